@@ -0,0 +1,110 @@
+# Backup of the input of makemoms(), instead of a full "cp -r" on every run.
+#
+# Policies:
+#   'copy' -- copy the cube to <cube>.backup, skipped when an identical backup is already there
+#             (same size and mtime, or else the same content hash). The copy is a reflink
+#             (copy-on-write, btrfs/XFS/APFS) where the filesystem supports it.
+#   'link' -- hard links to the files of the cube: no data is copied. The backup shares the data
+#             of the cube, so it only protects against deleting or replacing the cube.
+#   'none' -- no backup. makemoms() does not modify a FITS input.
+#
+# Usage:
+#   from backup import backup
+#   backup('cube.fits', policy='copy')
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import os
+import sys
+import shutil
+import subprocess
+from cache import files_of, stamp, file_digest
+
+
+POLICIES = ('copy', 'link', 'none')
+
+
+def same_content(path, target):
+    """True if target holds the same files as path: same size and mtime, or the same hash.
+    The hashes are not remembered: the cache of cache.py is only used with makemoms(cache=True)."""
+    if not os.path.exists(target):
+        return False
+    src, dst = files_of(path), files_of(target)
+    if [os.path.relpath(f, path) for f in src] != [os.path.relpath(f, target) for f in dst]:
+        return False
+    (size0, mtime0), (size1, mtime1) = stamp(src), stamp(dst)
+    if size0 != size1:
+        return False
+    return mtime0 == mtime1 or file_digest(path, remember=False) == file_digest(target, remember=False)
+
+
+def copy_data(path, target):
+    """copy with the mtimes kept, as a reflink where possible"""
+    if sys.platform.startswith('linux'):
+        if subprocess.call(['cp', '-rp', '--reflink=auto', path, target]) == 0:
+            return
+        shutil.rmtree(target, ignore_errors=True)
+    if os.path.isdir(path):
+        shutil.copytree(path, target)
+    else:
+        shutil.copy2(path, target)
+
+
+def _link(path, target):
+    """hard links to all the files of path. Falls back to a copy across filesystems."""
+    try:
+        if os.path.isfile(path):
+            os.link(path, target)
+            return
+        for name in files_of(path):
+            dst = os.path.join(target, os.path.relpath(name, path))
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.link(name, dst)
+    except OSError:
+        print("Hard links are not possible, copying ", path)
+        _remove(target)
+        copy_data(path, target)
+
+
+def _remove(target):
+    if os.path.isdir(target) and not os.path.islink(target):
+        shutil.rmtree(target)
+    elif os.path.lexists(target):
+        os.remove(target)
+
+
+def backup(path, policy='copy', suffix='.backup'):
+    """back up a FITS file or CASA image to path+suffix
+
+    Parameters
+    ----------
+    path : str
+        the FITS file or CASA image directory
+    policy : str
+        'copy', 'link' or 'none', see above
+    suffix : str
+        appended to path for the name of the backup
+
+    Returns
+    -------
+    the name of the backup, or None with policy='none'
+    """
+    if policy not in POLICIES:
+        raise ValueError("Unknown backup policy: "+str(policy)+", use one of "+str(POLICIES))
+    if policy == 'none':
+        return None
+    # -- a symlinked cube (e.g. in the scratch directories of batch.py) is backed up by its data, not by the link
+    path   = path.rstrip('/')
+    target = path+suffix
+    source = os.path.realpath(path)
+    if same_content(source, target):
+        print("Backup is up to date: ", target)
+        return target
+    _remove(target)
+    if policy == 'link':
+        _link(source, target)
+    else:
+        copy_data(source, target)
+    return target
@@ -0,0 +1,141 @@
+# Run makemoms() on many cubes at once.
+#
+# makemoms() writes fixed names ('sm.image', 'sm_sm.image', 'flagged.fits', 'file_w_dwarfs.fits',
+# 'mom0.fits', ...) into the current directory and runs "rm -rf mask*", so two runs in one
+# directory would overwrite each other. Here every job runs in its own process (a fresh one
+# per job) and in its own scratch directory. The moment maps are collected into outdir as
+# <cube>_<chans>_mom0.fits etc., and the scratch directory is removed afterwards.
+#
+# A job is (cube, chans, Npix). A failed job does not stop the others, its error is returned.
+#
+# Usage (CASA 6, with this directory in sys.path):
+#   from batch import batch_makemoms
+#   jobs = [('cube_CO65.fits', '485~510', 20), ('cube_CI10.fits', '300~330', 20)]
+#   results = batch_makemoms(jobs, processes=4)
+# or, from the shell, with a file of "cube chans Npix" lines:
+#   python batch.py jobs.txt 4
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import importlib
+import traceback
+import functools
+import multiprocessing
+from backup import copy_data
+
+
+SCRIPTS = {'makemoments': 'makemoments', 'multibeam': 'makemoments_multibeam'}
+
+
+def _casa_namespace(module):
+    """give a makemoms script the CASA tasks and image tool it expects as globals,
+    when it is imported as a module instead of with execfile() in the CASA prompt"""
+    import casatasks
+    import casatools
+    for name in ('importfits', 'exportfits', 'imhead', 'imsmooth', 'specsmooth', 'imstat', 'immoments'):
+        if not hasattr(module, name):
+            setattr(module, name, getattr(casatasks, name))
+    if not hasattr(module, 'ia'):
+        module.ia = casatools.image()
+    return module
+
+
+def run_job(job, script='makemoments', outdir=None, scratch=None, keep_scratch=False, **kwargs):
+    """run one makemoms() job in a private scratch directory
+
+    Parameters
+    ----------
+    job : tuple
+        (cube, chans, Npix)
+    script : str
+        'makemoments' or 'multibeam', the makemoms() to run
+    outdir : str
+        where the moment maps are collected. Default: the directory of the cube
+    scratch : str
+        the parent of the scratch directories. Default: the system temporary directory
+    keep_scratch : bool
+        keep the scratch directory, e.g. for debugging
+    kwargs :
+        passed to makemoms() (memory_budget, workers, cache)
+
+    Returns
+    -------
+    dict with the cube, the collected outputs, the scratch directory and the error (or None)
+    """
+    cube, chans, Npix = job
+    cube    = os.path.abspath(cube).rstrip('/')
+    outdir  = os.path.abspath(outdir or os.path.dirname(cube))
+    name    = os.path.basename(cube)
+    stem    = name[0:-5] if name.endswith('.fits') else name
+    workdir = tempfile.mkdtemp(prefix=stem+'.', dir=scratch)
+    result  = {'cube': cube, 'chans': chans, 'Npix': Npix, 'outputs': [], 'scratch': workdir, 'error': None}
+    cwd     = os.getcwd()
+    try:
+        # -- the cube is linked into the scratch directory, so that everything makemoms() writes,
+        #    including the maps named after the cube, stays there. makemoms() writes the mask into
+        #    a CASA image, so an image is copied instead (a reflink where possible), and the
+        #    original is never touched: no backup is needed in the scratch directory.
+        if not os.path.exists(cube):
+            raise IOError("No such cube: "+cube)
+        os.chdir(workdir)
+        if os.path.isdir(cube):
+            copy_data(cube, name)
+        else:
+            os.symlink(cube, name)
+        if script == 'makemoments':
+            kwargs.setdefault('backup_policy', 'none')
+        module = _casa_namespace(importlib.import_module(SCRIPTS[script]))
+        module.makemoms(name, chans, Npix, **kwargs)
+        os.makedirs(outdir, exist_ok=True)
+        tag = str(chans).replace('~', '-').replace(';', '_').replace(',', '_')
+        for mom in sorted(glob.glob('*mom[012].fits')):
+            target = os.path.join(outdir, stem+'_'+tag+'_'+mom[-9:])
+            shutil.move(mom, target)
+            result['outputs'].append(target)
+    except Exception:
+        result['error'] = traceback.format_exc()
+    finally:
+        os.chdir(cwd)
+        if not keep_scratch and result['error'] is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def batch_makemoms(jobs, processes=None, script='makemoments', outdir=None, scratch=None, keep_scratch=False, **kwargs):
+    """run makemoms() on a list of (cube, chans, Npix) jobs in a pool of processes
+
+    Every job gets a new process (the CASA tools keep state between calls) and its own
+    scratch directory, see run_job(). The other parameters are those of run_job().
+
+    Returns
+    -------
+    list of the results of run_job(), in the order of jobs
+    """
+    run  = functools.partial(run_job, script=script, outdir=outdir, scratch=scratch, keep_scratch=keep_scratch, **kwargs)
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    try:
+        results = pool.map(run, [tuple(job) for job in jobs], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    for res in results:
+        if res['error'] is None:
+            print("Done:   ", res['cube'], res['chans'], res['outputs'])
+        else:
+            print("Failed: ", res['cube'], res['chans'], "(scratch kept in "+res['scratch']+")")
+            print(res['error'])
+    return results
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1]) as f:
+        jobs = [line.split() for line in f if line.strip() and not line.startswith('#')]
+    jobs = [(cube, chans, Npix if Npix == 'none' else float(Npix)) for cube, chans, Npix in jobs]
+    batch_makemoms(jobs, processes=int(sys.argv[2]) if len(sys.argv) > 2 else None)
@@ -0,0 +1,135 @@
+# Beam table of a cube: major, minor (arcsec) and position angle (deg) of every channel and
+# stokes plane, as NumPy arrays of shape (nstokes, nchan).
+#
+# It replaces the Python loops over myhead['perplanebeams']['*'+str(i)] in makemoments.py,
+# makemoments_multibeam.py and extract.py. The table is read from the imhead(mode='list')
+# record, or from the BEAMS table (or BMAJ/BMIN/BPA keywords) of a FITS file, and it is
+# remembered per file and modification time, so every tool parses a header only once.
+# A cube with a single beam gives a (1, 1) table, which broadcasts against the channels.
+#
+# Usage:
+#   from beams import beam_table
+#   bt = beam_table('cube.fits')                     # or beam_table(imgname, myhead)
+#   bt.major[0], bt.area(), bt.pixels_per_beam(0.06)
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import os
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from cache import files_of, stamp
+
+
+_TABLES = {}
+
+
+def _value(quantity, unit):
+    """value of an imhead quantity record {'value': ..., 'unit': ...} in unit"""
+    return (quantity['value'] * u.Unit(quantity['unit'])).to(unit).value
+
+
+class BeamTable(object):
+    """per-plane beams of a cube
+
+    Parameters
+    ----------
+    major, minor : array_like
+        FWHM in arcsec, shape (nstokes, nchan), (nchan,) or scalar
+    pa : array_like
+        position angle in deg, east of north, same shape
+    """
+
+    def __init__(self, major, minor, pa):
+        self.major = np.atleast_2d(np.asarray(major, dtype=np.float64))
+        self.minor = np.atleast_2d(np.asarray(minor, dtype=np.float64))
+        self.pa    = np.atleast_2d(np.asarray(pa, dtype=np.float64))
+
+    @property
+    def nstokes(self):
+        return self.major.shape[0]
+
+    @property
+    def nchan(self):
+        return self.major.shape[1]
+
+    @property
+    def per_plane(self):
+        return self.major.size > 1
+
+    @classmethod
+    def from_imhead(cls, myhead):
+        """from the record of imhead(imagename, mode='list')"""
+        if 'perplanebeams' not in myhead:
+            return cls(_value(myhead['beammajor'], u.arcsec), _value(myhead['beamminor'], u.arcsec),
+                       _value(myhead['beampa'], u.deg))
+        planes  = myhead['perplanebeams']
+        nchan   = planes['nChannels']
+        nstokes = planes.get('nStokes', 1)
+        # -- the planes are numbered channel first: '*'+str(stokes*nchan + chan)
+        beams   = [planes['*'+str(i)] for i in range(nchan * nstokes)]
+        major   = [_value(b['major'], u.arcsec) for b in beams]
+        minor   = [_value(b['minor'], u.arcsec) for b in beams]
+        pa      = [_value(b['positionangle'], u.deg) for b in beams]
+        shape   = (nstokes, nchan)
+        return cls(np.reshape(major, shape), np.reshape(minor, shape), np.reshape(pa, shape))
+
+    @classmethod
+    def from_fits(cls, hdulist):
+        """from the BEAMS table of a FITS file, or the BMAJ/BMIN/BPA keywords of its primary header"""
+        if 'BEAMS' not in hdulist:
+            header = hdulist[0].header
+            return cls(header['BMAJ'] * 3600., header['BMIN'] * 3600., header.get('BPA', 0.))
+        table   = hdulist['BEAMS']
+        data    = table.data
+        nchan   = table.header.get('NCHAN', data['CHAN'].max() + 1)
+        nstokes = table.header.get('NPOL', data['POL'].max() + 1)
+        units   = [table.columns[name].unit or default for name, default in (('BMAJ', 'arcsec'), ('BMIN', 'arcsec'), ('BPA', 'deg'))]
+        out     = [np.full((nstokes, nchan), np.nan) for i in range(3)]
+        for arr, name, unit, target in zip(out, ('BMAJ', 'BMIN', 'BPA'), units, ('arcsec', 'arcsec', 'deg')):
+            arr[data['POL'], data['CHAN']] = (data[name] * u.Unit(unit)).to(target).value
+        return cls(*out)
+
+    def channel(self, stokes=0):
+        """(major, minor, pa) arrays of one stokes plane"""
+        return self.major[stokes], self.minor[stokes], self.pa[stokes]
+
+    def mean(self):
+        """(major, minor, pa) averaged over all the planes"""
+        return np.nanmean(self.major), np.nanmean(self.minor), np.nanmean(self.pa)
+
+    def area(self):
+        """beam area (arcsec^2) of every plane, pi x bmaj x bmin / (4 ln2)"""
+        return np.pi * self.major * self.minor / (4 * np.log(2))
+
+    def pixels_per_beam(self, cdelt1, cdelt2=None):
+        """number of pixels in the beam of every plane, for pixel sizes in arcsec"""
+        cdelt2 = cdelt1 if cdelt2 is None else cdelt2
+        return self.area() / np.abs(cdelt1 * cdelt2)
+
+
+def beam_table(filename, myhead=None):
+    """the BeamTable of a FITS file or CASA image, remembered by file and modification time
+
+    Parameters
+    ----------
+    filename : str
+        the FITS file or CASA image
+    myhead : dict
+        optional record of imhead(filename, mode='list'), if it was read already.
+        Otherwise FITS files are read with astropy and CASA images with imhead.
+    """
+    path = os.path.realpath(filename)
+    key  = (path,) + stamp(files_of(path))
+    if key not in _TABLES:
+        if myhead is not None:
+            _TABLES[key] = BeamTable.from_imhead(myhead)
+        elif os.path.isfile(path):
+            with fits.open(path) as hdulist:
+                _TABLES[key] = BeamTable.from_fits(hdulist)
+        else:
+            from casatasks import imhead
+            _TABLES[key] = BeamTable.from_imhead(imhead(path, mode='list'))
+    return _TABLES[key]
@@ -0,0 +1,208 @@
+# Content-addressed on-disk cache for makemoms().
+#
+# The expensive part of makemoms() -- smoothing, masking and flagging the dwarfs -- only
+# depends on the input cube and a few parameters, not on the channel range of the moments.
+# Its product, the dwarf-cleaned cube (its finite voxels are the mask), is stored under a key
+# made of the hash of the input cube (FITS file or CASA image directory) and the parameters
+# (smoothing factor, nsigma, noise method, Npix, ...). A rerun with the same key only makes
+# the moment maps from the cached cube.
+#
+# The cache is opt-in (makemoms(..., cache=True)). It lives in $MAKEMOMS_CACHE (default
+# ~/.makemoms_cache), one directory per key. The least recently used entries are removed when
+# the total size exceeds $MAKEMOMS_CACHE_LIMIT (GB, default 2). The first use of an input reads
+# it once to hash it.
+# Entries are written under a temporary name and renamed: when two runs store the same key,
+# the first complete entry is kept and the other is discarded.
+# The hash of an input is remembered by (path, size, mtime), so unchanged inputs are not re-read.
+#
+# Usage:
+#   from cache import cache_key, lookup, store
+#   key   = cache_key('cube.fits', factor=1.5, nsigma=3, Npix=20)
+#   entry = lookup(key)                  # the entry directory, or None
+#   store(key, ['file_wo_dwarfs.fits'], meta={'cutoff': 0.01})
+# From the shell:
+#   python cache.py list
+#   python cache.py purge [key]
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+
+
+CACHE_DIR     = os.environ.get('MAKEMOMS_CACHE', os.path.expanduser('~/.makemoms_cache'))
+CACHE_LIMIT   = int(float(os.environ.get('MAKEMOMS_CACHE_LIMIT', 2)) * 2**30)   # bytes
+CACHE_VERSION = 1                    # bump when the cached products change
+BLOCKSIZE     = 2**24
+DIGESTS       = 'digests'            # the directory of the remembered input digests
+
+
+def files_of(path):
+    """the files of a FITS file or of a CASA image directory, in a fixed order"""
+    if os.path.isfile(path):
+        return [path]
+    out = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        out += [os.path.join(root, f) for f in sorted(files)]
+    return out
+
+
+def stamp(files):
+    """(total size, latest mtime) of a list of files"""
+    stats = [os.stat(f) for f in files]
+    return sum(s.st_size for s in stats), max([s.st_mtime_ns for s in stats] or [0])
+
+
+def _tree_size(path):
+    return stamp(files_of(path))[0] if os.path.exists(path) else 0
+
+
+def file_digest(path, cache_dir=None, remember=True):
+    """sha1 of the content of a FITS file or CASA image directory
+
+    With remember=True, the digest is remembered in the cache directory by (path, size, mtime),
+    one small file per input under digests/, so an unchanged input is only read once, and
+    concurrent runs (see batch.py) do not overwrite each other's digests. With remember=False
+    the input is hashed, and the cache directory is not touched.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    path  = os.path.realpath(path)
+    files = files_of(path)
+    size, mtime = stamp(files)
+    index = os.path.join(cache_dir, DIGESTS, hashlib.sha1(path.encode()).hexdigest()+'.json')
+    if remember and os.path.exists(index):
+        with open(index) as f:
+            known = json.load(f)
+        if known[:3] == [path, size, mtime]:
+            return known[3]
+
+    sha = hashlib.sha1()
+    for name in files:
+        sha.update(os.path.relpath(name, path).encode())
+        with open(name, 'rb') as f:
+            for chunk in iter(lambda: f.read(BLOCKSIZE), b''):
+                sha.update(chunk)
+    if not remember:
+        return sha.hexdigest()
+    os.makedirs(os.path.dirname(index), exist_ok=True)
+    tmp = index+'.'+str(os.getpid())+'.tmp'
+    with open(tmp, 'w') as f:
+        json.dump([path, size, mtime, sha.hexdigest()], f)
+    os.replace(tmp, index)
+    return sha.hexdigest()
+
+
+def cache_key(filename, cache_dir=None, **params):
+    """key of a cache entry: the hash of the input and of the parameters"""
+    params = dict(params, version=CACHE_VERSION, input=file_digest(filename, cache_dir))
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def lookup(key, cache_dir=None):
+    """the directory of a complete cache entry (marked as just used), or None"""
+    entry = os.path.join(cache_dir or CACHE_DIR, key)
+    if not os.path.exists(os.path.join(entry, 'meta.json')):
+        return None
+    os.utime(entry)
+    return entry
+
+
+def read_meta(entry):
+    with open(os.path.join(entry, 'meta.json')) as f:
+        return json.load(f)
+
+
+def store(key, files, meta=None, cache_dir=None, limit=CACHE_LIMIT):
+    """copy files (FITS files or CASA images) into a new cache entry, then apply the size limit.
+    An existing entry of the same key (e.g. stored by a concurrent run) is kept as it is.
+
+    Parameters
+    ----------
+    key : str
+        see cache_key()
+    files : list
+        the products to keep
+    meta : dict
+        small JSON-able values kept along (e.g. the cutoff)
+    limit : int
+        the maximum total size of the cache in bytes
+
+    Returns
+    -------
+    the entry directory
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    entry = os.path.join(cache_dir, key)
+    if lookup(key, cache_dir):
+        return entry
+    tmp   = entry+'.'+str(os.getpid())+'.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for name in files:
+        if os.path.isdir(name):
+            shutil.copytree(name, os.path.join(tmp, os.path.basename(name)))
+        else:
+            shutil.copy2(name, tmp)
+    meta = dict(meta or {}, files=[os.path.basename(name) for name in files], created=time.time())
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # -- a concurrent run has stored the same key first: its entry is as good as this one
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not lookup(key, cache_dir):
+            raise
+    prune(limit, cache_dir, keep=key)
+    return entry
+
+
+def entries(cache_dir=None):
+    """(key, size, last used) of the cache entries, the least recently used first"""
+    cache_dir = cache_dir or CACHE_DIR
+    if not os.path.isdir(cache_dir):
+        return []
+    out = []
+    for key in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, key)
+        if os.path.isdir(entry) and not key.endswith('.tmp') and key != DIGESTS:
+            out.append((key, _tree_size(entry), os.stat(entry).st_mtime))
+    return sorted(out, key=lambda e: e[2])
+
+
+def prune(limit=CACHE_LIMIT, cache_dir=None, keep=None):
+    """remove the least recently used entries until the cache is smaller than limit (bytes)"""
+    cache_dir = cache_dir or CACHE_DIR
+    items = entries(cache_dir)
+    total = sum(e[1] for e in items)
+    for key, size, used in items:
+        if total <= limit:
+            break
+        if key == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total -= size
+
+
+def purge(key=None, cache_dir=None):
+    """remove one entry, or the whole cache"""
+    cache_dir = cache_dir or CACHE_DIR
+    if key is None:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    else:
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'purge':
+        purge(sys.argv[2] if len(sys.argv) > 2 else None)
+    else:
+        for key, size, used in entries():
+            print(key, '%10.1f MB' % (size / 2**20), time.strftime('%Y-%m-%d %H:%M', time.localtime(used)))
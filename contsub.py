@@ -0,0 +1,175 @@
+# Image-plane continuum subtraction of a cube, for quick looks without uvcontsub.
+#
+# The continuum of every pixel is a low-order polynomial in the channel, fitted to the line-free
+# channels. The design matrix V (channels x order+1) and its pseudo-inverse P are the same for
+# all the pixels, so the fit of all the pixels of a tile is one matrix product
+#   coefficients = P @ data[linefree, pixels],    continuum = V @ coefficients
+# Pixels with blanked (NaN) line-free channels are solved from their own normal equations, all
+# of them at once. The cube (FITS memmap, CASA image or any (chan, y, x) array, including
+# np.memmap) is streamed in spatial tiles of all the channels, within a memory budget, and the
+# line cube (and the continuum, if wanted) is written into a memory-mapped FITS file.
+#
+# The line-free channels are given as in uvcontsub, e.g. fitspw='0:500~1000;3300~3700' (the spw
+# is ignored), or as a boolean array.
+#
+# Usage:
+#   from contsub import contsub
+#   contsub('cube.fits', '0:500~1000;3300~3700', order=1, outfile='cube.line.fits', contfile='cube.cont.fits')
+# or, from the shell:
+#   python contsub.py cube.fits 500~1000;3300~3700 [order]
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import sys
+import numpy as np
+from astropy.io import fits
+from moments import parse_chans, spectral_view
+from cube    import Cube
+
+
+def linefree_channels(fitspw, nchan):
+    """boolean array of the line-free channels, from a uvcontsub fitspw ('0:500~1000;3300~3700') or a boolean array"""
+    if isinstance(fitspw, str):
+        return parse_chans(';'.join(seg.split(':')[-1] for seg in fitspw.replace(',', ';').split(';')), nchan)
+    return np.asarray(fitspw, dtype=bool)
+
+
+def design_matrix(nchan, order=1):
+    """(nchan, order+1) polynomial design matrix, in channels scaled to [-1, 1]"""
+    return np.vander(np.linspace(-1., 1., nchan), order + 1, increasing=True)
+
+
+def fit_continuum(data, linefree, order=1, model=None):
+    """continuum of every spectrum of data (chan, ...), a polynomial fitted to the line-free channels
+
+    Parameters
+    ----------
+    data : ndarray
+        (chan, ...) spectra
+    linefree : ndarray
+        (chan,) boolean, the line-free channels
+    order : int
+        the order of the polynomial
+    model : tuple
+        (V, P), the design matrix and the pseudo-inverse of its line-free rows, when they are
+        shared by many calls
+
+    Returns
+    -------
+    the continuum, shaped as data. NaN for spectra with fewer than order+1 valid line-free channels.
+    """
+    nchan = data.shape[0]
+    V, P  = model or (design_matrix(nchan, order), np.linalg.pinv(design_matrix(nchan, order)[linefree]))
+    free  = np.asarray(data, dtype=np.float64).reshape(nchan, -1)[linefree]
+    valid = np.isfinite(free)
+    good  = valid.all(0)
+    coef  = np.full((V.shape[1], free.shape[1]), np.nan)
+    coef[:, good] = P @ free[:, good]
+
+    # -- blanked channels: the normal equations of every such pixel, solved together
+    some = ~good & (valid.sum(0) >= V.shape[1])
+    if some.any():
+        Vf   = V[linefree]
+        mask = valid[:, some].astype(np.float64)
+        A    = np.einsum('cp,cn,cq->npq', Vf, mask, Vf)
+        b    = np.einsum('cp,cn->np', Vf, np.where(valid[:, some], free[:, some], 0.))
+        coef[:, some] = (np.linalg.pinv(A) @ b[..., None])[..., 0].T
+    return (V @ coef).reshape(data.shape)
+
+
+def subtract_continuum(cube, linefree, order=1, out=None, contout=None, memory_budget=2**28):
+    """stream a (chan, y, x) cube in spatial tiles, and subtract the continuum of every pixel
+
+    Parameters
+    ----------
+    cube : Cube or ndarray
+        anything indexed as cube[:, y0:y1, x0:x1], e.g. a Cube (cube.py) or an np.memmap
+    linefree : str or ndarray
+        the line-free channels, see linefree_channels()
+    order : int
+        the order of the polynomial
+    out, contout : ndarray
+        (chan, y, x) arrays for the line and the continuum cubes (e.g. memory-mapped). Default:
+        a new array for the line, no continuum
+    memory_budget : int
+        bytes of one tile and its fit
+
+    Returns
+    -------
+    out
+    """
+    nchan, ny, nx = cube.shape
+    linefree = linefree_channels(linefree, nchan)
+    if linefree.sum() < order + 1:
+        raise ValueError("Need at least "+str(order + 1)+" line-free channels for a polynomial of order "+str(order))
+    V     = design_matrix(nchan, order)
+    model = (V, np.linalg.pinv(V[linefree]))
+    if out is None:
+        out = np.empty((nchan, ny, nx), dtype=np.float32)
+
+    npix   = max(1, memory_budget // (nchan * 8 * 4))
+    tx     = int(min(nx, npix))
+    ty     = int(max(1, min(ny, npix // tx)))
+    for y0 in range(0, ny, ty):
+        for x0 in range(0, nx, tx):
+            tile = np.asarray(cube[:, y0:y0+ty, x0:x0+tx], dtype=np.float64)
+            cont = fit_continuum(tile, linefree, order, model)
+            out[:, y0:y0+ty, x0:x0+tx] = tile - cont
+            if contout is not None:
+                contout[:, y0:y0+ty, x0:x0+tx] = cont
+    return out
+
+
+def _create_fits(filename, header):
+    """an empty float32 FITS file with the shape of header, opened memory-mapped for writing"""
+    header = header.copy()
+    header['BITPIX'] = -32
+    for key in ('BSCALE', 'BZERO', 'BLANK'):
+        header.remove(key, ignore_missing=True)
+    nbytes = 4 * int(np.prod([header['NAXIS'+str(i)] for i in range(1, header['NAXIS'] + 1)]))
+    header.tofile(filename, overwrite=True)
+    with open(filename, 'rb+') as f:
+        f.seek(len(header.tostring()) + (nbytes + 2879) // 2880 * 2880 - 1)
+        f.write(b'\0')
+    return fits.open(filename, mode='update', memmap=True)
+
+
+def contsub(filename, fitspw, order=1, outfile=None, contfile=None, memory_budget=2**28):
+    """image-plane continuum subtraction of a FITS cube or CASA image
+
+    Parameters
+    ----------
+    filename : str
+        the cube
+    fitspw : str or ndarray
+        the line-free channels, e.g. '0:500~1000;3300~3700'
+    order : int
+        the order of the polynomial (fitorder of uvcontsub)
+    outfile : str
+        the line cube. Default: filename with .line.fits
+    contfile : str
+        the continuum cube. Default: not written
+    memory_budget : int
+        bytes, see subtract_continuum()
+
+    Returns
+    -------
+    outfile
+    """
+    outfile = outfile or filename.rstrip('/').replace('.fits', '')+'.line.fits'
+    with Cube(filename) as cube:
+        header = fits.Header(cube.header)
+        header.remove('SIMPLE', ignore_missing=True)
+        header.insert(0, ('SIMPLE', True))
+        files  = [_create_fits(name, header) for name in (outfile, contfile) if name]
+        views  = [spectral_view(f[0].data, header) for f in files]
+        subtract_continuum(cube, fitspw, order, views[0], views[1] if contfile else None, memory_budget)
+        for f in files:
+            f.close()
+    return outfile
+
+
+if __name__ == '__main__':
+    print(contsub(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 1))
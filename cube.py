@@ -0,0 +1,191 @@
+# Lazy access to FITS cubes and CASA images, shared by the cube tools.
+#
+# Cube('cube.fits') opens the FITS file memory-mapped, Cube('cube.image') reads a CASA image
+# through the image tool (CasaReader). Both look like a (chan, y, x) array of the first stokes
+# plane: cube[c0:c1, y0:y1, x0:x1] only reads that region into memory. The WCS gives the
+# indexing by sky position and by frequency or velocity:
+#   cube.pixel('13:15:06.315,-55.09.22.764')          -> (x, y)
+#   cube.channel(230.5 * u.GHz)                       -> channel (float)
+#   cube.cutout('19h10m13.148s, 09d06m12.970s', 0.3)  -> (chan, y, x) box of radius 0.3 arcsec
+#
+# Usage:
+#   from cube import Cube
+#   with Cube('cube.fits') as cube:
+#       spec = cube[:, 100, 120]
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import os
+import numpy as np
+import astropy.units as u
+from astropy.io          import fits
+from astropy.wcs         import WCS
+from astropy.coordinates import SkyCoord
+from moments import spectral_view, velocity_axis
+from beams   import beam_table
+
+
+def parse_position(location):
+    """SkyCoord of a position, given as a SkyCoord or as in CASA regions,
+    e.g. '19h10m13.148s, 09d06m12.970s' or '13:15:06.315,-55.09.22.764'"""
+    if isinstance(location, SkyCoord):
+        return location
+    ra, dec = [s.strip() for s in str(location).replace('J2000', '').split(',')]
+    # -- CASA writes the declination as dd.mm.ss.sss
+    if ':' not in dec and 'd' not in dec and dec.count('.') > 1:
+        dec = dec.replace('.', ':', 2)
+    return SkyCoord(ra, dec, unit=(u.hourangle, u.deg))
+
+
+def _bounds(index, n):
+    """(start, stop, step, squeeze) of one slice or integer index along an axis of length n"""
+    if isinstance(index, slice):
+        start, stop, step = index.indices(n)
+        if step < 0:
+            raise IndexError("Negative steps are not supported")
+        return start, max(start, stop), step, False
+    i = int(index)
+    i = i + n if i < 0 else i
+    if not 0 <= i < n:
+        raise IndexError("Index "+str(index)+" is out of range")
+    return i, i+1, 1, True
+
+
+class CasaReader(object):
+    """(chan, y, x) view of the first stokes plane of a CASA image, read with ia.getchunk()
+
+    Only the requested region is read. Masked pixels are NaN.
+    """
+
+    def __init__(self, imagename):
+        from casatools import image
+        self.ia = image()
+        self.ia.open(imagename)
+        csys = self.ia.coordsys()
+        self.spec   = int(csys.findcoordinate('spectral')['pixel'][0])
+        self.casa_shape = list(self.ia.shape())
+        csys.done()
+        self.shape  = (self.casa_shape[self.spec], self.casa_shape[1], self.casa_shape[0])
+        self.ndim   = 3
+        self.dtype  = np.dtype(np.float32)
+        self.header = fits.Header(self.ia.fitsheader())
+
+    def __getitem__(self, index):
+        index = index if isinstance(index, tuple) else (index,)
+        index = index + (slice(None),) * (3 - len(index))
+        # -- channel lists (as in moments()) are read as one range, and picked afterwards
+        pick  = None
+        if not isinstance(index[0], (slice, int, np.integer)):
+            pick  = np.asarray(index[0])
+            index = (slice(int(pick.min()), int(pick.max())+1),) + index[1:]
+        bounds = [_bounds(i, n) for i, n in zip(index, self.shape)]
+        counts = [len(range(*b[:3])) for b in bounds]
+        if 0 in counts:
+            return np.zeros([c for c, b in zip(counts, bounds) if not b[3]], dtype=self.dtype)
+        blc = [0] * len(self.casa_shape)
+        trc = [0] * len(self.casa_shape)
+        inc = [1] * len(self.casa_shape)
+        for axis, (start, stop, step, squeeze), count in zip((self.spec, 1, 0), bounds, counts):
+            blc[axis], trc[axis], inc[axis] = start, start + step * (count - 1), step
+        pixels = self.ia.getchunk(blc=blc, trc=trc, inc=inc).astype(self.dtype)
+        pixels[~self.ia.getchunk(blc=blc, trc=trc, inc=inc, getmask=True)] = np.nan
+        # -- CASA order (x, y, ...) to (chan, y, x), the degenerate stokes axis dropped
+        order = [self.spec, 1, 0] + [a for a in range(pixels.ndim) if a not in (self.spec, 1, 0)]
+        data  = pixels.transpose(order).reshape(counts)
+        if pick is not None:
+            data = data[pick - pick.min()]
+        return data[tuple(0 if b[3] else slice(None) for b in bounds)]
+
+    def close(self):
+        self.ia.close()
+
+
+class Cube(object):
+    """a FITS cube (memory-mapped) or a CASA image, seen as a lazy (chan, y, x) array
+
+    Parameters
+    ----------
+    filename : str
+        the FITS file or CASA image directory
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        if os.path.isfile(filename):
+            self._hdulist = fits.open(filename, memmap=True)
+            self.header   = self._hdulist[0].header
+            self.data     = spectral_view(self._hdulist[0].data, self.header)
+        else:
+            self._hdulist = None
+            self.data     = CasaReader(filename)
+            self.header   = self.data.header
+        self.wcs       = WCS(self.header)
+        self.celestial = self.wcs.celestial
+        self.shape     = self.data.shape
+
+    def __getitem__(self, index):
+        """read a region, e.g. cube[c0:c1, y0:y1, x0:x1], into memory"""
+        return np.asarray(self.data[index])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._hdulist is not None:
+            self._hdulist.close()
+        else:
+            self.data.close()
+
+    @property
+    def beams(self):
+        """the BeamTable of the cube, see beams.py"""
+        return beam_table(self.filename)
+
+    def pixel_scale(self):
+        """(|cdelt1|, |cdelt2|) in arcsec"""
+        return tuple(float(abs(scale.to(u.arcsec).value)) for scale in self.celestial.proj_plane_pixel_scales())
+
+    def spectral_axis(self):
+        """world coordinate of every channel (Hz, or m/s for velocity axes), from the full WCS"""
+        spec = self.wcs.sub(['spectral'])
+        return spec.all_pix2world(np.arange(self.shape[0]), 0)[0] * u.Unit(spec.wcs.cunit[0])
+
+    def velocity(self):
+        """radio velocity of every channel in km/s"""
+        return velocity_axis(self.header)
+
+    def pixel(self, position):
+        """(x, y) pixel coordinates (float, 0-based) of a sky position, see parse_position()"""
+        x, y = self.celestial.world_to_pixel(parse_position(position))
+        return float(x), float(y)
+
+    def channel(self, value):
+        """channel (float, 0-based) of a frequency or velocity quantity"""
+        spec  = self.wcs.sub(['spectral'])
+        unit  = u.Unit(spec.wcs.cunit[0])
+        if value.unit.is_equivalent(u.km/u.s) and unit.is_equivalent(u.Hz):
+            restfrq = spec.wcs.restfrq or self.header.get('RESTFRQ', self.header.get('RESTFREQ'))
+            value   = value.to(u.Hz, equivalencies=u.doppler_radio(restfrq * u.Hz))
+        return float(spec.all_world2pix(value.to(unit).value, 0)[0])
+
+    def spectral_slice(self, lo, hi):
+        """slice of the channels between two frequency or velocity quantities"""
+        c0, c1 = sorted((self.channel(lo), self.channel(hi)))
+        return slice(max(0, int(np.ceil(c0))), min(self.shape[0], int(np.floor(c1)) + 1))
+
+    def box(self, position, radius):
+        """(slice y, slice x) of the pixels within radius (arcsec) of a position"""
+        x, y   = self.pixel(position)
+        rx, ry = [radius / scale for scale in self.pixel_scale()]
+        return (slice(max(0, int(np.floor(y - ry))), min(self.shape[1], int(np.ceil(y + ry)) + 1)),
+                slice(max(0, int(np.floor(x - rx))), min(self.shape[2], int(np.ceil(x + rx)) + 1)))
+
+    def cutout(self, position, radius, chans=slice(None)):
+        """(chan, y, x) array of the box around a position, see box(). Only the box is read."""
+        ys, xs = self.box(position, radius)
+        return self[chans, ys, xs]
@@ -0,0 +1,465 @@
+# Remove the small connected structures ("dwarfs") from a masked datacube.
+# This is the engine behind flagdwarfs() in makemoments.py and makemoments_multibeam.py
+#
+# Three engines are provided:
+#   drop_dwarfs()          -- in memory, one bincount over the label array
+#   drop_dwarfs_parallel() -- in memory, the channel planes (or slabs, when the structure
+#                             links the channels) are labelled by a pool of processes
+#                             that share the cube and the labels
+#   flagdwarfs_chunked()   -- out of core. The FITS cube is read with memmap one spectral slab
+#                             at a time, and the components are merged across the slab
+#                             boundaries with a union-find table. Results are identical to
+#                             drop_dwarfs(), but the peak memory is bounded by memory_budget.
+#
+# Usage (inside or outside CASA, with this directory in sys.path):
+#   from dwarfs import flagdwarfs, flagdwarfs_file
+#   sig, header = flagdwarfs(data, 20, header=header, workers=8)   # arrays in, arrays out
+#   flagdwarfs_file('file_w_dwarfs.fits', 20, outfile='flagged.fits', memory_budget=2**30)
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import os
+import multiprocessing
+import numpy as np
+from astropy.io import fits
+from scipy      import ndimage
+
+
+# This is to find connected components in an array
+# https://scipy-lectures.org/intro/scipy/auto_examples/plot_connect_measurements.html
+# by default, it is 2-D array. However, I found this to adopt to 3-D cubes
+# https://stackoverflow.com/questions/36917944/label-3d-numpy-array-with-scipy-ndimage-label
+# NB: it only links the 4 neighbours within one channel plane.
+STRUCTURE = np.array([[[0, 0, 0],
+                       [0, 0, 0],
+                       [0, 0, 0]],
+                      [[0, 1, 0],
+                       [1, 1, 1],
+                       [0, 1, 0]],
+                      [[0, 0, 0],
+                       [0, 0, 0],
+                       [0, 0, 0]]],
+                     dtype='uint8')
+
+
+def drop_dwarfs(sig, Npix, structure=STRUCTURE, workers=1):
+    """NaN out, in place, the connected components with less than Npix voxels
+
+    Parameters
+    ----------
+    sig : ndarray
+        3-D cube (chan, y, x). The voxels > 0 are regarded as signal.
+    Npix : float
+        the components smaller than Npix voxels are removed
+    structure : ndarray
+        the structure element passed to ndimage.label
+    workers : int
+        the number of processes. If > 1, see drop_dwarfs_parallel()
+
+    Returns
+    -------
+    the number of kept and dropped components
+    """
+    if workers > 1:
+        return drop_dwarfs_parallel(sig, Npix, structure, workers)
+    labels, nb = ndimage.label(sig > 0, structure=structure)
+    # -- voxel counts of all the components in one pass. label 0 is the background.
+    sizes = np.bincount(labels.ravel(), minlength=nb+1)
+    # -- keep/drop lookup table, indexed by label
+    drop    = sizes < Npix
+    drop[0] = False
+    sig[drop[labels]] = np.nan
+    ndrop = int(np.count_nonzero(drop))
+    return nb - ndrop, ndrop
+
+
+#--------- union-find table, vectorised over arrays of label pairs
+def uf_find(parent, x):
+    """return the roots of the labels x"""
+    root = parent[x]
+    while True:
+        up = parent[root]
+        if np.array_equal(up, root):
+            return root
+        root = up
+
+
+def uf_union(parent, a, b):
+    """merge the components of the label pairs (a, b). The smaller root wins."""
+    while len(a) > 0:
+        ra   = uf_find(parent, a)
+        rb   = uf_find(parent, b)
+        diff = ra != rb
+        if not diff.any():
+            return
+        a, b   = a[diff], b[diff]
+        ra, rb = ra[diff], rb[diff]
+        np.minimum.at(parent, np.maximum(ra, rb), np.minimum(ra, rb))
+
+
+def boundary_pairs(last, first, structure=STRUCTURE):
+    """find the label pairs linked across two adjacent channel planes
+
+    Parameters
+    ----------
+    last : ndarray
+        2-D global labels of the last plane of one slab
+    first : ndarray
+        2-D global labels of the first plane of the next slab
+    structure : ndarray
+        the 3x3x3 structure element. Only its forward plane, structure[2], matters.
+
+    Returns
+    -------
+    two arrays of the linked labels (unique pairs)
+    """
+    ny, nx = last.shape
+    pa, pb = [], []
+    for dy, dx in zip(*np.nonzero(structure[2])):
+        dy, dx = dy - 1, dx - 1
+        a = last [max(0,-dy):ny-max(0,dy), max(0,-dx):nx-max(0,dx)]
+        b = first[max(0, dy):ny+min(0,dy), max(0, dx):nx+min(0,dx)]
+        both = (a > 0) & (b > 0)
+        pa.append(a[both])
+        pb.append(b[both])
+    if len(pa) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    pairs = np.unique(np.stack([np.concatenate(pa), np.concatenate(pb)]).astype(np.int64), axis=1)
+    return pairs[0], pairs[1]
+
+
+def merge_components(sizes, pa, pb):
+    """merge the slab components linked across the slab boundaries
+
+    Parameters
+    ----------
+    sizes : list
+        the voxel counts of the labels, one array per slab (in global label order).
+        The first array holds the background, label 0.
+    pa, pb : list
+        arrays of the linked label pairs, from boundary_pairs()
+
+    Returns
+    -------
+    the root of every global label, and the voxel counts indexed by root
+    """
+    sizes  = np.concatenate(sizes)
+    parent = np.arange(len(sizes), dtype=np.int64)
+    if len(pa) > 0:
+        uf_union(parent, np.concatenate(pa), np.concatenate(pb))
+    roots = uf_find(parent, np.arange(len(sizes)))
+    sizes = np.bincount(roots, weights=sizes, minlength=len(sizes)).astype(np.int64)
+    return roots, sizes
+
+
+def dwarf_table(roots, sizes, Npix):
+    """keep/drop lookup table of the global labels, and the number of kept and dropped components"""
+    drop      = sizes[roots] < Npix
+    drop[0]   = False
+    isroot    = roots == np.arange(len(roots))
+    isroot[0] = False
+    ndrop     = int(np.count_nonzero(isroot & drop))
+    return drop, int(np.count_nonzero(isroot)) - ndrop, ndrop
+
+
+def slab_planes(shape, itemsize, memory_budget):
+    """number of channel planes per slab, so that one slab stays within memory_budget (bytes)"""
+    # data copy + boolean mask + int32 labels + boolean drop index
+    per_plane = shape[-1] * shape[-2] * (itemsize + 6)
+    return int(max(1, min(shape[0], memory_budget // per_plane)))
+
+
+def _cube_data(hdu):
+    # -- the memmapped (chan, y, x) view. 4-D cubes use the first stokes plane
+    data = hdu.data
+    if data.ndim == 4:
+        data = data[0]
+    return data
+
+
+def cube_header(header):
+    """header of the 3-D (chan, y, x) output, matching fits.PrimaryHDU(header=header, data=sig)"""
+    header = header.copy()
+    if header['NAXIS'] == 4:
+        header['NAXIS'] = 3
+        del header['NAXIS4']
+    for key in ('BSCALE', 'BZERO'):
+        header.remove(key, ignore_missing=True)
+    return header
+
+
+def _label_slab(data, z0, z1, structure):
+    slab = np.array(data[z0:z1])
+    labels, nb = ndimage.label(slab > 0, structure=structure)
+    return slab, labels, nb
+
+
+def label_chunked(filename, structure=STRUCTURE, memory_budget=2**30):
+    """label a FITS cube slab by slab, and merge the components across slab boundaries
+
+    Parameters
+    ----------
+    filename : str
+        the FITS cube, (chan, y, x) or (stokes, chan, y, x)
+    structure : ndarray
+        the structure element passed to ndimage.label
+    memory_budget : int
+        the maximum number of bytes of one slab (data, mask and labels)
+
+    Returns
+    -------
+    nplanes : int
+        the number of planes per slab
+    offsets : list
+        the global label offset of every slab
+    roots : ndarray
+        the union-find root of every global label (index 0 is the background)
+    sizes : ndarray
+        the number of voxels of every merged component, indexed by root
+    """
+    cube    = fits.open(filename, memmap=True)
+    data    = _cube_data(cube[0])
+    nplanes = slab_planes(data.shape, data.dtype.itemsize, memory_budget)
+
+    offsets = []
+    sizes   = [np.zeros(1, dtype=np.int64)]
+    pa, pb  = [], []
+    nlabel  = 0
+    last    = None
+    for z0 in range(0, data.shape[0], nplanes):
+        slab, labels, nb = _label_slab(data, z0, z0+nplanes, structure)
+        offsets.append(nlabel)
+        sizes.append(np.bincount(labels.ravel(), minlength=nb+1)[1:])
+
+        first = np.where(labels[0] > 0, labels[0] + np.int64(nlabel), 0)
+        if last is not None:
+            a, b = boundary_pairs(last, first, structure)
+            pa.append(a)
+            pb.append(b)
+        last    = np.where(labels[-1] > 0, labels[-1] + np.int64(nlabel), 0)
+        nlabel += nb
+        del slab, labels
+    cube.close()
+
+    roots, sizes = merge_components(sizes, pa, pb)
+    return nplanes, offsets, roots, sizes
+
+
+def flagdwarfs_chunked(filename, Npix, outfile='flagged.fits', structure=STRUCTURE, memory_budget=2**30):
+    """out-of-core version of flagdwarfs(). Write the cube without dwarfs into outfile.
+
+    Parameters
+    ----------
+    filename : str
+        the input FITS cube, the voxels > 0 are regarded as signal
+    Npix : float
+        the components smaller than Npix voxels are removed
+    outfile : str
+        the output FITS cube
+    structure : ndarray
+        the structure element passed to ndimage.label
+    memory_budget : int
+        the maximum number of bytes of one slab. The per-component tables
+        (a few int64 per component) come on top of it.
+
+    Returns
+    -------
+    the number of kept and dropped components
+    """
+    nplanes, offsets, roots, sizes = label_chunked(filename, structure, memory_budget)
+    drop, nkeep, ndrop = dwarf_table(roots, sizes, Npix)
+
+    # -- second pass: relabel every slab (same input, same labels) and write it out
+    cube   = fits.open(filename, memmap=True)
+    data   = _cube_data(cube[0])
+    if os.path.exists(outfile):
+        os.remove(outfile)
+    output = fits.StreamingHDU(outfile, cube_header(cube[0].header))
+    for z0, offset in zip(range(0, data.shape[0], nplanes), offsets):
+        slab, labels, nb = _label_slab(data, z0, z0+nplanes, structure)
+        lut    = drop[offset:offset+nb+1].copy()
+        lut[0] = False
+        slab[lut[labels]] = np.nan
+        output.write(slab)
+        del slab, labels
+    output.close()
+    cube.close()
+    return nkeep, ndrop
+
+
+#--------- flagdwarfs is to remove the small patches in the moment maps. Normally those patches smaller than the beam size would not be beloved (on high fidelity)
+#          The flagdwarfs API: arrays in, arrays out. File output is a thin wrapper.
+def flagdwarfs(data, Npix, header=None, structure=STRUCTURE, workers=1):
+    """remove the structures with less than Npix connected voxels from a cube in memory
+
+    Parameters
+    ----------
+    data : ndarray
+        (chan, y, x) or (stokes, chan, y, x) cube in FITS axis order. The voxels > 0
+        are regarded as signal; the dwarfs are set to NaN in place.
+    Npix : float
+        the components smaller than Npix voxels are removed
+    header : astropy.io.fits.Header
+        optional, the header of data
+    structure : ndarray
+        the structure element passed to ndimage.label
+    workers : int
+        the number of processes labelling the channel planes
+
+    Returns
+    -------
+    sig : ndarray
+        the (chan, y, x) cube without dwarfs; a view of the first stokes plane of 4-D data
+    header : astropy.io.fits.Header
+        the header matching sig, or None
+    """
+    sig = data[0] if data.ndim == 4 else data
+    print("=========================================================================")
+    print("|Eliminating 3-D structures with less than Npix connected pixels (in 3-D).|")
+    print("=========================================================================")
+    nkeep, ndrop = drop_dwarfs(sig, Npix, structure, workers)
+    print("Components kept: ", nkeep, "  dropped: ", ndrop)
+    if header is not None:
+        header = cube_header(header)
+    return sig, header
+
+
+def flagdwarfs_file(filename, Npix, outfile='flagged.fits', memory_budget=None, workers=1):
+    """FITS wrapper of flagdwarfs(): read filename, and write the cube without dwarfs into outfile
+
+    Parameters
+    ----------
+    filename : str
+        the input FITS cube
+    Npix : float
+        the components smaller than Npix voxels are removed
+    outfile : str
+        the output FITS cube
+    memory_budget : int
+        if given (bytes), label the cube out of core, see flagdwarfs_chunked()
+    workers : int
+        the number of processes labelling the channel planes (in memory only)
+    """
+    if memory_budget is not None:
+        print("=========================================================================")
+        print("|Eliminating 3-D structures with less than Npix connected pixels (in 3-D).|")
+        print("=========================================================================")
+        nkeep, ndrop = flagdwarfs_chunked(filename, Npix, outfile=outfile, memory_budget=memory_budget)
+        print("Components kept: ", nkeep, "  dropped: ", ndrop)
+        return
+
+    cube = fits.open(filename)
+    sig, header = flagdwarfs(cube[0].data, Npix, header=cube[0].header, workers=workers)
+    fits.PrimaryHDU(header=header, data=sig).writeto(outfile, overwrite=True)
+    cube.close()
+
+
+def fits_order(pixels, vaxis):
+    """view a CASA pixel array (ia.getchunk) in FITS axis order, (stokes, chan, y, x)
+
+    Parameters
+    ----------
+    pixels : ndarray
+        (x, y, chan) or (x, y, stokes, chan) or (x, y, chan, stokes)
+    vaxis : int
+        the CASA spectral axis, 2 or 3
+    """
+    cube = pixels.T
+    if cube.ndim == 4 and vaxis == 3:
+        cube = cube.swapaxes(0, 1)
+    return cube
+
+
+#--------- multi-process labelling. The cube and the labels live in shared memory,
+#          which the worker processes inherit when the pool starts.
+_shared = {}
+
+
+def _init_worker(sig_buf, lab_buf, shape, dtype):
+    _shared['sig']    = np.frombuffer(sig_buf, dtype=dtype).reshape(shape)
+    _shared['labels'] = np.frombuffer(lab_buf, dtype=np.int32).reshape(shape)
+
+
+def _label_task(args):
+    z0, z1, structure = args
+    labels = _shared['labels'][z0:z1]
+    nb     = ndimage.label(_shared['sig'][z0:z1] > 0, structure=structure, output=labels)
+    sizes  = np.bincount(labels.ravel(), minlength=nb+1)[1:]
+    return nb, sizes, labels[0].copy(), labels[-1].copy()
+
+
+def _apply_task(args):
+    z0, z1, lut = args
+    sig = _shared['sig'][z0:z1]
+    sig[lut[_shared['labels'][z0:z1]]] = np.nan
+
+
+def drop_dwarfs_parallel(sig, Npix, structure=STRUCTURE, workers=2):
+    """multi-process version of drop_dwarfs()
+
+    The cube is split along the spectral axis into about 4 slabs per worker.
+    With the default STRUCTURE every channel plane is independent, so the slabs
+    need no merging. If the structure links adjacent channels, the components are
+    merged across the slab boundaries with the union-find table, as in label_chunked().
+
+    Parameters
+    ----------
+    sig : ndarray
+        3-D cube (chan, y, x), modified in place. The voxels > 0 are regarded as signal.
+    Npix : float
+        the components smaller than Npix voxels are removed
+    structure : ndarray
+        the structure element passed to ndimage.label
+    workers : int
+        the number of processes
+
+    Returns
+    -------
+    the number of kept and dropped components
+    """
+    shape, dtype = sig.shape, sig.dtype
+    sig_buf = multiprocessing.RawArray('B', sig.nbytes)
+    lab_buf = multiprocessing.RawArray('B', sig.size * 4)
+    shared  = np.frombuffer(sig_buf, dtype=dtype).reshape(shape)
+    shared[...] = sig
+
+    step   = max(1, -(-shape[0] // (workers * 4)))
+    bounds = [(z0, min(shape[0], z0+step)) for z0 in range(0, shape[0], step)]
+
+    pool = multiprocessing.Pool(workers, _init_worker, (sig_buf, lab_buf, shape, dtype))
+    try:
+        results = pool.map(_label_task, [(z0, z1, structure) for z0, z1 in bounds])
+
+        offsets = []
+        sizes   = [np.zeros(1, dtype=np.int64)]
+        pa, pb  = [], []
+        nlabel  = 0
+        last    = None
+        for nb, size, first, final in results:
+            offsets.append(nlabel)
+            sizes.append(size)
+            first = np.where(first > 0, first + np.int64(nlabel), 0)
+            if last is not None:
+                a, b = boundary_pairs(last, first, structure)
+                pa.append(a)
+                pb.append(b)
+            last    = np.where(final > 0, final + np.int64(nlabel), 0)
+            nlabel += nb
+
+        roots, sizes = merge_components(sizes, pa, pb)
+        drop, nkeep, ndrop = dwarf_table(roots, sizes, Npix)
+
+        tasks = []
+        for (z0, z1), offset, result in zip(bounds, offsets, results):
+            lut    = drop[offset:offset+result[0]+1].copy()
+            lut[0] = False
+            tasks.append((z0, z1, lut))
+        pool.map(_apply_task, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    sig[...] = shared
+    return nkeep, ndrop
@@ -2,6 +2,8 @@
 # split(vis='uid___A002_Xb0ebd1_Xe3ea.ms.split.cal',outputvis='spw3_split.ms', field='6',spw='3',datacolumn='data') 
 # rm -rf spw3_split.ms.con*
 # uvcontsub(vis='spw3_split.ms',want_cont=True,fitspw='0:500~1000;3300~3700')  
+# (quick look, in the image plane: contsub('dirty.cube.fits', '0:500~1000;3300~3700'), see contsub.py)
+# (the line-free channels of a dirty cube, as fitspw: find_fitspw(['dirty.cube.fits'], spws=[0]), see linefree.py)
 # 
 # flagdata(vis ='spw3_split.ms.contsub',  mode = 'manual', antenna='DV04',flagbackup = F)
 
@@ -63,8 +65,9 @@ out_Beam = str(1.5 * max(maj,mir))+"arcsec"
 imsmooth(imagename=img1, outfile=sm_img1, kernel='gauss', major=out_Beam, minor=out_Beam, pa="0deg")  
 specsmooth(imagename=sm_img1, outfile=sm_sm_img1,  axis=3, dmethod="",function='hanning',overwrite=True)  
 
-up_cutoff = 2 * imstat(sm_sm_img1,box='50,50,150,150')['rms'][0]
-threshold = 2 * imstat(sm_sm_img1,box='50,50,150,150')['rms'][0]
+rms       = imstat(sm_sm_img1,box='50,50,150,150')['rms'][0]
+up_cutoff = 2 * rms
+threshold = 2 * rms
 
 
 os.system("rm -rf sm_dirty_image.fits")
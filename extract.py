@@ -13,7 +13,6 @@
 #  import subprocess, sys
 #  subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'astropy'])
 #  import astropy
-#  subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'photutils'])
 
 #-----------------------------------------------------------
 
@@ -33,8 +32,12 @@ import astropy.units as u
 import matplotlib.pyplot as plt
 from   astropy.io          import fits
 from   astropy             import wcs
-from   photutils           import aperture_photometry, CircularAperture
 from   matplotlib.patches  import Ellipse
+from   beams               import beam_table
+from   spectra             import extract_spectra
+from   fluxes              import frequency_axis, beam_pixels, to_jy, to_tb, convert_spectra
+from   output              import write_spectra, plot_in_background, wait_plots
+from   wideband            import extract_wideband
 
 os.system("rm -rf *fit_beam*")
 
@@ -61,135 +64,123 @@ location=['13:15:06.315,-55.09.22.764',#  14h13m09.9415s,-65d20m21.0279s', # 0
 
 AperDiameter = 0.6 # arcsec 
 k            = 0 # the number in the filelist and associated location 
+spectral_tiles = False # True: read the spectra from a spectral-contiguous copy of the cube (<cube>.tiles, see tiles.py), built on the first run 
+headless       = False # True: for batch runs. The spectrum at location[i] is extracted from filelist[i], for every i. Every cube is
+                       # read once for all its locations, and its spectra are written into one table (<cube>+headless_suffix,
+                       # .fits or .npz, see output.py), without the single extraction of filelist[k], the blocking plots, 'open' and the CSV
+headless_suffix = '_spectra.fits'
+headless_plots = False # True: the Tb plots of the headless run are rendered by a background pool of processes, waited for at the end
+wideband_output = None # e.g. 'wideband_spectra.fits': location[k] is also extracted from all the cubes in filelist at once (in threads),
+                       # and stitched into one wide-band spectrum (see wideband.py)
 
 
 #----------------------- do not change below -------------------
 
 
-# ------read header file --------
-myhead    =  imhead(filelist[k],mode='list')
-channels  =  myhead['shape'][2] #myhead['perplanebeams']['nChannels'] #  #channels  =  SpecExtrCube.shape[2] The same 
-
-# --------- the regions for spectral subtraction ------- 
-region            =  'circle[['+location[k]+'], '+str(AperDiameter/2.)+'arcsec]'
-
-# Make circular apertures with diameter of xxx arcsec, centralised in (R.A. Dec. J2000)
-# --------- extract spectra from the defined region ----
-xval         =  imval(imagename=filelist[k], region=region)
-SpecExtrCube =  xval['data']
-SpecExtrMask =  xval['mask']
-
-
-# --------------------------------
-# get the extracted spectral cube from the selected region  
-# This is a 3-D cube, with a dimension something like (15x15x127) 
-# So, the spectral values are in box, rather than in circles or in Ellipses
-# Xval goes with a mask array to turn the box into circles or Ellipses 
-# Xval['data'] is the cube
-# Xval['mask'] is the mask cube 
-# -------------------------------
-
-#--------------------------------------------
-# apply mask to the extracted spectra 
-SpecExtrCube[np.where(SpecExtrMask==False)] = np.NaN
-# from now on, SpecExtrCube is the cube of the mask-applied extracted spectra 
-#--------------------------------------------
-
-f0       = float(myhead['crval3'])          # reference freq in Hz
-df       = float(myhead['cdelt3'])          # channel width in Hz
-i0       =       myhead['crpix3']           # reference pixel
-freqspec = ((np.arange(channels))*df + f0)  # channel array of the observing frequencies in Hz
-xdat     =  freqspec /1E9                   # Convert from Hz to GHz
-
-# -------------------------------------------
-# Obtain the average flux density (Jy/beam) within the masked region, using the mask-applied extracted spectra 
-Flux_jy_p_mean = np.nanmean(SpecExtrCube,axis=(0,1))
-# -------------------------------------------
-
-
-perbmaj =  np.arange(channels)*1.0 
-perbmin =  np.arange(channels)*1.0 
-perbpa  =  np.arange(channels)*1.0 
-
-
-
-
-if 'perplanebeams' in myhead: 
-#   print('yes') 
-    for i in range(0, channels):
-        print(i)
-        perbmaj[i] = myhead['perplanebeams']['*'+str(i)]['major']['value']
-        perbmin[i] = myhead['perplanebeams']['*'+str(i)]['minor']['value']
-        perbpa[i]  = myhead['perplanebeams']['*'+str(i)]['positionangle']['value']
-
-    bmaj = np.nanmean(perbmaj) 
-    bmin = np.nanmean(perbmin) 
-
-else: 
-    print('no')
-    bmaj = myhead['beammajor']['value']
-    bmin = myhead['beamminor']['value']
-
-
-
-
-# --- Read and assign beam values to the arrays
-#     Obtain beamsize/shape of each channel varies.
-#get pixel size in arcsec
-pixelsize    = np.abs((myhead['cdelt1']* u.rad).to(u.arcsec).value)
-# beam area calculated from a 2-D Gaussian  in arcsec^2
-MyBeamArea     = np.pi*  bmaj * bmin / ( 4 * np.log(2) )
-# How many pixels in one beam
-MyBeamPixels   = MyBeamArea / (pixelsize**2 )
-#------------------
-
-# Area of the aperture for line extraction in arcsec^2 (Area = pi * r^2 )
-MyAperArea     =  np.pi*(AperDiameter/2.)**2
-# How many pixels in one aperture
-MyAperPixels   = MyAperArea/ pixelsize**2
-#  ---------------------------------
-
-# ----- Flux density in the masked aperture -----
-Flux           = Flux_jy_p_mean * MyAperPixels / MyBeamPixels
-# -----------------------------------------------
-
-# From Jy/b to K 
-# https://science.nrao.edu/facilities/vla/proposing/TBconv
-# note that the unit of the flux density is mjy/beam. Therefore, we need another 1E3
-
-Tb            = 1.222E3 * Flux_jy_p_mean * 1E3 / (xdat**2 * bmaj * bmin) 
-
-plt.clf()
-ax1        =  plt.subplot(111) 
-ax1.set_xlabel('Frequency (GHz)', fontsize=18)
-ax1.set_ylabel('Flux density (Jy)', fontsize=16)
-ax1.plot(xdat,Flux,drawstyle='steps-mid')
-plt.savefig(filelist[k]+'test.pdf')
-os.system('open '+filelist[k]+'test.pdf')
-
-plt.clf()
-ax1        =  plt.subplot(111) 
-ax1.plot(xdat,Tb,drawstyle='steps-mid')
-ax1.set_xlabel('Frequency (GHz)', fontsize=18)
-ax1.set_ylabel('Tb (K)', fontsize=16)
-plt.savefig(filelist[k]+'Tb.pdf')
-os.system('open '+filelist[k]+'Tb.pdf')
-
-plt.clf()
-ax1        =  plt.subplot(111) 
-ax1.plot(xdat, Flux_jy_p_mean,drawstyle='steps-mid')
-ax1.set_xlabel('Frequency (GHz)', fontsize=18)
-ax1.set_ylabel('Flux density (Jy/b)', fontsize=16)
-plt.savefig(filelist[k]+'Flux_jy_p_mean.pdf')
-os.system('open '+filelist[k]+'Flux_jy_p_mean.pdf')
-
-
-
-
-import sys
-from astropy.io import ascii
-from astropy.table import Table, Column, MaskedColumn
-header="W49N western core spectrum"
-data = Table([xdat,Tb], names=['#freq(GHz)', 'Tb(K)'] )
-ascii.write(data, filelist[k]+'_Tb.dat', format='csv', comment=header)
-
+plot_pool = None
+if headless:
+    # -- the (filelist[i], location[i]) pairs, grouped by cube: all the spectra of a cube in one pass and one
+    #    binary table; the plots, if any, off the critical path
+    plots = []
+    for cube in sorted(set(filelist), key=filelist.index):
+        pairs     = [i for i, name in enumerate(filelist) if name == cube]
+        positions = [location[i] for i in pairs]
+        spectra   = extract_spectra(cube, positions, AperDiameter, tiles=spectral_tiles)[1]
+        freq_all, flux_all, tb_all = convert_spectra(cube, spectra, AperDiameter)
+        write_spectra(cube+headless_suffix, freq_all, {'FLUX_JY_BEAM': spectra, 'FLUX_JY': flux_all, 'TB_K': tb_all},
+                      names=positions, header={'CUBE': cube, 'APERTURE': AperDiameter})
+        print('spectra written to ', cube+headless_suffix)
+        plots += [(freq_all, tb_all[j], 'Tb (K)', cube+'_'+str(i)+'_Tb.pdf') for j, i in enumerate(pairs)]
+    if headless_plots:
+        plot_pool = plot_in_background(plots)
+else:
+    # -- one cube, one location: the interactive plots and the CSV. Headless runs skip all of it.
+    # ------read header file --------
+    myhead    =  imhead(filelist[k],mode='list')
+
+    # Make circular apertures with diameter of xxx arcsec, centralised in (R.A. Dec. J2000)
+    # --------- extract spectra from the defined region ----
+    # The pixels are weighted by their exact fractional overlap with the circle (method='center' is imval(region='circle[...]')),
+    # and averaged with one sparse product per block of channels. Only the aperture is read (see spectra.py).
+    # For many positions in one pass, give the whole list: extract_spectra(filelist[k], location, AperDiameter)
+    spectra  = extract_spectra(filelist[k], [location[k]], AperDiameter, tiles=spectral_tiles)[1]
+
+    # channel array of the observing frequencies in Hz, from the full spectral WCS (crpix included), cached per file
+    freqspec = frequency_axis(filelist[k])
+    xdat     =  freqspec /1E9                   # Convert from Hz to GHz
+
+    # -------------------------------------------
+    # The average flux density (Jy/beam) within the aperture, the masked pixels left out 
+    Flux_jy_p_mean = spectra[0]
+    # -------------------------------------------
+
+
+    # -- per-plane beams as arrays, parsed once per file (see beams.py)
+    beamtab         = beam_table(filelist[k], myhead)
+    print('multiple beams per channel? -- ', 'yes' if beamtab.per_plane else 'no')
+    perbmaj, perbmin, perbpa = beamtab.channel(0)
+
+
+    # --- The beam of every channel is used (the beam of wide-band cubes varies), see fluxes.py
+    #get pixel size in arcsec
+    pixelsize    = np.abs((myhead['cdelt1']* u.rad).to(u.arcsec).value)
+    # How many pixels in the beam of each channel, from the 2-D Gaussian area pi*bmaj*bmin/(4 ln2)
+    MyBeamPixels   = beam_pixels(beamtab, pixelsize)
+    #------------------
+
+    # Area of the aperture for line extraction in arcsec^2 (Area = pi * r^2 )
+    MyAperArea     =  np.pi*(AperDiameter/2.)**2
+    # How many pixels in one aperture
+    MyAperPixels   = MyAperArea/ pixelsize**2
+    #  ---------------------------------
+
+    # ----- Flux density in the masked aperture, per channel -----
+    Flux           = to_jy(Flux_jy_p_mean, MyBeamPixels, MyAperPixels)
+    # -----------------------------------------------
+
+    # From Jy/b to K, with the beam of each channel
+    # https://science.nrao.edu/facilities/vla/proposing/TBconv
+    # For all the spectra at once: freq, flux, tb = convert_spectra(filelist[k], spectra, AperDiameter)
+
+    Tb            = to_tb(Flux_jy_p_mean, freqspec, perbmaj, perbmin)
+
+    # Gaussian fits of all the spectra at once (see linefit.py): fits = fit_gaussians(xdat, spectra, ncomp=1)
+
+    plt.clf()
+    ax1        =  plt.subplot(111) 
+    ax1.set_xlabel('Frequency (GHz)', fontsize=18)
+    ax1.set_ylabel('Flux density (Jy)', fontsize=16)
+    ax1.plot(xdat,Flux,drawstyle='steps-mid')
+    plt.savefig(filelist[k]+'test.pdf')
+    os.system('open '+filelist[k]+'test.pdf')
+
+    plt.clf()
+    ax1        =  plt.subplot(111) 
+    ax1.plot(xdat,Tb,drawstyle='steps-mid')
+    ax1.set_xlabel('Frequency (GHz)', fontsize=18)
+    ax1.set_ylabel('Tb (K)', fontsize=16)
+    plt.savefig(filelist[k]+'Tb.pdf')
+    os.system('open '+filelist[k]+'Tb.pdf')
+
+    plt.clf()
+    ax1        =  plt.subplot(111) 
+    ax1.plot(xdat, Flux_jy_p_mean,drawstyle='steps-mid')
+    ax1.set_xlabel('Frequency (GHz)', fontsize=18)
+    ax1.set_ylabel('Flux density (Jy/b)', fontsize=16)
+    plt.savefig(filelist[k]+'Flux_jy_p_mean.pdf')
+    os.system('open '+filelist[k]+'Flux_jy_p_mean.pdf')
+
+    import sys
+    from astropy.io import ascii
+    from astropy.table import Table, Column, MaskedColumn
+    header="W49N western core spectrum"
+    data = Table([xdat,Tb], names=['#freq(GHz)', 'Tb(K)'] )
+    ascii.write(data, filelist[k]+'_Tb.dat', format='csv', comment=header)
+
+if wideband_output:
+    wide_freq, wide_cols = extract_wideband(filelist, location[k], AperDiameter, outfile=wideband_output, tiles=spectral_tiles)
+    print('wide-band spectrum of ', len(filelist), ' cubes written to ', wideband_output)
+
+# -- the background plots are waited for at the end, and a failed plot is an error
+if plot_pool is not None:
+    print('plots written: ', wait_plots(*plot_pool))
@@ -0,0 +1,97 @@
+# Per-channel conversion of extracted spectra (Jy/beam) to flux density (Jy) and to
+# brightness temperature (K), with the beam of every channel (see beams.py).
+#
+# Wide-band cubes have beams that change a lot across the band, so the mean beam is not used:
+#   Jy = Jy/beam x (pixels in the aperture) / (pixels in the beam of the channel)
+#   Tb = 1.222E6 x Jy/beam / (nu_GHz^2 x bmaj x bmin)           (bmaj, bmin in arcsec)
+# https://science.nrao.edu/facilities/vla/proposing/TBconv
+# The conversions are array operations over all the spectra, (nspec, nchan), at once.
+# The frequency of the channels comes from the full spectral WCS (crval, cdelt and crpix), and it
+# is remembered per file and modification time, like the beam table.
+#
+# Usage:
+#   from fluxes import convert_spectra
+#   freq, flux, tb = convert_spectra('cube.fits', spectra, diameter=0.6)
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import os
+import numpy as np
+import astropy.units as u
+from cache import files_of, stamp
+from cube  import Cube
+from beams import beam_table
+
+
+_AXES = {}
+
+
+def frequency_axis(filename):
+    """frequency (Hz) of every channel, from the full spectral WCS, remembered by file and mtime"""
+    path = os.path.realpath(filename)
+    key  = (path,) + stamp(files_of(path))
+    if key not in _AXES:
+        with Cube(filename) as cube:
+            axis = cube.spectral_axis()
+            if not axis.unit.is_equivalent(u.Hz):
+                restfrq = cube.wcs.wcs.restfrq or cube.header.get('RESTFRQ', cube.header.get('RESTFREQ'))
+                axis    = axis.to(u.Hz, equivalencies=u.doppler_radio(restfrq * u.Hz))
+            _AXES[key] = axis.to(u.Hz).value
+    return _AXES[key]
+
+
+def beam_pixels(beamtab, cdelt1, cdelt2=None, stokes=0):
+    """number of pixels in the beam of every channel, (nchan,) or (1,) for a single beam"""
+    return beamtab.pixels_per_beam(cdelt1, cdelt2)[stokes]
+
+
+def to_jy(spectra, beampix, aperpix):
+    """Jy/beam to Jy, for spectra (..., nchan) averaged over apertures of aperpix pixels"""
+    return np.asarray(spectra) * np.asarray(aperpix)[..., None] / beampix
+
+
+def to_tb(spectra, freq, bmaj, bmin):
+    """Jy/beam to brightness temperature (K), Rayleigh-Jeans
+
+    Parameters
+    ----------
+    spectra : ndarray
+        (..., nchan) in Jy/beam
+    freq : ndarray
+        (nchan,) in Hz
+    bmaj, bmin : ndarray
+        (nchan,) or scalars, FWHM in arcsec
+    """
+    return 1.222E6 * np.asarray(spectra) / ((freq / 1E9)**2 * bmaj * bmin)
+
+
+def convert_spectra(filename, spectra, diameter, stokes=0):
+    """frequency (GHz), flux density (Jy) and Tb (K) of spectra extracted from a cube
+
+    Parameters
+    ----------
+    filename : str
+        the FITS cube or CASA image of the spectra
+    spectra : ndarray
+        (nchan,) or (nspec, nchan) mean spectra in Jy/beam, e.g. from extract_spectra()
+    diameter : float or ndarray
+        the diameter (arcsec) of the circular apertures, one or one per spectrum
+    stokes : int
+        the stokes plane of the beams
+
+    Returns
+    -------
+    freq, flux, tb : ndarray
+        (nchan,) in GHz, and flux and tb with the shape of spectra
+    """
+    freq    = frequency_axis(filename)
+    beamtab = beam_table(filename)
+    with Cube(filename) as cube:
+        cdelt1, cdelt2 = cube.pixel_scale()
+    bmaj, bmin, bpa = beamtab.channel(stokes)
+    aperpix = np.pi * (np.asarray(diameter, dtype=np.float64) / 2.)**2 / (cdelt1 * cdelt2)
+    flux    = to_jy(spectra, beam_pixels(beamtab, cdelt1, cdelt2, stokes), aperpix)
+    tb      = to_tb(spectra, freq, bmaj, bmin)
+    return freq / 1E9, flux, tb
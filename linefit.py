@@ -0,0 +1,162 @@
+# Gaussian line fits of many spectra at once, e.g. the spectra of extract.py or of every pixel of a cube.
+#
+# All the spectra are fitted together by one Levenberg-Marquardt solver: the Jacobians of the
+# spectra are stacked into an (nspec, nchan, npar) array, and every iteration is a few array
+# operations and one batched solve of the (nspec, npar, npar) normal equations. Each spectrum
+# keeps its own damping and stops when it has converged, so the loop only runs over the spectra
+# still being fitted. The spectra are fitted in blocks, to bound the memory of the Jacobians.
+#
+# The model is a sum of ncomp Gaussians, amplitude x exp(-(x-centre)^2/(2 sigma^2)). Blanked (NaN)
+# channels are left out of the fit.
+#
+# Usage:
+#   from linefit import fit_gaussians
+#   fits = fit_gaussians(xdat, spectra, ncomp=2)        # spectra: (nspec, nchan), xdat: (nchan,) GHz
+#   fits['centre'][:, 0], fits['fwhm_err'][:, 0]
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import numpy as np
+
+
+FWHM = 2. * np.sqrt(2. * np.log(2.))
+
+
+def gaussians(x, params):
+    """sum of Gaussians at x (nchan,), params (..., 3*ncomp) as amplitude, centre, sigma of each component"""
+    p = np.asarray(params, dtype=np.float64)
+    p = p.reshape(p.shape[:-1] + (-1, 3))
+    return (p[..., 0, None] * np.exp(-0.5 * ((x - p[..., 1, None]) / p[..., 2, None])**2)).sum(-2)
+
+
+def _model(x, params):
+    """(model, jacobian) of params (n, 3*ncomp): (n, nchan) and (n, nchan, 3*ncomp)"""
+    n = len(params)
+    p = params.reshape(n, -1, 3)
+    a, c, s = p[..., 0, None], p[..., 1, None], p[..., 2, None]
+    u = (x - c) / s
+    e = np.exp(-0.5 * u**2)
+    jac = np.stack([e, a * e * u / s, a * e * u**2 / s], axis=-1)      # (n, ncomp, nchan, 3)
+    return (a * e).sum(1), jac.transpose(0, 2, 1, 3).reshape(n, len(x), -1)
+
+
+def initial_guess(x, spectra, ncomp=1):
+    """(nspec, 3*ncomp) first guesses: the highest peaks, one after the other, with the width
+    from the channels above half of the peak"""
+    resid = np.where(np.isfinite(spectra), spectra, 0.)
+    n     = len(resid)
+    dx    = np.abs(np.median(np.diff(x))) if len(x) > 1 else 1.
+    guess = np.empty((n, ncomp, 3))
+    for k in range(ncomp):
+        peak  = np.argmax(resid, axis=1)
+        amp   = resid[np.arange(n), peak]
+        width = (resid > amp[:, None] / 2.).sum(1) * dx / FWHM
+        guess[:, k] = np.column_stack([amp, x[peak], np.maximum(width, dx)])
+        resid = resid - gaussians(x, guess[:, k])
+    return guess.reshape(n, -1)
+
+
+def _fit_block(x, y, w, p, maxiter, tol):
+    """Levenberg-Marquardt for one block. Returns (params, chi2, normal matrix, niter, converged)"""
+    n, npar = p.shape
+    lam     = np.full(n, 1E-3)
+    niter   = np.zeros(n, dtype=np.int32)
+    done    = np.zeros(n, dtype=bool)
+    model, jac = _model(x, p)
+    chi2    = (w * (y - model)**2).sum(1)
+    for it in range(maxiter):
+        idx = np.flatnonzero(~done)
+        if len(idx) == 0:
+            break
+        J, r = jac[idx], y[idx] - model[idx]
+        JTw  = (J * w[idx, :, None]).transpose(0, 2, 1)
+        A    = JTw @ J
+        g    = (JTw @ r[..., None])[..., 0]
+        D    = np.maximum(np.diagonal(A, axis1=1, axis2=2), 1E-12 * np.abs(A).max(axis=(1, 2))[:, None] + 1E-300)
+        step = np.linalg.solve(A + lam[idx, None, None] * D[:, :, None] * np.eye(npar), g[..., None])[..., 0]
+        trial = p[idx] + step
+        trial.reshape(len(idx), -1, 3)[..., 2] = np.abs(trial.reshape(len(idx), -1, 3)[..., 2])
+        tmodel, tjac = _model(x, trial)
+        tchi2  = (w[idx] * (y[idx] - tmodel)**2).sum(1)
+        better = tchi2 < chi2[idx]
+        # -- converged: the step hardly changes chi2 (accepted), or the damping has grown without an improvement
+        small  = np.abs(chi2[idx] - tchi2) <= tol * np.maximum(chi2[idx], 1E-300)
+        stuck  = ~better & (lam[idx] > 1E10)
+        good   = idx[better]
+        p[good], model[good], jac[good], chi2[good] = trial[better], tmodel[better], tjac[better], tchi2[better]
+        lam[idx] = np.where(better, lam[idx] / 10., lam[idx] * 10.)
+        niter[idx] += 1
+        done[idx] = small | stuck
+    A = (jac * w[:, :, None]).transpose(0, 2, 1) @ jac
+    return p, chi2, A, niter, done
+
+
+def fit_gaussians(xdat, spectra, ncomp=1, guess=None, noise=None, maxiter=100, tol=1E-8, block=4096):
+    """fit ncomp Gaussian components to every spectrum
+
+    Parameters
+    ----------
+    xdat : ndarray
+        (nchan,) the spectral axis, e.g. the frequency in GHz of extract.py
+    spectra : ndarray
+        (nchan,) or (nspec, nchan). NaN channels are left out.
+    ncomp : int
+        the number of Gaussian components
+    guess : ndarray
+        (nspec, 3*ncomp) or (3*ncomp,) first guesses (amplitude, centre, sigma of each component).
+        Default: initial_guess()
+    noise : float or ndarray
+        the rms of the spectra, a scalar, (nspec,) or (nspec, nchan). Default: the errors are
+        scaled by the reduced chi2 of every fit
+    maxiter : int
+        the maximum number of iterations
+    tol : float
+        the relative change of chi2 at which a fit has converged
+    block : int
+        the number of spectra fitted together
+
+    Returns
+    -------
+    structured array (nspec,) with the fields amplitude, centre, fwhm and their errors amplitude_err,
+    centre_err, fwhm_err, each (ncomp,), and chi2, niter, converged.
+    """
+    x       = np.asarray(xdat, dtype=np.float64)
+    spectra = np.atleast_2d(np.asarray(spectra, dtype=np.float64))
+    nspec, nchan = spectra.shape
+    npar    = 3 * ncomp
+    if guess is None:
+        guess = initial_guess(x, spectra, ncomp)
+    guess   = np.broadcast_to(np.asarray(guess, dtype=np.float64), (nspec, npar))
+    sigma   = np.asarray(1. if noise is None else noise, dtype=np.float64)
+    sigma   = sigma[:, None] if sigma.ndim == 1 else sigma
+    weights = np.isfinite(spectra) / sigma**2 * np.ones((nspec, nchan))
+    values  = np.where(np.isfinite(spectra), spectra, 0.)
+
+    # -- fit in a normalised spectral axis (centred, unit channel spacing) for well-conditioned normal equations
+    x0    = x.mean()
+    scale = np.abs(np.median(np.diff(x))) if nchan > 1 else 1.
+    xs    = (x - x0) / scale
+    norm  = np.array([1., scale, scale] * ncomp)
+    shift = np.array([0., x0, 0.] * ncomp)
+
+    comp  = ('f8', (ncomp,))
+    out   = np.zeros(nspec, dtype=[('amplitude', comp), ('centre', comp), ('fwhm', comp),
+                                   ('amplitude_err', comp), ('centre_err', comp), ('fwhm_err', comp),
+                                   ('chi2', 'f8'), ('niter', 'i4'), ('converged', '?')])
+    for b0 in range(0, nspec, block):
+        sel = slice(b0, min(nspec, b0 + block))
+        w   = weights[sel]
+        p, chi2, A, niter, done = _fit_block(xs, values[sel], w, (guess[sel] - shift) / norm, maxiter, tol)
+        cov = np.linalg.pinv(A)
+        err = np.sqrt(np.abs(np.diagonal(cov, axis1=1, axis2=2)))
+        if noise is None:
+            dof = np.maximum((w > 0).sum(1) - npar, 1)
+            err = err * np.sqrt(chi2 / dof)[:, None]
+        p   = (p * norm + shift).reshape(-1, ncomp, 3)
+        err = (err * norm).reshape(-1, ncomp, 3)
+        out['amplitude'][sel],     out['centre'][sel],     out['fwhm'][sel]     = p[..., 0], p[..., 1], p[..., 2] * FWHM
+        out['amplitude_err'][sel], out['centre_err'][sel], out['fwhm_err'][sel] = err[..., 0], err[..., 1], err[..., 2] * FWHM
+        out['chi2'][sel], out['niter'][sel], out['converged'][sel] = chi2, niter, done
+    return out
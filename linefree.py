@@ -0,0 +1,159 @@
+# Automatic line-free channels of spectral windows, as the fitspw of uvcontsub (or of contsub.py).
+#
+# The input of a spectral window is a dirty cube, reduced to its per-channel maximum and minimum
+# over the field (emission or absorption anywhere marks a channel), or a set of extracted spectra
+# (nspec, nchan), reduced to the mean (faint lines common to the spectra), maximum and minimum of
+# the spectra in units of their own rms. These few spectra are sigma clipped together along the
+# spectral axis: in every iteration a polynomial baseline is fitted to the channels kept so far
+# (one batched solve of the normal equations), and channels further than nsigma x rms (MAD) from
+# it are dropped, until no channel changes. Lines span several channels, so only runs of at least
+# minline dropped channels are lines (single noise spikes are not), and a channel is line-free if
+# it is in no line of any of them. The lines are then padded by a few channels, and line-free runs
+# that are too short, or at the edges of the band, are dropped.
+#
+# Usage:
+#   from linefree import find_fitspw
+#   fitspw = find_fitspw(['spw25.cube.fits', 'spw27.cube.fits'], spws=[0, 1])   # '0:12~480;610~1900,1:...'
+#   uvcontsub(vis='spw3_split.ms', want_cont=True, fitspw=fitspw)
+# or, from the shell (the spws are numbered in the order of the files):
+#   python linefree.py spw25.cube.fits spw27.cube.fits
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import sys
+import numpy as np
+from noise import mad_std
+from cube  import Cube
+
+
+def cube_extremes(filename, block=64):
+    """(2, nchan) per-channel maximum and minimum over the field of a cube, read in blocks of channels"""
+    with Cube(filename) as cube:
+        nchan = cube.shape[0]
+        out   = np.full((2, nchan), np.nan)
+        for c0 in range(0, nchan, block):
+            data = cube[c0:c0+block].reshape(min(block, nchan - c0), -1)
+            good = np.isfinite(data).any(1)
+            if good.any():
+                out[0, c0:c0+block][good] = np.nanmax(data[good], axis=1)
+                out[1, c0:c0+block][good] = np.nanmin(data[good], axis=1)
+    return out
+
+
+def summary_spectra(spectra):
+    """(3, nchan) mean x sqrt(n), maximum and minimum over many spectra (nspec, nchan) of
+    (spectrum - median) / rms. One or two spectra are returned as they are."""
+    spectra = np.atleast_2d(np.asarray(spectra, dtype=np.float64))
+    if len(spectra) <= 2:
+        return spectra
+    z = (spectra - np.nanmedian(spectra, axis=1)[:, None]) / mad_std(spectra, axis=1)[:, None]
+    n = np.isfinite(z).sum(0)
+    return np.stack([np.nanmean(z, axis=0) * np.sqrt(n), np.nanmax(z, axis=0), np.nanmin(z, axis=0)])
+
+
+def clip_spectra(spectra, nsigma=3., order=1, maxiter=20):
+    """iterative sigma clipping of every spectrum around a polynomial baseline
+
+    Parameters
+    ----------
+    spectra : ndarray
+        (nspec, nchan) or (nchan,)
+    nsigma : float
+        the clipping level, in units of the MAD rms of the kept channels
+    order : int
+        the order of the baseline polynomial (0: the median level)
+    maxiter : int
+        the maximum number of iterations
+
+    Returns
+    -------
+    (nspec, nchan) boolean, the kept (line-free) channels of every spectrum
+    """
+    spectra = np.atleast_2d(np.asarray(spectra, dtype=np.float64))
+    nspec, nchan = spectra.shape
+    V    = np.vander(np.linspace(-1., 1., nchan), order + 1, increasing=True)
+    keep = np.isfinite(spectra)
+    data = np.where(keep, spectra, 0.)
+    for it in range(maxiter):
+        w    = keep.astype(np.float64)
+        A    = np.einsum('cp,nc,cq->npq', V, w, V)
+        b    = np.einsum('cp,nc->np', V, w * data)
+        base = (np.linalg.pinv(A) @ b[..., None])[..., 0] @ V.T
+        res  = np.where(np.isfinite(spectra), data - base, np.nan)
+        rms  = mad_std(np.where(keep, res, np.nan), axis=1)
+        new  = np.isfinite(res) & (np.abs(res) <= nsigma * rms[:, None])
+        if np.array_equal(new, keep):
+            break
+        keep = new
+    return keep
+
+
+def line_runs(dropped, minline=2):
+    """(nspec, nchan) boolean, the dropped channels in runs of at least minline channels"""
+    dropped = np.atleast_2d(dropped)
+    if minline <= 1:
+        return dropped
+    nspec, nchan = dropped.shape
+    count = np.concatenate([np.zeros((nspec, 1), dtype=int), np.cumsum(dropped, axis=1)], axis=1)
+    full  = (count[:, minline:] - count[:, :-minline]) == minline          # runs starting at every channel
+    start = np.concatenate([np.zeros((nspec, 1), dtype=int), np.cumsum(full, axis=1)], axis=1)
+    lo    = np.clip(np.arange(nchan) - minline + 1, 0, full.shape[1])
+    hi    = np.clip(np.arange(nchan) + 1, 0, full.shape[1])
+    return (start[:, hi] - start[:, lo]) > 0
+
+
+def clean_mask(linefree, pad=2, minwidth=5, edge=0):
+    """pad the line channels by pad channels, drop the edge channels at both ends of the band
+    and the line-free runs shorter than minwidth channels"""
+    free = np.asarray(linefree, dtype=bool).copy()
+    if pad > 0:
+        lines = np.convolve(~free, np.ones(2 * pad + 1, dtype=bool), mode='same')
+        free &= ~lines.astype(bool)
+    if edge > 0:
+        free[:edge], free[-edge:] = False, False
+    for start, stop in channel_ranges(free):
+        if stop - start + 1 < minwidth:
+            free[start:stop+1] = False
+    return free
+
+
+def channel_ranges(linefree):
+    """[(first, last), ...] of the runs of line-free channels"""
+    edges = np.diff(np.concatenate([[0], np.asarray(linefree, dtype=np.int8), [0]]))
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1))
+
+
+def fitspw_string(masks, spws=None):
+    """fitspw of uvcontsub, e.g. '0:500~1000;3300~3700,1:20~900', from the line-free channels of every spw"""
+    spws  = range(len(masks)) if spws is None else spws
+    parts = [str(spw)+':'+';'.join(str(c0)+'~'+str(c1) for c0, c1 in channel_ranges(mask))
+             for spw, mask in zip(spws, masks) if np.any(mask)]
+    return ','.join(parts)
+
+
+def find_linefree(source, nsigma=3., order=1, minline=2, pad=2, minwidth=5, edge=0, maxiter=20):
+    """line-free channels (boolean, (nchan,)) of one spectral window
+
+    Parameters
+    ----------
+    source : str or ndarray
+        a dirty cube (FITS or CASA image), or the spectra (nspec, nchan) of the window
+    nsigma, order, maxiter : see clip_spectra()
+    minline : int
+        the fewest adjacent dropped channels taken as a line, see line_runs()
+    pad, minwidth, edge : see clean_mask()
+    """
+    spectra = cube_extremes(source) if isinstance(source, str) else summary_spectra(source)
+    lines   = line_runs(~clip_spectra(spectra, nsigma, order, maxiter), minline)
+    return clean_mask(~lines.any(0), pad, minwidth, edge)
+
+
+def find_fitspw(sources, spws=None, **kwargs):
+    """fitspw string of many spectral windows, one source (cube or spectra) per spw, see find_linefree()"""
+    return fitspw_string([find_linefree(source, **kwargs) for source in sources], spws)
+
+
+if __name__ == '__main__':
+    print(find_fitspw(sys.argv[1:]))
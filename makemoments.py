@@ -4,6 +4,12 @@
 # makemoms(filename,channel_range,Npix)
 # Here channel_range is the channel range to make moment maps
 # Npix is the number of connected pixels, below which the structure will be flagged 
+# memory_budget (optional, bytes) labels the cube slab by slab, for cubes larger than RAM 
+# workers (optional) is the number of processes used to label the channel planes 
+# cache (optional, default False) reuses the cube without dwarfs of an earlier run, see cache.py 
+# backup_policy (optional) 'copy' (default, skipped if an identical backup exists), 'link' or 'none', see backup.py 
+# export (optional, default False) writes the cube without dwarfs into file_wo_dwarfs.fits (always with cache or memory_budget) 
+# dwarfs.py, moments.py, smoothing.py, noise.py, cache.py, backup.py and beams.py should be in the same directory, which is in sys.path 
 # Example:: 
 # execfile('makemoments.py') 
 # makemoms('cube_CO65_contsub_selfcal_image.fits','485~510',20)
@@ -22,59 +28,41 @@ from matplotlib            import pyplot as plt
 from scipy                 import ndimage
 from matplotlib            import pyplot as plt
 from scipy                 import ndimage
-from astropy.utils.console import ProgressBar
-
+from dwarfs                import flagdwarfs, flagdwarfs_file, fits_order
+from moments               import moments, moments_fits, velocity_axis, write_moments
+from smoothing             import smooth_and_mask
+from noise                 import estimate_noise, sample_channels, beam_voxels
+from cache                 import cache_key, lookup, read_meta, store
+from backup                import backup
+from beams                 import beam_table
+
+
+
+def cube_header(fitsfilename, imgname):
+    # -- FITS header of the input cube (of its float pixels), without exporting the cube: read from
+    #    the FITS input, or from the image tool (as cube.CasaReader)
+    if fitsfilename[-5:] == '.fits':
+        header = fits.getheader(fitsfilename)
+        for key in ('BSCALE', 'BZERO', 'BLANK'):
+            header.remove(key, ignore_missing=True)
+        return header
+    ia.open(imgname)
+    header = fits.Header(ia.fitsheader())
+    ia.close()
+    return header
 
 
 
-#--------- flagwarfs is to remove the small patches in the moment maps. Normally those patches smaller than the beam size would not be beloved (on high fidelity)
-def flagdwarfs(filename,Npix):
+def makemoms(fitsfilename,chans, Npix='none', memory_budget=None, workers=1, cache=False, backup_policy='copy', export=False): 
 
-    filename = filename 
-    cube     = fits.open(filename)
-    header   = cube[0].header
-    if len(cube[0].data.shape) ==4:
-        sig = cube[0].data[0,:]
-        mask= cube[0].data [0,:]> 0 # * noise[0].data
-    else:
-        sig = cube[0].data
-        mask= cube[0].data > 0 # * noise[0].data
-
-   
-    # This is to find connected components in an array
-    # https://scipy-lectures.org/intro/scipy/auto_examples/plot_connect_measurements.html
-    # by default, it is 2-D array. However, I found this to adopt to 3-D cubes
-    # https://stackoverflow.com/questions/36917944/label-3d-numpy-array-with-scipy-ndimage-label
-    
-    str_3D = np.array([[[0, 0, 0],
-                        [0, 0, 0],
-                        [0, 0, 0]],
-                      [[0, 1, 0],
-                        [1, 1, 1],
-                        [0, 1, 0]],
-                      [[0, 0, 0],
-                        [0, 0, 0],
-                        [0, 0, 0]]],
-                      dtype='uint8')
-    
-    labels, nb = ndimage.label(mask,structure=str_3D)
-    print("=========================================================================")
-    print("|Eliminating 3-D structures with less than Npix connected pixels (in 3-D).|")
-    print("=========================================================================")
-    with ProgressBar(nb) as bar:
-        for i in range(nb):
-            bar.update()
-            sl = ndimage.find_objects(labels==i)
-        #   print(i)
-            if sig[sl[0]].size < Npix:
-                sig[sl[0]] = np.NaN
-    
-    hdu = fits.PrimaryHDU(header=header,data=sig)
-    hdu.writeto('flagged.fits',overwrite=True)
+    # -- skipped when an identical backup exists, see backup.py
+    backup(fitsfilename, policy=backup_policy)
 
-def makemoms(fitsfilename,chans, Npix='none'): 
-
-    os.system("cp -r "+fitsfilename+" "+fitsfilename+".backup")
+    # -- the cube without dwarfs only depends on the input and these parameters, not on chans (see cache.py)
+    entry = None
+    if cache:
+        key   = cache_key(fitsfilename, factor=1.5, nsigma=3, noise='mad', Npix=Npix, ondisk=memory_budget is not None)
+        entry = lookup(key)
 
 
     if fitsfilename[-4:] == '.fits':
@@ -84,7 +72,8 @@ def makemoms(fitsfilename,chans, Npix='none'):
         outputname2 = fitsfilename[0:-5]+"_mom2.fits"
         # -- import fits file without primary beam (PB) correction 
         # This is because the noise and (signal) is uniformly treated in this data. 
-        importfits(imagename=imgname,fitsimage=fitsfilename,overwrite=True)
+        if entry is None:
+            importfits(imagename=imgname,fitsimage=fitsfilename,overwrite=True)
     else: 
         imgname     = fitsfilename
         outputname0 = fitsfilename+"_mom0.fits"
@@ -92,6 +81,11 @@ def makemoms(fitsfilename,chans, Npix='none'):
         outputname2 = fitsfilename+"_mom2.fits"
     print("Image name: ",imgname)
 
+    if entry is not None:
+        print("Cached cube without dwarfs: ", entry, read_meta(entry))
+        moments_fits(os.path.join(entry, 'file_wo_dwarfs.fits'), chans, outputnames=[outputname0,outputname1,outputname2], excludepix=[-100.,0.0])
+        return
+
 
     # -- names of the images 
     sm_img    = 'sm.image'
@@ -99,30 +93,22 @@ def makemoms(fitsfilename,chans, Npix='none'):
 
     # -- read header 
     myhead    = imhead(imgname,mode  = 'list')
-    channels  =  myhead['shape'][2] #myhead['perplanebeams']['nChannels'] #  #channels  =  SpecExtrCube.shape[2] The same
-
-    perbmaj =  np.arange(channels)*1.0
-    perbmin =  np.arange(channels)*1.0
-    perbpa  =  np.arange(channels)*1.0
-    
-    if 'perplanebeams' in myhead:
-        print('perplanebeams')
-        for i in range(0, channels):
-            print(i)
-            perbmaj[i] = myhead['perplanebeams']['*'+str(i)]['major']['value']
-            perbmin[i] = myhead['perplanebeams']['*'+str(i)]['minor']['value']
-            perbpa[i]  = myhead['perplanebeams']['*'+str(i)]['positionangle']['value']
-    
-        bmaj = np.nanmean(perbmaj)
-        bmin = np.nanmean(perbmin)
-        vaxis = 3
-    
+    # -- per-plane beams as arrays (see beams.py)
+    beamtab   = beam_table(imgname, myhead)
+    bmaj, bmin, bpa = beamtab.mean()
+    if beamtab.per_plane:
+        print('perplanebeams: ', beamtab.nstokes, 'x', beamtab.nchan)
+        beams = beamtab.channel(0)
     else:
         print('Uniform beam')
-        bmaj = myhead['beammajor']['value']
-        bmin = myhead['beamminor']['value']
-        vaxis = 2
+        beams = (bmaj, bmin, bpa)
 
+    # -- the spectral axis from the coordinate system (as cube.CasaReader), whatever the beams and the order of the axes
+    ia.open(imgname)
+    csys  = ia.coordsys()
+    vaxis = int(csys.findcoordinate('spectral')['pixel'][0])
+    csys.done()
+    ia.close()
     print("vaxis=", vaxis)
  
 
@@ -130,25 +116,58 @@ def makemoms(fitsfilename,chans, Npix='none'):
     out_Beam = str(1.5 * max(np.mean(bmaj),np.mean(bmin)))+"arcsec"
     print("Output beam size: ", out_Beam )
 
-    # -- convolve to 1.5 x angular resolution 
-    imsmooth(imagename=imgname, outfile=sm_img, kernel='gauss', major=out_Beam, minor=out_Beam, pa="0deg",targetres=True,overwrite=True)
-
-    # -- convolve to 2 x channel width,  2.25 x 2 ~ 4.5 x smoothing 
-    specsmooth(imagename=sm_img, outfile=sm_sm_img,  axis=vaxis, dmethod="",width=2,function='hanning',overwrite=True)
-
-    # -- define cutoff to be 3.5 sigma from the convolved datacube  
-    #  This can be tuned, for optimising the final moment-0 map. 
-    up_cutoff = 3 * imstat(sm_sm_img)['rms'][0]
+    if memory_budget is None:
+        # -- smooth and mask in memory (see smoothing.py): convolve to out_Beam, Hanning smoothing along the channels,
+        #    and cutoff at 3 x noise (MAD) of the smoothed cube. The mask is applied to the original datacube.
+        ia.open(imgname)
+        pixels = ia.getchunk()
+        pixels[~ia.getchunk(getmask=True)] = np.nan
+        ia.close()
+        cube  = fits_order(pixels, vaxis)
+        sig   = cube[0] if cube.ndim == 4 else cube
+        cdelt = (myhead['cdelt1']*u.rad.to(u.arcsec), myhead['cdelt2']*u.rad.to(u.arcsec))
+        if len(np.atleast_1d(beams[0])) != sig.shape[0]:
+            beams = (bmaj, bmin, np.nanmean(beams[2]))
+        # -- with per-plane beams, every channel is convolved with its own kernel to the common beam
+        sm_sm, up_cutoff, mask = smooth_and_mask(sig, beams, cdelt, factor=1.5, nsigma=3)
+        sig[~mask] = np.nan
+        del sm_sm, mask
+        print("Cutoff: ", up_cutoff)
 
-    # --  make mask using up_cutoff on the smoothed, non-PB corrected datacube,  and apply the mask to the original, unmasked, PB corrected datacube.
-    os.system("rm -rf mask*")
-    ia.open(imgname)
-    ia.calcmask(mask=str(sm_sm_img)+" > "+str(up_cutoff),name='masked_img')
-    ia.close()
+    else:
+        # -- convolve to 1.5 x angular resolution 
+        imsmooth(imagename=imgname, outfile=sm_img, kernel='gauss', major=out_Beam, minor=out_Beam, pa="0deg",targetres=True,overwrite=True)
+
+        # -- convolve to 2 x channel width,  2.25 x 2 ~ 4.5 x smoothing 
+        specsmooth(imagename=sm_img, outfile=sm_sm_img,  axis=vaxis, dmethod="",width=2,function='hanning',overwrite=True)
+
+        # -- define cutoff to be 3 sigma from the convolved datacube. The noise is the MAD of a random
+        #  sample of voxels in a few random planes (see noise.py), instead of the rms of the full cube.
+        #  This can be tuned, for optimising the final moment-0 map. 
+        ia.open(sm_sm_img)
+        planes = []
+        for c in sample_channels(myhead['shape'][vaxis]):
+            blc, trc = [0]*len(myhead['shape']), [-1]*len(myhead['shape'])
+            blc[vaxis] = trc[vaxis] = int(c)
+            plane = ia.getchunk(blc=blc, trc=trc, dropdeg=True).astype(np.float64)
+            plane[~ia.getchunk(blc=blc, trc=trc, dropdeg=True, getmask=True)] = np.nan
+            planes.append(plane)
+        ia.close()
+        # -- the planes are smoothed to out_Beam: ncorr pixels per independent one, for the interval
+        size  = 1.5 * max(np.mean(bmaj), np.mean(bmin))
+        ncorr = beam_voxels((size, size), (myhead['cdelt1']*u.rad.to(u.arcsec), myhead['cdelt2']*u.rad.to(u.arcsec)))
+        sigma, interval = estimate_noise(np.array(planes), ncorr=ncorr)
+        print("Noise (mad): ", sigma, ", 95% interval: ", interval)
+        up_cutoff = 3 * sigma
+
+        # --  make mask using up_cutoff on the smoothed, non-PB corrected datacube,  and apply the mask to the original, unmasked, PB corrected datacube.
+        os.system("rm -rf mask*")
+        ia.open(imgname)
+        ia.calcmask(mask=str(sm_sm_img)+" > "+str(up_cutoff),name='masked_img')
+        ia.close()
 
     
-    os.system('rm -rf file_w_dwarfs.fits flagged.fits img_wo_dwarfs.im') 
-    exportfits(imagename=imgname,fitsimage='file_w_dwarfs.fits')
+    os.system('rm -rf file_w_dwarfs.fits flagged.fits file_wo_dwarfs.fits') 
     if Npix == 'none':
         BeamArea = bmaj*bmin
         if myhead['cunit1'] == 'rad':
@@ -159,23 +178,28 @@ def makemoms(fitsfilename,chans, Npix='none'):
         NpixBeam = Npix
         print("Input Pixels ", Npix)
     
-    flagdwarfs('file_w_dwarfs.fits', NpixBeam)
-    importfits(fitsimage='flagged.fits',imagename='img_wo_dwarfs.im')
-    imgname = 'img_wo_dwarfs.im'
-    exportfits(imagename=imgname,fitsimage='file_wo_dwarfs.fits',overwrite=True)
-
-
-    # -- Make moment0 image, using the masked, original resolution, PB-corrected datacube. 
-    os.system("rm -rf image.mom0 mom0.fits")
-    immoments( imagename=imgname,moments=0,chans=chans,outfile='image.mom0') 
-    exportfits(imagename='image.mom0',fitsimage=outputname0,overwrite=True)
-
-    os.system("rm -rf image.mom1 mom1.fits")
-    immoments( imagename=imgname,moments=1,chans=chans,outfile='image.mom1',excludepix=[-100.,0.0]) 
-    exportfits(imagename='image.mom1',fitsimage=outputname1,overwrite=True)
-
-    os.system("rm -rf image.mom2 mom2.fits")
-    immoments( imagename=imgname,moments=2,chans=chans,outfile='image.mom2',excludepix=[-100.,0.0]) 
-    exportfits(imagename='image.mom2',fitsimage=outputname2,overwrite=True)
+    if memory_budget is not None:
+        # -- out of core: FITS round trip, the cube is labelled one spectral slab at a time, and the moments are streamed from flagged.fits
+        exportfits(imagename=imgname,fitsimage='file_w_dwarfs.fits')
+        flagdwarfs_file('file_w_dwarfs.fits', NpixBeam, outfile='flagged.fits', memory_budget=memory_budget)
+        os.rename('flagged.fits', 'file_wo_dwarfs.fits')
+    else:
+        # -- in memory: the dwarfs are flagged in place, in the masked cube from above, and the moments are made from it directly.
+        #    The cube is written to disk only when asked, or for the cache.
+        flagdwarfs(cube, NpixBeam, workers=workers)
+        header = cube_header(fitsfilename, imgname)
+        if export or cache:
+            fits.writeto('file_wo_dwarfs.fits', cube, header, overwrite=True)
+    if cache:
+        store(key, ['file_wo_dwarfs.fits'], meta={'cutoff': float(up_cutoff), 'Npix': float(NpixBeam)})
+
+
+    # -- Make moment 0, 1 and 2 images in one pass, using the masked, original resolution, PB-corrected datacube (see moments.py).
+    # -- excludepix applies to moments 1 and 2, as immoments(excludepix=[-100.,0.0]) did.
+    outputnames = [outputname0,outputname1,outputname2]
+    if memory_budget is not None:
+        moments_fits('file_wo_dwarfs.fits', chans, outputnames=outputnames, excludepix=[-100.,0.0])
+    else:
+        mom0, mom1, mom2 = moments(sig, velocity_axis(header), chans, excludepix=[-100.,0.0])
+        write_moments(mom0, mom1, mom2, header, outputnames)
     
-      
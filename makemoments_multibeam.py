@@ -4,6 +4,7 @@
 # makemoms(filename,channel_range,Npix)
 # Here channel_range is the channel range to make moment maps
 # Npix is the number of connected pixels, below which the structure will be flagged 
+# export (optional, default False) writes the cube without dwarfs into file_wo_dwarfs.fits (always with cache or memory_budget) 
 # Example:: 
 # execfile('makemoments.py') 
 # makemoms('cube_CO65_contsub_selfcal_image.fits','485~510',10)
@@ -11,65 +12,21 @@
 import os
 import glob
 import numpy as np
+import astropy.units as u
 from astropy.io import fits
 from matplotlib import pyplot as plt
 from scipy		import ndimage
 from matplotlib import pyplot as plt
 from scipy		import ndimage
-from astropy.utils.console import ProgressBar
+from dwarfs		import flagdwarfs, flagdwarfs_file, fits_order
+from moments	import moments, moments_fits, velocity_axis, write_moments
+from smoothing	import smooth_and_mask
+from noise		import estimate_noise, sample_channels, beam_voxels
+from cache		import cache_key, lookup, read_meta, store
+from beams		import beam_table
 
 
-def flagdwarfs(filename,Npix):
-
-	filename = filename 
-	cube	 = fits.open(filename)
-	header	 = cube[0].header
-	if len(cube[0].data.shape) ==4:
-		sig = cube[0].data[0,:]
-		mask= cube[0].data [0,:]> 0 # * noise[0].data
-	else:
-		sig = cube[0].data
-		mask= cube[0].data > 0 # * noise[0].data
-
-   
-	# This is to find connected components in an array
-	# https://scipy-lectures.org/intro/scipy/auto_examples/plot_connect_measurements.html
-	# by default, it is 2-D array. However, I found this to adopt to 3-D cubes
-	# https://stackoverflow.com/questions/36917944/label-3d-numpy-array-with-scipy-ndimage-label
-	
-	str_3D = np.array([[[0, 0, 0],
-						[0, 0, 0],
-						[0, 0, 0]],
-					  [[0, 1, 0],
-						[1, 1, 1],
-						[0, 1, 0]],
-					  [[0, 0, 0],
-						[0, 0, 0],
-						[0, 0, 0]]],
-					  dtype='uint8')
-	
-	labels, nb = ndimage.label(mask,structure=str_3D)
-	print("=========================================================================")
-	print("|Eliminating 3-D structures with less than Npix connected pixels (in 3-D).|")
-	print("=========================================================================")
-	with ProgressBar(nb) as bar:
-		for i in range(nb):
-			# python 2 - xrange 
-			# python 3 - range 
-			bar.update()
-			sl = ndimage.find_objects(labels==i)
-		#	print(i)
-			if sig[sl[0]].size < Npix:
-				sig[sl[0]] = np.NaN
-	
-	hdu = fits.PrimaryHDU(header=header,data=sig)
-	hdu.writeto('flagged.fits',overwrite=True)
-
-
-
-
-
-def makemoms(fitsfilename,chans,Npix): 
+def makemoms(fitsfilename,chans,Npix,memory_budget=None, workers=1, cache=False, export=False): 
 	imgname		= fitsfilename[0:-4]+"image"
 	outputname	= fitsfilename[0:-5]+"_mom0.fits"
 	outputname1 = fitsfilename[0:-5]+"_mom1.fits"
@@ -77,6 +34,16 @@ def makemoms(fitsfilename,chans,Npix):
 	# -- import fits file without primary beam (PB) correction 
 
 	#	 This is because the noise+signal is uniform in this data. 
+
+	# -- the cube without dwarfs only depends on the input and these parameters, not on chans (see cache.py)
+	if cache:
+		key   = cache_key(fitsfilename, factor=1.5, nsigma=3, noise='mad', Npix=Npix, ondisk=memory_budget is not None)
+		entry = lookup(key)
+		if entry is not None:
+			print("Cached cube without dwarfs: ", entry, read_meta(entry))
+			moments_fits(os.path.join(entry, 'file_wo_dwarfs.fits'), chans, outputnames=['mom0.fits','mom1.fits','mom2.fits'], excludepix=[-100.,0.0])
+			return
+
 	importfits(imagename=imgname,fitsimage=fitsfilename,overwrite=True)
 
 	# -- names of the images 
@@ -87,36 +54,22 @@ def makemoms(fitsfilename,chans,Npix):
 	myhead	  = imhead(imgname,mode  = 'list')
 
 
-	if	len(myhead['shape']) == 4:
-		if	myhead['shape'][2] <= 2:
-			axis	  = 3
-			channels  =  myhead['shape'][3] 
-		else:
-			channels  =  myhead['shape'][2] 
-			axis	  = 2
-	elif len(myhead['shape']) == 3:
-		channels  =  myhead['shape'][2] 
-		axis		  = 2
-
-	perbmaj =  np.arange(channels)*1.0
-	perbmin =  np.arange(channels)*1.0
-	perbpa	=  np.arange(channels)*1.0
-	
-	if 'perplanebeams' in myhead:
+	# -- the spectral axis from the coordinate system (as cube.CasaReader), whatever the order of the axes
+	ia.open(imgname)
+	csys = ia.coordsys()
+	axis = int(csys.findcoordinate('spectral')['pixel'][0])
+	csys.done()
+	ia.close()
+
+	# -- per-plane beams as arrays (see beams.py)
+	beamtab = beam_table(imgname, myhead)
+	bmaj, bmin, bpa = beamtab.mean()
+	if beamtab.per_plane:
 		print('multiple beams per channel? -- yes')
-		for i in range(0, channels):
-			print(i)
-			perbmaj[i] = myhead['perplanebeams']['*'+str(i)]['major']['value']
-			perbmin[i] = myhead['perplanebeams']['*'+str(i)]['minor']['value']
-			perbpa[i]  = myhead['perplanebeams']['*'+str(i)]['positionangle']['value']
-	
-		bmaj = np.nanmean(perbmaj)
-		bmin = np.nanmean(perbmin)
-	
+		beams = beamtab.channel(0)
 	else:
 		print('multiple beams per channel? -- no')
-		bmaj = myhead['beammajor']['value']
-		bmin = myhead['beamminor']['value']
+		beams = (bmaj, bmin, bpa)
 	
 #	 myhead    = imhead(imgname,mode  = 'list')
 #	 bmaj	   = myhead['beammajor']['value']
@@ -125,44 +78,78 @@ def makemoms(fitsfilename,chans,Npix):
 	# -- define the aimed angular resolution after convolution. It is 1.5 x of the mean original value. 1.5^2 ~ 2.25 x area   
 	out_Beam = str(1.5 * max(np.mean(bmaj),np.mean(bmin)))+"arcsec"
 
-	# -- convolve to 1.5 x angular resolution 
-	imsmooth(imagename=imgname, outfile=sm_img, kernel='gauss', major=out_Beam, minor=out_Beam, pa="0deg",targetres=True,overwrite=True)
-
-	# -- convolve to 2 x channel width,  2.25 x 2 ~ 4.5 x smoothing 
-	specsmooth(imagename=sm_img, outfile=sm_sm_img,  axis=2, dmethod="",width=2,function='hanning',overwrite=True)
+	if memory_budget is None:
+		# -- smooth and mask in memory (see smoothing.py): convolve to out_Beam, Hanning smoothing along the channels,
+		#    and cutoff at 3 x noise (MAD) of the smoothed cube. The mask is applied to the original datacube.
+		ia.open(imgname)
+		pixels = ia.getchunk()
+		pixels[~ia.getchunk(getmask=True)] = np.nan
+		ia.close()
+		cube  = fits_order(pixels, axis)
+		sig   = cube[0] if cube.ndim == 4 else cube
+		cdelt = (myhead['cdelt1']*u.rad.to(u.arcsec), myhead['cdelt2']*u.rad.to(u.arcsec))
+		if len(np.atleast_1d(beams[0])) != sig.shape[0]:
+			beams = (bmaj, bmin, np.nanmean(beams[2]))
+		# -- with per-plane beams, every channel is convolved with its own kernel to the common beam
+		sm_sm, up_cutoff, mask = smooth_and_mask(sig, beams, cdelt, factor=1.5, nsigma=3)
+		sig[~mask] = np.nan
+		del sm_sm, mask
 
-	# -- define cutoff to be 3.5 sigma from the convolved datacube	
-	#  This can be tuned, for optimising the final moment-0 map. 
-	up_cutoff = 3 * imstat(sm_sm_img)['rms'][0]
-
-	# --  make mask using up_cutoff on the smoothed, non-PB corrected datacube,  and apply the mask to the original, unmasked, PB corrected datacube.
-	os.system("rm -rf mask*")
-	ia.open(imgname)
-	ia.calcmask(mask=str(sm_sm_img)+" > "+str(up_cutoff),name='masked_img')
-	ia.close()
+	else:
+		# -- convolve to 1.5 x angular resolution 
+		imsmooth(imagename=imgname, outfile=sm_img, kernel='gauss', major=out_Beam, minor=out_Beam, pa="0deg",targetres=True,overwrite=True)
+
+		# -- convolve to 2 x channel width,  2.25 x 2 ~ 4.5 x smoothing 
+		specsmooth(imagename=sm_img, outfile=sm_sm_img,  axis=axis, dmethod="",width=2,function='hanning',overwrite=True)
+
+		# -- define cutoff to be 3 sigma from the convolved datacube. The noise is the MAD of a random
+		#  sample of voxels in a few random planes (see noise.py), instead of the rms of the full cube.
+		#  This can be tuned, for optimising the final moment-0 map. 
+		ia.open(sm_sm_img)
+		planes = []
+		for c in sample_channels(myhead['shape'][axis]):
+			blc, trc = [0]*len(myhead['shape']), [-1]*len(myhead['shape'])
+			blc[axis] = trc[axis] = int(c)
+			plane = ia.getchunk(blc=blc, trc=trc, dropdeg=True).astype(np.float64)
+			plane[~ia.getchunk(blc=blc, trc=trc, dropdeg=True, getmask=True)] = np.nan
+			planes.append(plane)
+		ia.close()
+		# -- the planes are smoothed to out_Beam: ncorr pixels per independent one, for the interval
+		size  = 1.5 * max(np.mean(bmaj), np.mean(bmin))
+		ncorr = beam_voxels((size, size), (myhead['cdelt1']*u.rad.to(u.arcsec), myhead['cdelt2']*u.rad.to(u.arcsec)))
+		sigma, interval = estimate_noise(np.array(planes), ncorr=ncorr)
+		print("Noise (mad): ", sigma, ", 95% interval: ", interval)
+		up_cutoff = 3 * sigma
+
+		# --  make mask using up_cutoff on the smoothed, non-PB corrected datacube,  and apply the mask to the original, unmasked, PB corrected datacube.
+		os.system("rm -rf mask*")
+		ia.open(imgname)
+		ia.calcmask(mask=str(sm_sm_img)+" > "+str(up_cutoff),name='masked_img')
+		ia.close()
 	
-	os.system('rm -rf file_w_dwarfs.fits flagged.fits img_wo_dwarfs.im') 
-	exportfits(imagename=imgname,fitsimage='file_w_dwarfs.fits')
-	flagdwarfs('file_w_dwarfs.fits',Npix)
-	importfits(fitsimage='flagged.fits',imagename='img_wo_dwarfs.im')
-	imgname = 'img_wo_dwarfs.im'
-	exportfits(imagename=imgname,fitsimage='file_wo_dwarfs.fits',overwrite=True)
-
-
-	# -- Make moment0 image, using the masked, original resolution, PB-corrected datacube. 
-	os.system("rm -rf image.mom0 mom0.fits")
-	outputname ='mom0.fits'
-	immoments( imagename=imgname,moments=0,chans=chans,outfile='image.mom0') 
-	exportfits(imagename='image.mom0',fitsimage=outputname,overwrite=True)
-
-	os.system("rm -rf image.mom1 mom1.fits")
-	outputname ='mom1.fits'
-	immoments( imagename=imgname,moments=1,chans=chans,outfile='image.mom1',excludepix=[-100.,0.0]) 
-	exportfits(imagename='image.mom1',fitsimage=outputname,overwrite=True)
-
-	os.system("rm -rf image.mom2 mom2.fits")
-	outputname ='mom2.fits'
-	immoments( imagename=imgname,moments=2,chans=chans,outfile='image.mom2',excludepix=[-100.,0.0]) 
-	exportfits(imagename='image.mom2',fitsimage=outputname,overwrite=True)
+	os.system('rm -rf file_w_dwarfs.fits flagged.fits file_wo_dwarfs.fits') 
+	if memory_budget is not None:
+		# -- out of core: FITS round trip, the cube is labelled one spectral slab at a time, and the moments are streamed from flagged.fits
+		exportfits(imagename=imgname,fitsimage='file_w_dwarfs.fits')
+		flagdwarfs_file('file_w_dwarfs.fits', Npix, outfile='flagged.fits', memory_budget=memory_budget)
+		os.rename('flagged.fits', 'file_wo_dwarfs.fits')
+	else:
+		# -- in memory: the dwarfs are flagged in place, in the masked cube from above, and the moments are made from it directly.
+		#	 The cube is written to disk only when asked, or for the cache.
+		flagdwarfs(cube, Npix, workers=workers)
+		header = fits.getheader(fitsfilename)
+		for name in ('BSCALE', 'BZERO', 'BLANK'):
+			header.remove(name, ignore_missing=True)
+		if export or cache:
+			fits.writeto('file_wo_dwarfs.fits', cube, header, overwrite=True)
+	if cache:
+		store(key, ['file_wo_dwarfs.fits'], meta={'cutoff': float(up_cutoff), 'Npix': float(Npix)})
+
+
+	# -- Make moment 0, 1 and 2 images in one pass, using the masked, original resolution, PB-corrected datacube (see moments.py).
+	if memory_budget is not None:
+		moments_fits('file_wo_dwarfs.fits', chans, outputnames=['mom0.fits','mom1.fits','mom2.fits'], excludepix=[-100.,0.0])
+	else:
+		mom0, mom1, mom2 = moments(sig, velocity_axis(header), chans, excludepix=[-100.,0.0])
+		write_moments(mom0, mom1, mom2, header, ['mom0.fits','mom1.fits','mom2.fits'])
 	
-	  
@@ -0,0 +1,216 @@
+# Moment 0, 1 and 2 maps of a FITS datacube in one pass over the selected channels.
+# The memmapped cube is streamed in blocks of channels, so the memory use stays flat
+# however many channels the cube has.
+# Plain NumPy/astropy, CASA is not needed.
+#
+# The three moments are built from running sums of I, I*v and I*v^2, following immoments:
+#   mom0 = sum(I) * |dv|                             (all the unmasked pixels)
+#   mom1 = sum(I*v) / sum(I)                         (pixels outside excludepix)
+#   mom2 = sqrt( sum(I*(v-mom1)^2) / sum(I) )        (pixels outside excludepix)
+# with v the radio velocity in km/s. As in makemoms(), excludepix=[-100, 0] is applied
+# to moments 1 and 2 only.
+#
+# Usage:
+#   from moments import moments_fits
+#   moments_fits('file_wo_dwarfs.fits', '485~510')
+# or, from the shell:
+#   python moments.py cube.fits 485~510
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import sys
+import numpy as np
+import astropy.units as u
+from astropy.io  import fits
+from astropy.wcs import WCS
+
+
+def parse_chans(chans, nchan):
+    """channel selection of immoments, e.g. '485~510' or '10~20;40~50', as a boolean array
+
+    Parameters
+    ----------
+    chans : str
+        the channel ranges (inclusive), separated by ';' or ','. '' or None selects all.
+    nchan : int
+        the number of channels of the cube
+
+    Raises
+    ------
+    ValueError if chans selects no channel of the cube
+    """
+    select = np.zeros(nchan, dtype=bool)
+    if chans is None or str(chans).strip() == '':
+        select[:] = True
+        return select
+    for seg in str(chans).replace(',', ';').split(';'):
+        if '~' in seg:
+            c0, c1 = seg.split('~')
+            select[int(c0):int(c1)+1] = True
+        elif 0 <= int(seg) < nchan:
+            select[int(seg)] = True
+    if not select.any():
+        raise ValueError("The channels '"+str(chans)+"' select none of the "+str(nchan)+" channels of the cube")
+    return select
+
+
+def spectral_view(data, header):
+    """view a FITS cube as (chan, y, x). For 4-D cubes the first stokes plane is used."""
+    spec = WCS(header).wcs.spec
+    # -- without a spectral WCS, the slowest axis is taken as the channel axis
+    spec = data.ndim - 1 - spec if spec >= 0 else 0
+    if data.ndim == 4:
+        other = 1 - spec
+        index = [slice(None)] * 4
+        index[other] = 0
+        data  = data[tuple(index)]
+        spec  = 0
+    if spec != 0:
+        data = np.moveaxis(data, spec, 0)
+    return data
+
+
+def velocity_axis(header):
+    """radio velocity (km/s) of every channel, from the spectral WCS (crval, cdelt and crpix)
+
+    Parameters
+    ----------
+    header : astropy.io.fits.Header
+        the cube header. Frequency axes need RESTFRQ (or RESTFREQ).
+
+    Returns
+    -------
+    velocity of the channels in km/s
+    """
+    w     = WCS(header)
+    spec  = w.sub(['spectral'])
+    nchan = header['NAXIS'+str(w.wcs.spec+1)]
+    world = spec.all_pix2world(np.arange(nchan), 0)[0]
+    ctype = spec.wcs.ctype[0]
+    if ctype.startswith('FREQ'):
+        restfrq = spec.wcs.restfrq or header.get('RESTFRQ', header.get('RESTFREQ'))
+        if not restfrq:
+            raise ValueError("mom1 and mom2 need a rest frequency: RESTFRQ (or RESTFREQ) is missing from the header of the frequency cube")
+        return (world * u.Hz).to(u.km/u.s, equivalencies=u.doppler_radio(restfrq * u.Hz)).value
+    # -- velocity axes, in m/s after the WCS unit normalisation
+    return world / 1E3
+
+
+def moments(cube, velo, chans=None, excludepix=[-100., 0.], block=32):
+    """moment 0, 1 and 2 maps from one pass over the selected channels
+
+    The cube is streamed along the spectral axis in blocks of `block` channels.
+    Only one block and the 2-D accumulators are held in memory, so the memory use
+    does not grow with the number of channels when cube is a memmap.
+
+    Parameters
+    ----------
+    cube : ndarray
+        (chan, y, x) cube. NaN voxels are masked. It may be a memmap.
+    velo : ndarray
+        velocity (km/s) of every channel
+    chans : str
+        channel selection, see parse_chans()
+    excludepix : list
+        [lo, hi], the pixels with lo <= I <= hi are excluded from moments 1 and 2.
+        None to use all the unmasked pixels.
+    block : int
+        the number of channels read at once
+
+    Returns
+    -------
+    mom0, mom1, mom2 : ndarray
+        2-D maps (Jy/beam.km/s, km/s, km/s). The pixels without valid channels are NaN.
+    """
+    select = np.flatnonzero(parse_chans(chans, cube.shape[0]))
+    dv     = np.abs(np.gradient(velo)) if len(velo) > 1 else np.ones(1)
+    vref   = np.mean(velo[select])
+
+    # -- running sums, accumulated block by block
+    shape  = cube.shape[1:]
+    sum0   = np.zeros(shape)
+    nvalid = np.zeros(shape, dtype=np.int32)
+    s0     = np.zeros(shape)
+    s1     = np.zeros(shape)
+    s2     = np.zeros(shape)
+    for k in range(0, len(select), block):
+        index = select[k:k+block]
+        # -- contiguous runs are read as slices, so a memmap only touches those planes. The block is a
+        #    copy (it is modified below), also of a float64 cube
+        if index[-1] - index[0] == len(index) - 1:
+            data = np.array(cube[index[0]:index[-1]+1], dtype=np.float64)
+        else:
+            data = np.array(cube[index], dtype=np.float64)
+        good  = np.isfinite(data)
+        data[~good] = 0.
+        v     = (velo[index] - vref)[:, None, None]
+        sum0   += np.einsum('ijk,i->jk', data, dv[index])
+        nvalid += good.sum(axis=0, dtype=np.int32)
+        if excludepix is not None:
+            data[(data >= excludepix[0]) & (data <= excludepix[1])] = 0.
+        s0 += data.sum(axis=0)
+        data *= v
+        s1 += data.sum(axis=0)
+        data *= v
+        s2 += data.sum(axis=0)
+        del data, good
+    return finish_moments(sum0, nvalid, s0, s1, s2, vref)
+
+
+def finish_moments(sum0, nvalid, s0, s1, s2, vref):
+    """turn the running sums into the moment maps, see moments()"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mom0 = np.where(nvalid > 0, sum0, np.nan)
+        m1   = np.where(s0 != 0, s1 / s0, np.nan)
+        mom2 = np.sqrt(np.clip(s2 / s0 - m1**2, 0, None))
+    return mom0, m1 + vref, np.where(s0 != 0, mom2, np.nan)
+
+
+def moment_header(header, bunit):
+    """2-D header of a moment map, keeping the celestial WCS and the beam"""
+    out = WCS(header).celestial.to_header()
+    for key in ('BMAJ', 'BMIN', 'BPA', 'OBJECT', 'TELESCOP', 'DATE-OBS', 'RESTFRQ'):
+        if key in header:
+            out[key] = header[key]
+    out['BUNIT'] = bunit
+    return out
+
+
+def write_moments(mom0, mom1, mom2, header, outputnames):
+    """write the three moment maps into FITS files, named by outputnames"""
+    cubeunit = header.get('BUNIT', 'Jy/beam').strip()
+    units    = [cubeunit+'.km/s', 'km/s', 'km/s']
+    for data, unit, name in zip((mom0, mom1, mom2), units, outputnames):
+        fits.PrimaryHDU(data=data.astype(np.float32), header=moment_header(header, unit)).writeto(name, overwrite=True)
+
+
+def moments_fits(fitsfilename, chans, outputnames=None, excludepix=[-100., 0.], block=32):
+    """stream a FITS cube (memmap) once, and write its moment 0, 1 and 2 maps
+
+    Parameters
+    ----------
+    fitsfilename : str
+        the FITS cube
+    chans : str
+        channel selection, e.g. '485~510'
+    outputnames : list
+        the names of the three output files. Default: fitsfilename with _mom0/1/2.fits
+    excludepix : list
+        see moments()
+    block : int
+        the number of channels read at once, see moments()
+    """
+    if outputnames is None:
+        outputnames = [fitsfilename[0:-5]+"_mom"+str(i)+".fits" for i in range(3)]
+    cube   = fits.open(fitsfilename, memmap=True)
+    header = cube[0].header
+    mom0, mom1, mom2 = moments(spectral_view(cube[0].data, header), velocity_axis(header), chans, excludepix, block)
+    write_moments(mom0, mom1, mom2, header, outputnames)
+    cube.close()
+    return outputnames
+
+
+if __name__ == '__main__':
+    print(moments_fits(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else ''))
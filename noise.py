@@ -0,0 +1,211 @@
+# Robust noise estimates of datacubes, to replace the full-cube imstat()['rms'].
+#
+# The rms of a whole cube reads every voxel and includes the line emission, which biases
+# the cutoff upwards. Here the noise is estimated with
+#   'mad'  -- 1.4826 x median absolute deviation
+#   'clip' -- iteratively sigma-clipped standard deviation
+#   'rms'  -- plain rms, as imstat
+# from a bounded random sample of the finite voxels (or all of them, for small cubes), together
+# with the uncertainty of the estimate at a given confidence level. The voxels of a smoothed cube
+# are not independent: ncorr (see beam_voxels()) is the number of voxels per independent one, and
+# the interval is computed from the effective number of voxels. channel_noise() gives the
+# per-channel noise vector from the same pixel positions in every channel, and
+# sample_channels() picks a few planes of a cube that is too large to be read.
+#
+# Usage:
+#   from noise import estimate_noise
+#   sigma, (lo, hi) = estimate_noise(cube, method='mad', nsample=100000)
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import numpy as np
+from scipy import stats
+
+
+MAD2SIG = 1.4826
+
+# -- standard error of the estimators for Gaussian noise, in units of sigma/sqrt(n)
+STDERR  = {'mad': 1.1664, 'clip': 0.7071, 'rms': 0.7071}
+
+# -- sum of the squared correlations of neighbouring channels after Hanning smoothing, 1 + 2 x (2/3)^2 + 2 x (1/6)^2
+HANNING = 1.944
+
+# -- the most rounds of random draws in a blanked cube, before its planes are read once
+MAXDRAW = 4
+
+
+def mad_std(data, axis=None):
+    """1.4826 x median absolute deviation of the finite values"""
+    med = np.nanmedian(data, axis=axis, keepdims=True)
+    return MAD2SIG * np.nanmedian(np.abs(data - med), axis=axis)
+
+
+def clipped_std(data, nsigma=3., maxiter=10, axis=None):
+    """standard deviation after iterative nsigma clipping around the median"""
+    data = np.array(data, dtype=np.float64)
+    for i in range(maxiter):
+        med  = np.nanmedian(data, axis=axis, keepdims=True)
+        std  = np.nanstd(data, axis=axis, keepdims=True)
+        clip = np.abs(data - med) > nsigma * std
+        if not clip.any():
+            break
+        data[clip] = np.nan
+    return np.nanstd(data, axis=axis)
+
+
+def robust_std(data, method='mad', axis=None):
+    """noise of data with one of the methods 'mad', 'clip' or 'rms'"""
+    if method == 'mad':
+        return mad_std(data, axis=axis)
+    elif method == 'clip':
+        return clipped_std(data, axis=axis)
+    elif method == 'rms':
+        return np.sqrt(np.nanmean(np.square(data, dtype=np.float64), axis=axis))
+    raise ValueError("Unknown noise method: "+str(method)+", use 'mad', 'clip' or 'rms'.")
+
+
+def _sample_planes(cube, nsample, rng):
+    """(finite voxels, number of finite voxels): one pass over the planes, keeping a random
+    subset of the finite voxels of every plane, about nsample in all"""
+    per_plane = -(-nsample // len(cube))
+    data, nfinite = [], 0
+    for plane in cube:
+        plane = np.asarray(plane, dtype=np.float64).ravel()
+        good  = np.flatnonzero(np.isfinite(plane))
+        nfinite += len(good)
+        if len(good) > per_plane:
+            good = rng.choice(good, per_plane, replace=False)
+        data.append(plane[good])
+    return np.concatenate(data) if data else np.zeros(0), nfinite
+
+
+def _sample(cube, nsample, box, seed):
+    """(finite sampled voxels, estimated number of finite voxels in the cube or box)"""
+    if box is not None:
+        cube = cube[:, box[1]:box[3]+1, box[0]:box[2]+1]
+    if cube.size <= nsample:
+        data = np.asarray(cube, dtype=np.float64).ravel()
+        data = data[np.isfinite(data)]
+        return data, len(data)
+    rng   = np.random.default_rng(seed)
+    index = np.unique(rng.integers(0, cube.size, size=nsample))
+    data  = np.asarray(cube[np.unravel_index(index, cube.shape)], dtype=np.float64)
+    for it in range(MAXDRAW):
+        good = np.isfinite(data)
+        if good.sum() >= 0.9 * nsample:
+            return data[good], cube.size * good.mean()
+        # -- blanked areas (e.g. outside the primary beam): draw more voxels, for about nsample finite ones,
+        #    or read the planes once when that would be a large part of the cube
+        more = 1.1 * (nsample - good.sum()) * len(data) / max(good.sum(), 1)
+        if len(data) + more > cube.size / 4:
+            break
+        new   = np.setdiff1d(rng.integers(0, cube.size, size=int(more)), index)
+        index = np.concatenate([index, new])
+        data  = np.concatenate([data, np.asarray(cube[np.unravel_index(new, cube.shape)], dtype=np.float64)])
+    return _sample_planes(cube, nsample, rng)
+
+
+def sample_voxels(cube, nsample=100000, box=None, seed=0):
+    """random finite voxels of a (chan, y, x) cube (or memmap), drawn without reading the whole cube
+
+    Parameters
+    ----------
+    cube : ndarray
+        (chan, y, x) cube, NaN for the masked voxels
+    nsample : int
+        the number of voxels. If the cube (or box) is smaller, all the finite voxels are returned.
+    box : tuple
+        optional (blcx, blcy, trcx, trcy) in pixels, inclusive, as imstat(box=...)
+    seed : int
+        seed of the random generator, so that reruns give the same cutoff
+    """
+    return _sample(cube, nsample, box, seed)[0]
+
+
+def beam_voxels(beam, cdelt, hanning=False):
+    """number of correlated voxels per independent one, for the noise of a cube smoothed to beam
+
+    Parameters
+    ----------
+    beam : tuple
+        (bmaj, bmin) FWHM in arcsec
+    cdelt : tuple
+        (cdelt1, cdelt2) in arcsec
+    hanning : bool
+        the cube is also Hanning smoothed along the channels
+    """
+    pixels = np.pi * beam[0] * beam[1] / (4. * np.log(2.)) / abs(cdelt[0] * cdelt[1])
+    return max(1., pixels) * (HANNING if hanning else 1.)
+
+
+def sample_channels(nchan, nplanes=16, seed=0):
+    """sorted random channel indices, to estimate the noise of a cube that stays on disk
+    from a few planes (e.g. read with ia.getchunk(blc, trc) in CASA)"""
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(nchan, min(nchan, nplanes), replace=False))
+
+
+def estimate_noise(cube, method='mad', nsample=100000, box=None, confidence=0.95, seed=0, ncorr=1.):
+    """noise of a cube from a random voxel sample
+
+    Parameters
+    ----------
+    cube : ndarray
+        (chan, y, x) cube, NaN for the masked voxels
+    method : str
+        'mad', 'clip' or 'rms'
+    nsample : int
+        the maximum number of voxels used
+    box : tuple
+        optional (blcx, blcy, trcx, trcy), see sample_voxels()
+    confidence : float
+        the confidence level of the returned interval
+    seed : int
+        seed of the random generator
+    ncorr : float
+        the number of correlated voxels per independent one, see beam_voxels(). The interval
+        is computed from min(sampled voxels, finite voxels / ncorr) independent voxels.
+
+    Returns
+    -------
+    sigma : float
+        the noise estimate
+    interval : tuple
+        (lo, hi), the confidence interval of sigma
+    """
+    data, nfinite = _sample(cube, nsample, box, seed)
+    sigma = float(robust_std(data, method))
+    neff  = max(1., min(len(data), nfinite / ncorr))
+    error = stats.norm.ppf(0.5 + confidence / 2.) * STDERR[method] * sigma / np.sqrt(neff)
+    return sigma, (float(sigma - error), float(sigma + error))
+
+
+def channel_noise(cube, method='mad', npixel=10000, seed=0):
+    """noise of every channel, from the same random pixel positions in all the channels
+
+    Parameters
+    ----------
+    cube : ndarray
+        (chan, y, x) cube, NaN for the masked voxels
+    method : str
+        'mad', 'clip' or 'rms'
+    npixel : int
+        the maximum number of pixels per channel
+    seed : int
+        seed of the random generator
+
+    Returns
+    -------
+    ndarray of the per-channel noise
+    """
+    nz, ny, nx = cube.shape
+    if ny * nx <= npixel:
+        data = np.asarray(cube, dtype=np.float64).reshape(nz, -1)
+    else:
+        rng  = np.random.default_rng(seed)
+        flat = np.unique(rng.integers(0, ny * nx, size=npixel))
+        y, x = np.unravel_index(flat, (ny, nx))
+        data = np.asarray(cube[:, y, x], dtype=np.float64)
+    return robust_std(data, method, axis=1)
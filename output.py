@@ -0,0 +1,130 @@
+# Headless output of extracted spectra, for batch runs on compute nodes.
+#
+# write_spectra() puts all the spectra of a batch into one file: a FITS binary table (one row
+# per spectrum, the spectra as array columns, and the frequency axis in the FREQ extension) or a
+# NumPy .npz. The plots are optional, and rendered by a background pool of processes
+# (plot_in_background), so they are off the critical path.
+#
+# Usage:
+#   from output import write_spectra, read_spectra, plot_in_background, wait_plots
+#   write_spectra('batch_spectra.fits', freq_ghz, {'FLUX_JY': flux, 'TB_K': tb}, names=locations)
+#   plots = plot_in_background([(freq_ghz, tb[0], 'Tb (K)', 'spec0_Tb.pdf')])
+#   ...                                           # more work, while the plots are rendered
+#   wait_plots(*plots)                            # at the end: raises if a plot failed
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import numpy as np
+import multiprocessing
+from astropy.io import fits
+
+
+def write_spectra(outfile, freq, columns, names=None, header=None):
+    """write a batch of spectra into one FITS binary table (.fits) or NumPy archive (.npz)
+
+    Parameters
+    ----------
+    outfile : str
+        the output file, .fits or .npz
+    freq : ndarray
+        (nchan,) frequency axis in GHz
+    columns : dict
+        {name: (nspec, nchan) or (nchan,) array}, e.g. {'FLUX_JY': flux, 'TB_K': tb}
+    names : list
+        a label for every spectrum (e.g. the positions)
+    header : dict
+        optional keywords of the table (FITS) or extra arrays (npz)
+    """
+    columns = {key: np.atleast_2d(value) for key, value in columns.items()}
+    nspec   = len(next(iter(columns.values())))
+    names   = [str(n) for n in (names if names is not None else range(nspec))]
+    if outfile.endswith('.npz'):
+        np.savez(outfile, freq=np.asarray(freq), names=np.array(names), **dict(columns, **(header or {})))
+        return outfile
+
+    nchan = len(freq)
+    cols  = [fits.Column(name='NAME', format=str(max(1, max(len(n) for n in names)))+'A', array=names)]
+    cols += [fits.Column(name=key, format=str(nchan)+'E', array=value.astype(np.float32)) for key, value in columns.items()]
+    table = fits.BinTableHDU.from_columns(cols, name='SPECTRA')
+    for key, value in (header or {}).items():
+        table.header[key] = value
+    freq_hdu = fits.ImageHDU(np.asarray(freq, dtype=np.float64), name='FREQ')
+    freq_hdu.header['BUNIT'] = 'GHz'
+    fits.HDUList([fits.PrimaryHDU(), table, freq_hdu]).writeto(outfile, overwrite=True)
+    return outfile
+
+
+def read_spectra(filename):
+    """(freq, {column: (nspec, nchan)}, names) of a file written by write_spectra()"""
+    if filename.endswith('.npz'):
+        data = np.load(filename)
+        cols = {key: data[key] for key in data.files if key not in ('freq', 'names') and data[key].ndim == 2}
+        return data['freq'], cols, [str(n) for n in data['names']]
+    with fits.open(filename) as hdulist:
+        table = hdulist['SPECTRA'].data
+        cols  = {name: np.array(table[name]) for name in table.columns.names if name != 'NAME'}
+        return np.array(hdulist['FREQ'].data), cols, list(table['NAME'])
+
+
+def plot_spectrum(freq, spectrum, ylabel, filename):
+    """render one spectrum into a file, without a display"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig = plt.figure()
+    ax1 = fig.add_subplot(111)
+    ax1.plot(freq, spectrum, drawstyle='steps-mid')
+    ax1.set_xlabel('Frequency (GHz)', fontsize=18)
+    ax1.set_ylabel(ylabel, fontsize=16)
+    fig.savefig(filename)
+    plt.close(fig)
+    return filename
+
+
+def _report(error):
+    """error_callback of the background plots: a failed plot is reported as soon as it fails"""
+    print("A background plot failed: ", repr(error))
+
+
+def plot_in_background(plots, processes=2):
+    """render plots in a background pool of processes
+
+    Parameters
+    ----------
+    plots : list
+        (freq, spectrum, ylabel, filename) of every plot, freq (nchan,) in GHz
+    processes : int
+        the number of processes
+
+    Returns
+    -------
+    pool, results
+        the pool, already closed to new work, and the AsyncResult of every plot. wait_plots()
+        waits for them.
+    """
+    pool    = multiprocessing.Pool(processes)
+    results = [pool.apply_async(plot_spectrum, (freq, spectrum, ylabel, filename), error_callback=_report)
+               for freq, spectrum, ylabel, filename in plots]
+    pool.close()
+    return pool, results
+
+
+def wait_plots(pool, results):
+    """wait for the plots of plot_in_background()
+
+    Returns
+    -------
+    the names of the plot files. Raises a RuntimeError if any plot failed.
+    """
+    pool.join()
+    done, failed = [], []
+    for result in results:
+        try:
+            done.append(result.get())
+        except Exception as error:
+            failed.append(error)
+    if failed:
+        raise RuntimeError(str(len(failed))+" of "+str(len(results))+" background plots failed, the first: "+repr(failed[0]))
+    return done
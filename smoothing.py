@@ -0,0 +1,282 @@
+# Smooth-and-mask in memory, without CASA.
+# It does what makemoms() (makemoments.py) and dyn_clean.py do on disk with
+#   imsmooth(targetres=True) -> specsmooth(function='hanning') -> imstat()['rms'] -> ia.calcmask()
+#
+#   1) Gaussian spatial convolution to a circular beam of factor x the input beam (1.5 by default).
+#      The matching kernel is the target beam deconvolved by the input beam, and its FFT is
+#      computed once and reused for all the channel planes.
+#      With per-plane beams, every channel gets its exact matching kernel. The channels sharing
+#      a beam are convolved together, with one kernel FFT per (bmaj, bmin, bpa).
+#   2) Hanning smoothing along the channels, kernel [0.25, 0.5, 0.25]
+#   3) cutoff = nsigma x noise of the smoothed cube (optionally inside a box). The noise is the
+#      robust estimate of noise.py ('mad' by default), from a random sample of the finite voxels.
+#   4) mask = smoothed cube > cutoff
+#
+# Beams are given as (bmaj, bmin, bpa): FWHM in arcsec, and position angle in deg (east of north).
+# Pixel sizes (cdelt1, cdelt2) are in arcsec, with their signs as in the header.
+#
+# Usage:
+#   from smoothing import smooth_and_mask
+#   sm_sm, up_cutoff, mask = smooth_and_mask(cube, (0.5, 0.4, 30.), (-0.06, 0.06), factor=1.5, nsigma=3)
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import numpy as np
+from scipy import fft
+from scipy import ndimage
+from noise import estimate_noise, beam_voxels
+
+
+FWHM2SIG = 1. / np.sqrt(8 * np.log(2))
+
+
+def beam_covariance(bmaj, bmin, bpa, cdelt1, cdelt2):
+    """covariance matrix (pixel^2, axes x and y) of Gaussian beams
+
+    Parameters
+    ----------
+    bmaj, bmin, bpa : float or ndarray
+        FWHM (arcsec) and position angle (deg) of the beams
+    cdelt1, cdelt2 : float
+        pixel sizes (arcsec), signed
+
+    Returns
+    -------
+    ndarray of shape (..., 2, 2)
+    """
+    pa   = np.radians(bpa)
+    smaj = (np.asarray(bmaj) * FWHM2SIG)**2
+    smin = (np.asarray(bmin) * FWHM2SIG)**2
+    s, c = np.sin(pa), np.cos(pa)
+    # -- on the sky (east, north); the major axis points to (sin pa, cos pa)
+    see  = smaj * s * s + smin * c * c
+    snn  = smaj * c * c + smin * s * s
+    sen  = (smaj - smin) * s * c
+    # -- to pixels: x = east / cdelt1, y = north / cdelt2
+    cov  = np.array([[see / cdelt1**2,          sen / (cdelt1 * cdelt2)],
+                     [sen / (cdelt1 * cdelt2), snn / cdelt2**2        ]])
+    return np.moveaxis(cov, (0, 1), (-2, -1))
+
+
+def gaussian_kernel(cov, nsig=4.):
+    """normalised 2-D Gaussian kernel image of the pixel covariance cov (2 x 2)"""
+    if np.linalg.eigvalsh(cov).min() < -1E-6:
+        raise ValueError("The target beam is smaller than the input beam, cannot convolve to it.")
+    cov  = cov + np.eye(2) * 1E-3
+    half = int(np.ceil(nsig * np.sqrt(max(cov[0, 0], cov[1, 1]))))
+    y, x = np.mgrid[-half:half+1, -half:half+1]
+    inv  = np.linalg.inv(cov)
+    kern = np.exp(-0.5 * (inv[0, 0] * x * x + 2 * inv[0, 1] * x * y + inv[1, 1] * y * y))
+    return kern / kern.sum()
+
+
+def matching_kernel(beam, target, cdelt):
+    """kernel convolving beam into target, and the Jy/beam scaling factor (target area / beam area)
+
+    Parameters
+    ----------
+    beam, target : tuple
+        (bmaj, bmin, bpa) of the input and the target beams
+    cdelt : tuple
+        (cdelt1, cdelt2)
+    """
+    cov   = beam_covariance(*(tuple(target) + tuple(cdelt))) - beam_covariance(*(tuple(beam) + tuple(cdelt)))
+    scale = (target[0] * target[1]) / (beam[0] * beam[1])
+    return gaussian_kernel(cov), scale
+
+
+def kernel_fft(kernel, shape):
+    """FFT of the kernel, zero padded for the linear convolution of planes of this shape"""
+    pad = (fft.next_fast_len(shape[0] + kernel.shape[0] - 1, real=True),
+           fft.next_fast_len(shape[1] + kernel.shape[1] - 1, real=True))
+    return fft.rfft2(kernel, s=pad), pad
+
+
+def _convolve_block(data, kft, kshape, scale):
+    # -- convolve a block of planes (n, y, x) with the kernel FFT. With blanked voxels, this is a
+    #    normalised convolution (data x w and w convolved, w = 1 for the finite voxels), so the edges
+    #    of the blanked areas are not pulled towards 0, and the blanked voxels stay NaN.
+    kern, pad = kft
+    ny, nx    = data.shape[-2:]
+    cy, cx    = kshape[0] // 2, kshape[1] // 2
+    finite    = np.isfinite(data)
+    conv = fft.irfft2(fft.rfft2(np.where(finite, data, 0.), s=pad) * kern, s=pad)[:, cy:cy+ny, cx:cx+nx]
+    if not finite.all():
+        norm = fft.irfft2(fft.rfft2(finite.astype(np.float64), s=pad) * kern, s=pad)[:, cy:cy+ny, cx:cx+nx]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            conv = np.where(norm > 1E-6, conv / norm, np.nan)
+        conv[~finite] = np.nan
+    return conv * scale
+
+
+def convolve_planes(cube, kernel, scale=1., block=16, kft=None):
+    """convolve every channel plane of a (chan, y, x) cube with one kernel, via FFT
+
+    The FFT of the kernel is computed once (or given by kft, from kernel_fft) and
+    reused for all the planes. NaN voxels are left out of the convolution, and stay NaN
+    in the output, as the mask of imsmooth.
+
+    Parameters
+    ----------
+    cube : ndarray
+        (chan, y, x) cube, or a memmap
+    kernel : ndarray
+        2-D kernel image
+    scale : float
+        multiplied to the result, e.g. the Jy/beam factor from matching_kernel()
+    block : int
+        the number of planes transformed at once
+    kft : tuple
+        optional, the output of kernel_fft(kernel, cube.shape[1:])
+
+    Returns
+    -------
+    the convolved cube (float32)
+    """
+    nz, ny, nx = cube.shape
+    if kft is None:
+        kft = kernel_fft(kernel, (ny, nx))
+    out = np.empty(cube.shape, dtype=np.float32)
+    for z0 in range(0, nz, block):
+        data = np.asarray(cube[z0:z0+block], dtype=np.float64)
+        out[z0:z0+block] = _convolve_block(data, kft, kernel.shape, scale)
+    return out
+
+
+def beam_kernel(beam, target, cdelt, shape):
+    """matching kernel shape, Jy/beam scale and kernel FFT of one beam (bmaj, bmin, bpa)"""
+    kernel, scale = matching_kernel(beam, target, cdelt)
+    return kernel.shape, scale, kernel_fft(kernel, shape)
+
+
+def beam_groups(bmaj, bmin, bpa, precision=(1E-3, 1E-3, 0.1)):
+    """group the channels sharing a beam
+
+    Parameters
+    ----------
+    bmaj, bmin, bpa : ndarray
+        per-channel beams (arcsec, arcsec, deg)
+    precision : tuple
+        the beams equal within (arcsec, arcsec, deg) share a group
+
+    Returns
+    -------
+    list of (beam triple, channel indices). Channels with non-finite beams are left out.
+    """
+    beams = np.stack([bmaj, bmin, bpa], axis=-1).astype(np.float64)
+    good  = np.all(np.isfinite(beams), axis=1)
+    keys  = np.round(beams[good] / np.asarray(precision)).astype(np.int64)
+    uniq, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    chans   = np.flatnonzero(good)
+    groups  = []
+    for g, key in enumerate(uniq):
+        triple = tuple(float(v) for v in key * np.asarray(precision))
+        groups.append((triple, chans[inverse == g]))
+    return groups
+
+
+def convolve_perplane(cube, bmaj, bmin, bpa, target, cdelt, block=16, precision=(1E-3, 1E-3, 0.1)):
+    """convolve every channel plane from its own beam to a common target beam
+
+    The channels sharing a beam (within precision) are convolved together, with one
+    kernel FFT per beam triple (see beam_kernel), so cubes with many nearly identical
+    beams cost about as much as uniform-beam cubes. Only the FFT of the group being
+    convolved is kept in memory.
+
+    Parameters
+    ----------
+    cube : ndarray
+        (chan, y, x) cube, or a memmap
+    bmaj, bmin, bpa : ndarray
+        per-channel beams (arcsec, arcsec, deg)
+    target : tuple
+        (bmaj, bmin, bpa) of the common beam
+    cdelt : tuple
+        (cdelt1, cdelt2) in arcsec
+    block : int
+        the number of planes transformed at once
+    precision : tuple
+        see beam_groups()
+
+    Returns
+    -------
+    the convolved cube (float32, Jy/beam of the target beam). Channels without beams are NaN.
+    """
+    shape  = cube.shape[1:]
+    target = tuple(float(v) for v in target)
+    cdelt  = tuple(float(v) for v in cdelt)
+    out    = np.full(cube.shape, np.nan, dtype=np.float32)
+    for beam, chans in beam_groups(bmaj, bmin, bpa, precision):
+        kshape, scale, kft = beam_kernel(beam, target, cdelt, shape)
+        for k in range(0, len(chans), block):
+            index = chans[k:k+block]
+            data  = np.asarray(cube[index], dtype=np.float64)
+            out[index] = _convolve_block(data, kft, kshape, scale)
+    return out
+
+
+def convolve_to_beam(cube, beam, cdelt, factor=1.5, block=16):
+    """convolve a cube to a circular beam of factor x max(bmaj, bmin), as imsmooth(targetres=True)
+
+    beam may hold per-channel arrays (bmaj, bmin, bpa), e.g. from 'perplanebeams'. The target
+    is then factor x the larger of the mean bmaj and the mean bmin, as in makemoms().
+
+    Returns
+    -------
+    the convolved cube (Jy/beam of the new beam), and the target beam
+    """
+    size   = factor * max(np.nanmean(beam[0]), np.nanmean(beam[1]))
+    target = (size, size, 0.)
+    if np.ndim(beam[0]) > 0:
+        return convolve_perplane(cube, beam[0], beam[1], beam[2], target, cdelt, block), target
+    kernel, scale = matching_kernel(beam, target, cdelt)
+    return convolve_planes(cube, kernel, scale, block), target
+
+
+def hanning_smooth(cube, axis=0):
+    """Hanning smoothing along the spectral axis, as specsmooth(function='hanning', dmethod='')"""
+    return ndimage.convolve1d(cube, [0.25, 0.5, 0.25], axis=axis, mode='nearest')
+
+
+def smooth_and_mask(cube, beam, cdelt, factor=1.5, nsigma=3., box=None, block=16, noise='mad', nsample=100000):
+    """smooth a cube spatially and spectrally, and mask it at nsigma x noise
+
+    Parameters
+    ----------
+    cube : ndarray
+        (chan, y, x) cube, NaN for the masked voxels
+    beam : tuple
+        (bmaj, bmin, bpa) of the cube, or per-channel arrays of them
+    cdelt : tuple
+        (cdelt1, cdelt2) in arcsec
+    factor : float
+        the target beam is factor x max(bmaj, bmin)
+    nsigma : float
+        cutoff = nsigma x noise of the smoothed cube
+    box : tuple
+        optional (blcx, blcy, trcx, trcy) region for the noise, see noise.sample_voxels()
+    block : int
+        the number of planes transformed at once
+    noise : str
+        'mad', 'clip' or 'rms' (see noise.py). 'rms' of all the voxels is imstat()['rms'].
+    nsample : int
+        the maximum number of voxels for the noise estimate, None for all of them
+
+    Returns
+    -------
+    sm_sm : ndarray
+        the spatially and spectrally smoothed cube
+    cutoff : float
+        the cutoff level
+    mask : ndarray
+        boolean mask, sm_sm > cutoff
+    """
+    sm, target = convolve_to_beam(cube, beam, cdelt, factor, block)
+    sm_sm  = hanning_smooth(sm)
+    del sm
+    sigma, interval = estimate_noise(sm_sm, noise, nsample or sm_sm.size, box, ncorr=beam_voxels(target, cdelt, hanning=True))
+    cutoff = nsigma * sigma
+    return sm_sm, cutoff, sm_sm > cutoff
@@ -0,0 +1,327 @@
+# Spectra of many apertures at once.
+#
+# extract_spectra() opens every cube once (see cube.py), and builds one sparse weight matrix
+# W (apertures x pixels) for all the apertures. The spectra of one block of channels are then
+# a single sparse product, W @ block, and the whole cube is read once however many apertures
+# there are. Masked (NaN) pixels are left out of the average of their aperture.
+#
+# The weights are the exact fractional overlap of every pixel with the circle or ellipse
+# (beam-shaped apertures), so small apertures on coarse pixels are not pixelated. They are
+# cached by (sub-pixel offset, radius, minor axis, angle).
+#
+# grid_spectra() gives the spectra of a regular grid of box or circular apertures across the
+# field (e.g. for maps of line ratios), from per-channel summed-area tables: the cost is about
+# one read of the cube, independent of the size of the apertures.
+#
+# Usage:
+#   from spectra import extract_spectra
+#   freq, spec = extract_spectra('cube.fits', ['13:15:06.315,-55.09.22.764'], 0.6)
+#   results    = extract_spectra(['spw25.fits', 'spw27.fits'], catalogue_coords, 0.6)
+#   freq, centres, grid = grid_spectra('cube.fits', step=0.6, size=0.6, aperture='circle')
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import functools
+import numpy as np
+from scipy import sparse
+from astropy.coordinates import SkyCoord
+from cube  import Cube, parse_position
+from tiles import SpectralTiles
+
+
+# -- relative tolerance on the radius for method='center', so that the rounding of the pixel
+#    scale (e.g. 0.3" / 0.06" = 4.9999999999999 pixels) and of the WCS transformations does not
+#    decide for the pixels on the edge
+EPS = 1E-6
+
+
+def sky_positions(positions):
+    """SkyCoord array of a SkyCoord, or of a list of positions (see parse_position())"""
+    if isinstance(positions, SkyCoord):
+        return positions if not positions.isscalar else positions.reshape(1)
+    return SkyCoord([parse_position(p) for p in positions])
+
+
+def _sector(p, q, r2):
+    """signed area of the circular sector (origin, radius^2 = r2) between the vectors p and q"""
+    return 0.5 * r2 * np.arctan2(p[0] * q[1] - p[1] * q[0], p[0] * q[0] + p[1] * q[1])
+
+
+def _edge_area(a, b, r2=1.):
+    """signed area of the intersection of the circle (origin, radius^2 = r2) with the triangle
+    (origin, a, b). Summed over the edges of a polygon, it gives the exact overlap area."""
+    d    = b - a
+    qa   = d[0]**2 + d[1]**2
+    qb   = 2 * (a[0] * d[0] + a[1] * d[1])
+    qc   = a[0]**2 + a[1]**2 - r2
+    disc = qb**2 - 4 * qa * qc
+    root = np.sqrt(np.clip(disc, 0, None))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t1 = np.where(disc > 0, np.clip((-qb - root) / (2 * qa), 0, 1), 0.)
+        t2 = np.where(disc > 0, np.clip((-qb + root) / (2 * qa), 0, 1), 0.)
+    p1, p2 = a + t1 * d, a + t2 * d
+    # -- outside from a to p1, inside (a triangle) from p1 to p2, outside from p2 to b
+    inside = 0.5 * (p1[0] * p2[1] - p1[1] * p2[0])
+    return _sector(a, p1, r2) + inside + _sector(p2, b, r2)
+
+
+@functools.lru_cache(maxsize=4096)
+def aperture_stamp(fx, fy, major, minor, theta):
+    """exact fractional overlap of the pixels with an ellipse (or circle)
+
+    Parameters
+    ----------
+    fx, fy : float
+        the offset of the centre from the nearest pixel centre, in pixels
+    major, minor : float
+        the semi-axes in pixels
+    theta : float
+        the angle (deg) of the major axis from the +x axis
+
+    Returns
+    -------
+    dy, dx, w : ndarray
+        the offsets of the pixels from the nearest pixel, and their weights (0 < w <= 1)
+    """
+    r      = int(np.ceil(major)) + 1
+    dy, dx = [a.ravel() for a in np.mgrid[-r:r+1, -r:r+1]]
+    # -- corners of the pixels (counter-clockwise), relative to the centre,
+    #    in the frame where the ellipse is the unit circle
+    cos, sin = np.cos(np.radians(theta)), np.sin(np.radians(theta))
+    corners  = []
+    for cx, cy in ((-0.5, -0.5), (0.5, -0.5), (0.5, 0.5), (-0.5, 0.5)):
+        x, y = dx + cx - fx, dy + cy - fy
+        corners.append(np.array([(x * cos + y * sin) / major, (-x * sin + y * cos) / minor]))
+    area = sum(_edge_area(corners[i], corners[(i + 1) % 4]) for i in range(4)) * major * minor
+    keep = area > 1E-12
+    return dy[keep], dx[keep], np.clip(area[keep], 0, 1)
+
+
+def aperture_weights(xc, yc, radius, shape, minor=None, theta=0., method='exact', precision=1E-3):
+    """sparse (aperture x pixel) matrix of circular or elliptical apertures
+
+    Parameters
+    ----------
+    xc, yc : ndarray
+        the centres of the apertures in pixels (0-based)
+    radius : float
+        the radius (or the semi-major axis) in pixels
+    shape : tuple
+        (ny, nx) of the image. The pixels are numbered y * nx + x.
+    minor : float
+        the semi-minor axis in pixels, None for circles
+    theta : float
+        the angle (deg) of the major axis from the +x axis
+    method : str
+        'exact': the fractional overlap of every pixel with the aperture, see aperture_stamp().
+                 The stamps are cached by (offset, radius, minor, theta), and the offsets are
+                 rounded to `precision` pixels, so apertures on the same grid share them.
+        'center': 1 for the pixels whose centre is inside the aperture, as imval(region=...)
+    """
+    ny, nx = shape
+    minor  = radius if minor is None else minor
+    xc, yc = np.asarray(xc, dtype=np.float64), np.asarray(yc, dtype=np.float64)
+    x0, y0 = np.rint(xc).astype(int), np.rint(yc).astype(int)
+    if method == 'center':
+        r      = int(np.ceil(radius)) + 1
+        dy, dx = [a.ravel() for a in np.mgrid[-r:r+1, -r:r+1]]
+        x, y   = x0[:, None] + dx, y0[:, None] + dy
+        cos, sin = np.cos(np.radians(theta)), np.sin(np.radians(theta))
+        u, v   = (x - xc[:, None]) * cos + (y - yc[:, None]) * sin, -(x - xc[:, None]) * sin + (y - yc[:, None]) * cos
+        w      = ((u / radius)**2 + (v / minor)**2 <= 1 + EPS).astype(np.float64)
+        rows   = np.broadcast_to(np.arange(len(xc))[:, None], x.shape)
+    elif method == 'exact':
+        fx, fy = np.round((xc - x0) / precision) * precision, np.round((yc - y0) / precision) * precision
+        keys, inverse = np.unique(np.stack([fx, fy]), axis=1, return_inverse=True)
+        inverse = np.ravel(inverse)
+        rows, x, y, w = [], [], [], []
+        for k in range(keys.shape[1]):
+            dy, dx, wk = aperture_stamp(float(keys[0, k]), float(keys[1, k]), float(radius), float(minor), float(theta))
+            sel = np.flatnonzero(inverse == k)
+            rows.append(np.repeat(sel, len(wk)))
+            x.append((x0[sel, None] + dx).ravel())
+            y.append((y0[sel, None] + dy).ravel())
+            w.append(np.tile(wk, len(sel)))
+        rows, x, y, w = [np.concatenate(a) if a else np.zeros(0, dtype=int) for a in (rows, x, y, w)]
+    else:
+        raise ValueError("Unknown aperture method: "+str(method)+", use 'exact' or 'center'.")
+    inside = (w > 0) & (x >= 0) & (x < nx) & (y >= 0) & (y < ny)
+    return sparse.csr_matrix((w[inside], (rows[inside], y[inside] * nx + x[inside])), shape=(len(xc), ny * nx))
+
+
+def _weighted_mean(W, data):
+    """W @ data / W @ finite(data), for a (pixel, chan) block with NaN for the masked pixels"""
+    good = np.isfinite(data)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (W @ np.where(good, data, 0.)) / (W @ good.astype(np.float64))
+
+
+def cube_spectra(cube, positions, diameter, block=64, tiles=False, minor=None, pa=0., method='exact'):
+    """mean spectra (Jy/beam) of circular or elliptical apertures in one Cube
+
+    Parameters
+    ----------
+    cube : Cube
+        the cube, see cube.py
+    positions : SkyCoord or list
+        the centres of the apertures
+    diameter : float
+        the diameter of the apertures in arcsec
+    block : int
+        the number of channels read at once
+    tiles : bool
+        read the spectra from the spectral-contiguous tiles of the cube (see tiles.py)
+    minor : float
+        the minor-axis diameter of elliptical apertures in arcsec (e.g. beam-shaped), None for circles
+    pa : float
+        the position angle (deg, east of north) of the major axis
+    method : str
+        'exact' (fractional pixel overlap) or 'center', see aperture_weights()
+
+    Returns
+    -------
+    (naperture, nchan) array of the spectra
+    """
+    nz, ny, nx = cube.shape
+    x, y   = cube.celestial.world_to_pixel(sky_positions(positions))
+    scale  = cube.pixel_scale()[0]
+    # -- the major axis in the pixel frame: north is +y, and east is -x when cdelt1 < 0
+    east   = -1. if cube.celestial.pixel_scale_matrix[0, 0] < 0 else 1.
+    theta  = np.degrees(np.arctan2(np.cos(np.radians(pa)), east * np.sin(np.radians(pa))))
+    W      = aperture_weights(np.atleast_1d(x), np.atleast_1d(y), diameter / 2. / scale, (ny, nx),
+                              None if minor is None else minor / 2. / scale, theta, method)
+
+    # -- only the pixels in one of the apertures are read
+    used   = np.unique(W.indices)
+    W      = W[:, used]
+    if len(used) == 0:
+        return np.full((W.shape[0], nz), np.nan, dtype=np.float32)
+    if tiles:
+        data = SpectralTiles(cube.filename).spectra(used % nx, used // nx)
+        return _weighted_mean(W, data.astype(np.float64)).astype(np.float32)
+
+    py, px = used // nx, used % nx
+    y0, x0 = py.min(), px.min()
+    width  = px.max() + 1 - x0
+    local  = (py - y0) * width + (px - x0)
+    out    = np.empty((W.shape[0], nz), dtype=np.float32)
+    for z0 in range(0, nz, block):
+        data = cube[z0:z0+block, y0:py.max()+1, x0:x0+width]
+        data = data.reshape(data.shape[0], -1)[:, local]
+        out[:, z0:z0+block] = _weighted_mean(W, data.T.astype(np.float64))
+    return out
+
+
+def extract_spectra(cubes, positions, diameter, block=64, tiles=False, minor=None, pa=0., method='exact'):
+    """mean spectra (Jy/beam) of circular or elliptical apertures at many positions, in one pass per cube
+
+    Parameters
+    ----------
+    cubes : str or list
+        FITS cubes or CASA images
+    positions : SkyCoord or list
+        the centres of the apertures, e.g. '13:15:06.315,-55.09.22.764'
+    diameter : float
+        the diameter of the apertures in arcsec
+    block : int
+        the number of channels read at once
+    tiles, minor, pa, method :
+        see cube_spectra()
+
+    Returns
+    -------
+    (spectral_axis, spectra) for one cube, or a list of them for a list of cubes.
+    spectral_axis is a Quantity (Hz, from the full WCS), spectra is (naperture, nchan).
+    """
+    single = isinstance(cubes, str)
+    out    = []
+    for filename in ([cubes] if single else cubes):
+        with Cube(filename) as cube:
+            out.append((cube.spectral_axis(), cube_spectra(cube, positions, diameter, block, tiles, minor, pa, method)))
+    return out[0] if single else out
+
+
+def _integral(data):
+    """summed-area tables (chan, y+1, x+1) of a block of planes, with a zero first row and column"""
+    nb, ny, nx = data.shape
+    table = np.zeros((nb, ny + 1, nx + 1))
+    np.cumsum(np.cumsum(data, axis=1, dtype=np.float64), axis=2, out=table[:, 1:, 1:])
+    return table
+
+
+def _box_sums(table, y0, y1, x0, x1):
+    """(chan, aperture) sums of the boxes [y0:y1, x0:x1], four look-ups each"""
+    return table[:, y1, x1] - table[:, y0, x1] - table[:, y1, x0] + table[:, y0, x0]
+
+
+def grid_spectra(filename, step, size, aperture='box', block=8):
+    """mean spectra (Jy/beam) in a regular grid of apertures across the whole field
+
+    Every block of channels is read once, and turned into summed-area tables of the data and of
+    the unmasked pixels. A box aperture then costs four look-ups per channel, whatever its size.
+    A circular aperture is summed as its rows of pixels (those whose centre is inside the circle,
+    as method='center' of aperture_weights()), i.e. 2 x radius + 1 boxes of one row.
+
+    Parameters
+    ----------
+    filename : str
+        the FITS cube or CASA image
+    step : float
+        the spacing of the grid in arcsec
+    size : float
+        the side of the boxes, or the diameter of the circles, in arcsec. A box of an even number
+        of pixels is centred between pixels.
+    aperture : str
+        'box' or 'circle'
+    block : int
+        the number of channels read at once
+
+    Returns
+    -------
+    spectral_axis : Quantity
+        see Cube.spectral_axis()
+    centres : SkyCoord
+        (ny_grid, nx_grid) centres of the apertures
+    spectra : ndarray
+        (ny_grid, nx_grid, nchan) mean spectra
+    """
+    with Cube(filename) as cube:
+        nz, ny, nx = cube.shape
+        scale  = cube.pixel_scale()[0]
+        step   = max(1, int(round(step / scale)))
+        radius = size / 2. / scale * (1 + EPS)
+        half   = int(np.floor(radius))
+        yc, xc = np.mgrid[half:ny-half:step, half:nx-half:step] if min(ny, nx) > 2 * half else np.mgrid[0:0, 0:0]
+        gshape = yc.shape
+        yc, xc = yc.ravel(), xc.ravel()
+        offset = 0.
+        if aperture == 'box':
+            # -- a box of an even number of pixels is centred on the corner between four pixels,
+            #    half a pixel below and left of the grid pixel
+            side   = max(1, int(round(size / scale * (1 + EPS))))
+            lo     = side // 2
+            offset = (side - 1) / 2. - lo
+            rows   = [(yc - lo, yc - lo + side, xc - lo, xc - lo + side)]
+        elif aperture == 'circle':
+            rows = []
+            for dy in range(-half, half + 1):
+                w = int(np.floor(np.sqrt(radius**2 - dy**2)))
+                rows.append((yc + dy, yc + dy + 1, xc - w, xc + w + 1))
+        else:
+            raise ValueError("Unknown aperture: "+str(aperture)+", use 'box' or 'circle'.")
+        rows = [[np.clip(a, 0, n) for a, n in zip(r, (ny, ny, nx, nx))] for r in rows]
+
+        out = np.empty((len(yc), nz), dtype=np.float32)
+        for z0 in range(0, nz, block):
+            data  = cube[z0:z0+block]
+            good  = np.isfinite(data)
+            total = _integral(np.where(good, data, 0.))
+            count = _integral(good)
+            s = sum(_box_sums(total, *r) for r in rows)
+            n = sum(_box_sums(count, *r) for r in rows)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                out[:, z0:z0+block] = (s / n).T
+        centres = cube.celestial.pixel_to_world(xc + offset, yc + offset).reshape(gshape)
+        return cube.spectral_axis(), centres, out.reshape(gshape + (nz,))
@@ -0,0 +1,150 @@
+# Velocity-aligned stacking of spectra, e.g. of the extract.py spectra of many galaxies or positions.
+#
+# The frequency axis (GHz) of every spectrum is shifted to the rest frame of its source (redshift z
+# or systemic velocity vsys) and converted to the velocity of a line (radio convention). All the
+# spectra are then regridded onto one common velocity grid in one vectorised linear interpolation
+# (one searchsorted over all the spectra, no loop over spectra or channels), and stacked into
+#   mean     -- noise-weighted (1/rms^2) mean, the rms of each spectrum from the MAD (noise.py)
+#   median   -- channel median
+#   error    -- bootstrap uncertainty of the weighted mean (resampled spectra)
+# The spectra may have different numbers of channels: they are padded with NaN.
+#
+# Usage:
+#   from stacking import load_spectra, stack_spectra
+#   freqs, spectra = load_spectra(['a.fits_Tb.dat', 'b_spectra.fits'])   # CSV of extract.py, or output.py tables
+#   vel, mean, median, error, count = stack_spectra(freqs, spectra, restfreq=230.538, z=[0.031, 0.029, 0.030])
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import numpy as np
+from noise  import robust_std
+from output import read_spectra
+
+
+CKMS = 299792.458
+
+
+def _pack(rows):
+    """(n, nmax) array of rows of different lengths, padded with NaN"""
+    if isinstance(rows, np.ndarray) and rows.dtype != object:
+        return np.atleast_2d(rows).astype(np.float64)
+    rows = [np.ravel(np.asarray(r, dtype=np.float64)) for r in rows]
+    out  = np.full((len(rows), max(len(r) for r in rows)), np.nan)
+    for i, r in enumerate(rows):
+        out[i, :len(r)] = r
+    return out
+
+
+def load_spectra(filenames, column='TB_K'):
+    """(freqs, spectra) lists of the spectra in extract.py CSV files (_Tb.dat) or output.py tables"""
+    freqs, spectra = [], []
+    for filename in filenames:
+        if filename.endswith(('.fits', '.npz')):
+            freq, cols, names = read_spectra(filename)
+            freqs   += [freq] * len(cols[column])
+            spectra += list(cols[column])
+        else:
+            data = np.genfromtxt(filename, delimiter=',', comments='#')
+            data = data[np.isfinite(data).all(1)]
+            freqs.append(data[:, 0])
+            spectra.append(data[:, 1])
+    return freqs, spectra
+
+
+def rest_velocity(freq, restfreq, z=None, vsys=None):
+    """velocity (km/s, radio) of the frequencies freq (GHz, (n, nchan)) in the rest frame of
+    each spectrum, relative to the line at restfreq (GHz)
+
+    z or vsys (km/s, optical, z = vsys/c) is a scalar or one value per spectrum.
+    """
+    freq = _pack(freq)
+    if z is None:
+        z = 0. if vsys is None else np.asarray(vsys, dtype=np.float64) / CKMS
+    z = np.reshape(np.asarray(z, dtype=np.float64), (-1, 1))
+    return CKMS * (1. - freq * (1. + z) / restfreq)
+
+
+def regrid(vel, spectra, grid):
+    """linear interpolation of every spectrum (n, nchan) from its velocity axis vel (n, nchan)
+    onto grid (ngrid,), in one pass. NaN outside the velocity range of each spectrum.
+    """
+    vel, spectra = _pack(vel), _pack(spectra)
+    grid     = np.asarray(grid, dtype=np.float64)
+    n, nchan = vel.shape
+    # -- ascending velocities in every row, the padding last
+    order = np.argsort(np.where(np.isfinite(vel), vel, np.inf), axis=1)
+    vel, spectra = np.take_along_axis(vel, order, 1), np.take_along_axis(spectra, order, 1)
+    nvalid = np.isfinite(vel).sum(1)
+
+    # -- rows side by side on one axis: row i is mapped into [2i, 2i+1], so one searchsorted does all the rows
+    lo, hi = min(np.nanmin(vel), grid.min()), max(np.nanmax(vel), grid.max())
+    span   = (hi - lo) or 1.
+    rows   = 2. * np.arange(n)[:, None]
+    keys   = np.where(np.isfinite(vel), (vel - lo) / span, 1.5) + rows
+    query  = (grid - lo) / span + rows
+    j      = np.searchsorted(keys.ravel(), query.ravel(), side='right').reshape(n, -1) - np.arange(n)[:, None] * nchan
+    j      = np.clip(j, 1, np.maximum(nvalid, 2)[:, None] - 1)
+    first  = vel[:, :1]
+    last   = np.take_along_axis(vel, np.maximum(nvalid - 1, 0)[:, None], 1)
+    inside = (grid >= first) & (grid <= last) & (nvalid[:, None] > 1)
+    v0, v1 = np.take_along_axis(vel, j - 1, 1), np.take_along_axis(vel, j, 1)
+    s0, s1 = np.take_along_axis(spectra, j - 1, 1), np.take_along_axis(spectra, j, 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = s0 + (grid - v0) / (v1 - v0) * (s1 - s0)
+    return np.where(inside, out, np.nan)
+
+
+def stack_spectra(freqs, spectra, restfreq, z=None, vsys=None, grid=None, dv=None, noise=None, nboot=1000, seed=0):
+    """stack spectra on a common rest-frame velocity grid
+
+    Parameters
+    ----------
+    freqs, spectra : ndarray or list
+        (n, nchan) arrays, or lists of n arrays of different lengths. freqs in GHz (xdat of extract.py)
+    restfreq : float
+        the rest frequency of the line, GHz
+    z, vsys : float or ndarray
+        the redshift or the systemic velocity (km/s) of every spectrum
+    grid : ndarray
+        the velocity grid (km/s). Default: from the lowest to the highest velocity, in steps of dv
+    dv : float
+        the channel width of the default grid. Default: the widest channel of the spectra
+    noise : ndarray
+        the rms of every spectrum. Default: MAD of the regridded spectrum
+    nboot : int
+        the number of bootstrap resamples of the spectra (0: no error spectrum)
+
+    Returns
+    -------
+    grid, mean, median, error, count : ndarray
+        (ngrid,) each; count is the number of spectra in every channel
+    """
+    vel     = rest_velocity(freqs, restfreq, z, vsys)
+    spectra = _pack(spectra)
+    if grid is None:
+        dv   = dv or np.nanmax(np.nanmedian(np.abs(np.diff(vel, axis=1)), axis=1))
+        grid = np.arange(np.nanmin(vel), np.nanmax(vel) + dv / 2., dv)
+    grid    = np.asarray(grid, dtype=np.float64)
+    regrid_ = regrid(vel, spectra, grid)
+
+    sigma   = robust_std(regrid_, 'mad', axis=1) if noise is None else np.broadcast_to(noise, (len(regrid_),))
+    weight  = np.where(np.isfinite(sigma) & (sigma > 0), 1. / np.asarray(sigma)**2, 0.)
+    valid   = np.isfinite(regrid_)
+    values  = np.where(valid, regrid_, 0.)
+    count   = valid.sum(0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean   = (weight @ values) / (weight @ valid)
+        median = np.nanmedian(np.where(count > 0, regrid_, 0.), axis=0)
+        median = np.where(count > 0, median, np.nan)
+        error  = np.full(len(grid), np.nan)
+        if nboot:
+            # -- every resample as the number of times each spectrum is drawn: the bootstrap means are two products
+            n     = len(values)
+            draws = np.random.default_rng(seed).integers(n, size=(nboot, n))
+            times = np.bincount((draws + n * np.arange(nboot)[:, None]).ravel(), minlength=nboot * n).reshape(nboot, n)
+            boots = ((times * weight) @ values) / ((times * weight) @ valid)
+            error = np.nanstd(boots, axis=0)
+    return grid, mean, median, error, count
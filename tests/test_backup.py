@@ -0,0 +1,44 @@
+import os
+import numpy as np
+from astropy.io import fits
+import cache
+from backup import backup, same_content
+
+
+def write_cube(path, value=1.):
+    fits.writeto(str(path), np.full((4, 8, 8), value, dtype=np.float32), overwrite=True)
+    return str(path)
+
+
+def test_backup_is_skipped_when_identical(tmp_path, monkeypatch):
+    # -- regression: comparing the hashes wrote digests into the cache directory, also without cache=True
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    cube   = write_cube(tmp_path / 'cube.fits')
+    target = backup(cube)
+    assert target == cube+'.backup' and same_content(cube, target)
+    os.utime(cube, (1E9, 1E9))                                      # same content, another mtime
+    assert same_content(cube, target)
+    write_cube(cube, 2.)
+    assert not same_content(cube, target)
+    backup(cube)
+    assert fits.getdata(target)[0, 0, 0] == 2.
+    assert not os.path.exists(tmp_path / 'cache')
+
+
+def test_link_policy(tmp_path):
+    cube   = write_cube(tmp_path / 'cube.fits')
+    target = backup(cube, policy='link')
+    assert os.path.samefile(cube, target)
+    assert backup(cube, policy='none') is None
+
+
+def test_symlinked_cube_is_backed_up_by_its_data(tmp_path):
+    image = tmp_path / 'cube.image'
+    os.makedirs(image / 'logtable')
+    (image / 'table.f0').write_bytes(b'data')
+    (image / 'logtable' / 'table.f0').write_bytes(b'log')
+    os.symlink(str(image), str(tmp_path / 'link.image'))
+    target = backup(str(tmp_path / 'link.image'))
+    assert not os.path.islink(target)
+    assert (tmp_path / 'link.image.backup' / 'table.f0').read_bytes() == b'data'
+    assert same_content(str(image), target)
@@ -0,0 +1,69 @@
+import os
+import multiprocessing
+import numpy as np
+from astropy.io import fits
+import cache
+from cache import cache_key, entries, file_digest, lookup, prune, read_meta, store
+
+
+def write_cube(path, value=1.):
+    fits.writeto(str(path), np.full((4, 8, 8), value, dtype=np.float32), overwrite=True)
+    return str(path)
+
+
+def test_key_follows_the_content(tmp_path):
+    store_dir = str(tmp_path / 'cache')
+    a = write_cube(tmp_path / 'a.fits')
+    b = write_cube(tmp_path / 'b.fits')
+    key = cache_key(a, store_dir, Npix=20)
+    assert cache_key(b, store_dir, Npix=20) == key                # same content, another name
+    assert cache_key(a, store_dir, Npix=10) != key
+    write_cube(a, 2.)
+    assert cache_key(a, store_dir, Npix=20) != key                # the content has changed
+
+
+def test_digests_are_remembered(tmp_path):
+    store_dir = str(tmp_path / 'cache')
+    a, b = write_cube(tmp_path / 'a.fits'), write_cube(tmp_path / 'b.fits', 3.)
+    digests = [file_digest(a, store_dir), file_digest(b, store_dir)]
+    assert len(os.listdir(os.path.join(store_dir, cache.DIGESTS))) == 2
+    assert [file_digest(a, store_dir), file_digest(b, store_dir)] == digests
+    assert entries(store_dir) == []
+
+
+def test_store_and_lookup(tmp_path):
+    store_dir = str(tmp_path / 'cache')
+    product   = write_cube(tmp_path / 'file_wo_dwarfs.fits')
+    assert lookup('k1', store_dir) is None
+    entry = store('k1', [product], meta={'cutoff': 0.5}, cache_dir=store_dir)
+    assert lookup('k1', store_dir) == entry
+    assert read_meta(entry)['cutoff'] == 0.5
+    assert np.array_equal(fits.getdata(os.path.join(entry, 'file_wo_dwarfs.fits')), fits.getdata(product))
+
+
+def test_prune_keeps_the_recent_entries(tmp_path):
+    store_dir = str(tmp_path / 'cache')
+    product   = write_cube(tmp_path / 'file_wo_dwarfs.fits')
+    for key in ('k1', 'k2', 'k3'):
+        store(key, [product], cache_dir=store_dir)
+    size = max(e[1] for e in entries(store_dir))                   # the meta data may differ by a few bytes
+    lookup('k1', store_dir)                                         # k1 is used again: k2 is the oldest
+    os.utime(os.path.join(store_dir, 'k2'), (0, 0))
+    prune(2 * size, store_dir)
+    assert sorted(key for key, size, used in entries(store_dir)) == ['k1', 'k3']
+
+
+def _store(args):
+    key, product, store_dir = args
+    return store(key, [product], meta={'pid': os.getpid()}, cache_dir=store_dir)
+
+
+def test_concurrent_stores(tmp_path):
+    # -- regression: a run storing a key that another run had just stored failed, or left its temporary entry
+    store_dir = str(tmp_path / 'cache')
+    product   = write_cube(tmp_path / 'file_wo_dwarfs.fits')
+    with multiprocessing.Pool(8) as pool:
+        results = pool.map(_store, [('k1', product, store_dir)] * 32, chunksize=1)
+    assert set(results) == {os.path.join(store_dir, 'k1')}
+    assert sorted(os.listdir(store_dir)) == ['k1']
+    assert sorted(os.listdir(results[0])) == ['file_wo_dwarfs.fits', 'meta.json']
@@ -0,0 +1,30 @@
+import numpy as np
+from contsub import fit_continuum, linefree_channels, subtract_continuum
+
+
+def test_fit_matches_polyfit():
+    rng   = np.random.default_rng(0)
+    nchan = 120
+    free  = linefree_channels('0:0~39;80~119', nchan)
+    data  = rng.normal(size=(nchan, 6, 5))
+    data[45:70] += 10.                                      # a line, outside the fit
+    data[3, 2, 1] = data[90, 0, 0] = np.nan                 # blanked line-free channels
+    data[:, 4, 4] = np.nan                                  # a blank pixel
+    cont  = fit_continuum(data, free, order=2)
+    xs    = np.linspace(-1., 1., nchan)
+    for y in range(6):
+        for x in range(5):
+            good = free & np.isfinite(data[:, y, x])
+            if good.sum() < 3:
+                assert np.isnan(cont[:, y, x]).all()
+                continue
+            coef = np.polyfit(xs[good], data[good, y, x], 2)
+            assert np.allclose(cont[:, y, x], np.polyval(coef, xs))
+
+
+def test_tiles_match_one_fit():
+    rng  = np.random.default_rng(1)
+    data = rng.normal(size=(64, 17, 13)) + np.linspace(0, 5, 64)[:, None, None]
+    free = linefree_channels('10~30;40~60', 64)
+    out  = subtract_continuum(data, free, order=1, memory_budget=64 * 8 * 4 * 20)
+    assert np.allclose(out, data - fit_continuum(data, free, order=1), atol=1E-5)
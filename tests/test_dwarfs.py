@@ -0,0 +1,51 @@
+import numpy as np
+from astropy.io import fits
+from scipy      import ndimage
+from dwarfs     import STRUCTURE, drop_dwarfs, flagdwarfs_chunked, label_chunked, slab_planes
+
+
+# -- adjacent channels linked, so that the components cross the slab boundaries
+LINKED = ndimage.generate_binary_structure(3, 1).astype('uint8')
+
+
+def blobs(shape=(24, 32, 32), seed=0):
+    """a cube of connected positive patches of all sizes, on a negative background"""
+    rng = np.random.default_rng(seed)
+    return (ndimage.gaussian_filter(rng.normal(size=shape), 1.2) - 0.05).astype(np.float32)
+
+
+def reference(data, Npix, structure):
+    """drop_dwarfs() on a copy, labelled in one piece by ndimage.label"""
+    out = data.copy()
+    drop_dwarfs(out, Npix, structure)
+    return out
+
+
+def test_slab_components_are_merged(tmp_path):
+    data = blobs()
+    fits.writeto(tmp_path / 'cube.fits', data)
+    nplanes, offsets, roots, sizes = label_chunked(str(tmp_path / 'cube.fits'), LINKED, memory_budget=3 * 32 * 32 * 10)
+    assert nplanes == 3 == slab_planes(data.shape, 4, 3 * 32 * 32 * 10)
+
+    labels, nb = ndimage.label(data > 0, structure=LINKED)
+    merged = np.sort(sizes[np.unique(roots[1:])])
+    assert np.array_equal(merged, np.sort(np.bincount(labels.ravel())[1:]))
+
+
+def test_chunked_matches_in_memory(tmp_path):
+    data = blobs(seed=1)
+    fits.writeto(tmp_path / 'cube.fits', data)
+    for structure in (STRUCTURE, LINKED):
+        flagdwarfs_chunked(str(tmp_path / 'cube.fits'), 30, outfile=str(tmp_path / 'flagged.fits'),
+                           structure=structure, memory_budget=4 * 32 * 32 * 10)
+        assert np.array_equal(fits.getdata(tmp_path / 'flagged.fits'), reference(data, 30, structure), equal_nan=True)
+
+
+def test_parallel_matches_serial():
+    data = blobs(seed=2)
+    for structure in (STRUCTURE, LINKED):
+        serial, parallel = data.copy(), data.copy()
+        nkeep, ndrop = drop_dwarfs(serial, 30, structure)
+        assert nkeep > 0 and ndrop > 0
+        assert drop_dwarfs(parallel, 30, structure, workers=3) == (nkeep, ndrop)
+        assert np.array_equal(serial, parallel, equal_nan=True)
@@ -0,0 +1,51 @@
+import numpy as np
+from astropy.io import fits
+from fluxes import convert_spectra, frequency_axis, to_jy, to_tb
+
+
+def write_cube(path, nchan=6):
+    # -- 0.1 arcsec pixels, 1 GHz channels from 100 GHz, a beam that shrinks with frequency
+    header = fits.Header()
+    for key, value in dict(CTYPE1='RA---SIN', CTYPE2='DEC--SIN', CTYPE3='FREQ', CDELT1=-0.1/3600, CDELT2=0.1/3600,
+                           CDELT3=1E9, CRVAL1=10., CRVAL2=-5., CRVAL3=100E9, CRPIX1=1, CRPIX2=1, CRPIX3=1, CUNIT3='Hz').items():
+        header[key] = value
+    bmaj  = np.linspace(1.2, 0.7, nchan)
+    beams = fits.BinTableHDU.from_columns([
+        fits.Column(name='BMAJ', format='E', unit='arcsec', array=bmaj),
+        fits.Column(name='BMIN', format='E', unit='arcsec', array=0.6 * bmaj),
+        fits.Column(name='BPA',  format='E', unit='deg',    array=np.full(nchan, 30.)),
+        fits.Column(name='CHAN', format='J', array=np.arange(nchan)),
+        fits.Column(name='POL',  format='J', array=np.zeros(nchan, dtype=int))], name='BEAMS')
+    fits.HDUList([fits.PrimaryHDU(np.zeros((nchan, 16, 16), dtype=np.float32), header), beams]).writeto(str(path))
+    return str(path), bmaj, 0.6 * bmaj
+
+
+def test_per_channel_conversion(tmp_path):
+    filename, bmaj, bmin = write_cube(tmp_path / 'cube.fits')
+    spectra = np.random.default_rng(2).uniform(0.1, 1., (3, 6))
+    freq, flux, tb = convert_spectra(filename, spectra, diameter=[0.6, 1., 2.])
+    assert np.allclose(freq, 100. + np.arange(6))
+    beampix = np.pi * bmaj * bmin / (4 * np.log(2)) / 0.1**2
+    aperpix = np.pi * (np.array([0.6, 1., 2.]) / 2.)**2 / 0.1**2
+    assert np.allclose(flux, spectra * aperpix[:, None] / beampix, rtol=1E-6)
+    assert np.allclose(tb, 1.222E6 * spectra / (freq**2 * bmaj * bmin), rtol=1E-6)
+    # -- one spectrum, one aperture
+    freq, flux1, tb1 = convert_spectra(filename, spectra[1], diameter=1.)
+    assert np.allclose(flux1, flux[1]) and np.allclose(tb1, tb[1])
+
+
+def test_apertures_in_beams():
+    # -- 1 Jy/beam in an aperture of one beam is 1 Jy
+    beampix = np.array([10., 20., 40.])
+    assert np.allclose(to_jy(np.ones((2, 3)), beampix, [10., 20.]), [[1., .5, .25], [2., 1., .5]])
+    assert np.isclose(to_tb(1., 1E9, 1., 1.), 1.222E6)
+
+
+def test_frequency_of_a_velocity_axis(tmp_path):
+    header = fits.Header()
+    for key, value in dict(CTYPE1='RA---SIN', CTYPE2='DEC--SIN', CTYPE3='VRAD', CDELT1=-0.1/3600, CDELT2=0.1/3600,
+                           CDELT3=1E3, CRVAL3=0., CRPIX3=1, CUNIT3='m/s', RESTFRQ=230E9, BMAJ=1/3600, BMIN=1/3600).items():
+        header[key] = value
+    fits.writeto(str(tmp_path / 'vel.fits'), np.zeros((4, 8, 8), dtype=np.float32), header)
+    freq = frequency_axis(str(tmp_path / 'vel.fits'))
+    assert np.allclose(freq, 230E9 * (1 - np.arange(4) * 1E3 / 299792458.))
@@ -0,0 +1,28 @@
+import numpy as np
+from linefit import FWHM, fit_gaussians, gaussians
+
+
+def test_batched_fits_converge():
+    rng   = np.random.default_rng(0)
+    x     = np.linspace(230.0, 230.5, 200)
+    nspec = 300
+    true  = np.column_stack([rng.uniform(1., 5., nspec), rng.uniform(230.15, 230.35, nspec), rng.uniform(0.01, 0.03, nspec)])
+    spectra = gaussians(x, true) + rng.normal(0, 0.05, (nspec, len(x)))
+    spectra[:, 5:9] = np.nan                                # blanked channels are left out
+    fits  = fit_gaussians(x, spectra, noise=0.05)
+    assert fits['converged'].all()
+    for name, value in (('amplitude', true[:, 0]), ('centre', true[:, 1]), ('fwhm', true[:, 2] * FWHM)):
+        pull = (fits[name][:, 0] - value) / fits[name+'_err'][:, 0]
+        assert np.abs(pull).max() < 5
+        assert 0.7 < np.std(pull) < 1.3
+    assert abs(np.mean(fits['chi2']) / (len(x) - 4 - 3) - 1.) < 0.05
+
+
+def test_two_components():
+    x      = np.linspace(-10, 10, 400)
+    true   = np.array([3., -2., 0.8, 1.5, 3., 1.2])
+    fits   = fit_gaussians(x, gaussians(x, true), ncomp=2)
+    order  = np.argsort(fits['centre'][0])
+    assert np.allclose(fits['amplitude'][0][order], [3., 1.5], atol=1E-6)
+    assert np.allclose(fits['centre'][0][order], [-2., 3.], atol=1E-6)
+    assert np.allclose(fits['fwhm'][0][order], np.array([0.8, 1.2]) * FWHM, atol=1E-6)
@@ -0,0 +1,27 @@
+import numpy as np
+from linefree import channel_ranges, clean_mask, find_linefree, fitspw_string, line_runs
+
+
+def test_line_runs():
+    dropped = np.array([0, 1, 0, 1, 1, 0, 1, 1, 1, 0, 0, 1], dtype=bool)
+    assert np.array_equal(line_runs(dropped, 2)[0], [0, 0, 0, 1, 1, 0, 1, 1, 1, 0, 0, 0])
+    assert np.array_equal(line_runs(dropped, 3)[0], [0, 0, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0])
+    assert np.array_equal(line_runs(dropped, 1)[0], dropped)
+
+
+def test_clean_mask():
+    free = np.ones(40, dtype=bool)
+    free[20:23] = False                                     # a line
+    free[8] = False                                         # leaves a short run 1~5 after padding and the edge
+    mask = clean_mask(free, pad=2, minwidth=6, edge=1)
+    assert channel_ranges(mask) == [(11, 17), (25, 38)]
+    assert fitspw_string([mask], [3]) == '3:11~17;25~38'
+
+
+def test_find_linefree_spectra():
+    rng     = np.random.default_rng(0)
+    spectra = rng.normal(size=(20, 300)) + np.linspace(0, 2, 300)
+    spectra[:, 140:160] += 4.
+    free    = find_linefree(spectra, pad=2, minwidth=5)
+    assert not free[138:162].any()
+    assert free[:130].mean() > 0.9 and free[170:].mean() > 0.9
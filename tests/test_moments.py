@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+from moments    import moments, moments_fits, parse_chans, velocity_axis
+
+
+def line_cube(shape=(40, 12, 10), seed=0):
+    """a Gaussian line of varying centre and width on noise, with blanked voxels"""
+    rng  = np.random.default_rng(seed)
+    velo = np.linspace(-200., 190., shape[0])
+    cen  = rng.uniform(-50, 50, shape[1:])
+    wid  = rng.uniform(20, 60, shape[1:])
+    cube = 3. * np.exp(-0.5 * ((velo[:, None, None] - cen) / wid)**2) + rng.normal(0, 0.2, shape)
+    cube[rng.uniform(size=shape) < 0.05] = np.nan
+    return cube, velo
+
+
+def direct_moments(cube, velo, select, excludepix):
+    """the moments of immoments, summed over the selected channels in one go"""
+    data = np.where(np.isfinite(cube), cube, 0.)[select]
+    v    = velo[select][:, None, None]
+    dv   = np.abs(np.gradient(velo))[select][:, None, None]
+    mom0 = (data * dv).sum(0)
+    used = np.where((data >= excludepix[0]) & (data <= excludepix[1]), 0., data)
+    mom1 = (used * v).sum(0) / used.sum(0)
+    mom2 = np.sqrt((used * (v - mom1)**2).sum(0) / used.sum(0))
+    return mom0, mom1, mom2
+
+
+def frequency_header(nchan, restfrq=True):
+    header = fits.Header()
+    for key, value in (('NAXIS', 3), ('NAXIS1', 10), ('NAXIS2', 12), ('NAXIS3', nchan),
+                       ('CTYPE1', 'RA---SIN'), ('CTYPE2', 'DEC--SIN'), ('CTYPE3', 'FREQ'),
+                       ('CRVAL3', 230.538E9), ('CDELT3', -1E6), ('CRPIX3', 1.), ('CUNIT3', 'Hz')):
+        header[key] = value
+    if restfrq:
+        header['RESTFRQ'] = 230.538E9
+    return header
+
+
+def test_moments_match_direct_sums():
+    cube, velo = line_cube()
+    select = parse_chans('5~30', len(velo))
+    for got, ref in zip(moments(cube, velo, '5~30'), direct_moments(cube, velo, select, [-100., 0.])):
+        assert np.allclose(got, ref)
+
+
+def test_parse_chans():
+    assert np.flatnonzero(parse_chans('2~4;7', 10)).tolist() == [2, 3, 4, 7]
+    assert parse_chans('', 10).all()
+    for chans in ('20~30', '12', '-1'):
+        with pytest.raises(ValueError, match="'"+chans+"'"):
+            parse_chans(chans, 10)
+
+
+def test_velocity_axis():
+    velo = velocity_axis(frequency_header(5))
+    assert np.allclose(velo, 299792.458 * np.arange(5) * 1E6 / 230.538E9)
+    with pytest.raises(ValueError, match='rest frequency'):
+        velocity_axis(frequency_header(5, restfrq=False))
+
+
+def test_moments_fits(tmp_path):
+    cube, velo = line_cube()
+    header     = frequency_header(len(velo))
+    fits.writeto(tmp_path / 'cube.fits', cube.astype(np.float32), header)
+    names = moments_fits(str(tmp_path / 'cube.fits'), '0~39')
+    ref   = moments(cube.astype(np.float32), velocity_axis(header), '0~39')
+    for name, value, unit in zip(names, ref, ('Jy/beam.km/s', 'km/s', 'km/s')):
+        assert np.allclose(fits.getdata(name), value, equal_nan=True, rtol=1E-5)
+        assert fits.getheader(name)['BUNIT'] == unit
+
+
+def test_streamed_blocks(tmp_path):
+    cube, velo = line_cube(seed=1)
+    keep = cube.copy()
+    ref  = moments(cube, velo, '3~35', block=1000)
+    assert np.array_equal(cube, keep, equal_nan=True)               # the input cube is not modified
+    memmap = np.lib.format.open_memmap(str(tmp_path / 'cube.npy'), mode='w+', dtype=np.float64, shape=cube.shape)
+    memmap[...] = cube
+    for block in (1, 4, 7):
+        for got, value in zip(moments(memmap, velo, '3~35', block=block), ref):
+            assert np.allclose(got, value, equal_nan=True)
+    # -- non-contiguous selections are read with fancy indexing
+    for got, value in zip(moments(cube, velo, '3~9;20;30~35', block=4), moments(cube, velo, '3~9;20;30~35', block=1000)):
+        assert np.allclose(got, value, equal_nan=True)
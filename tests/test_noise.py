@@ -0,0 +1,41 @@
+import numpy as np
+from noise     import estimate_noise, sample_voxels
+from smoothing import smooth_and_mask
+
+
+def primary_beam_cube(shape=(24, 160, 160), radius=50, seed=1):
+    """unit Gaussian noise, blanked (NaN) outside a circular primary beam, as the cubes of tclean"""
+    rng  = np.random.default_rng(seed)
+    cube = rng.normal(0, 1, shape)
+    y, x = np.mgrid[:shape[1], :shape[2]]
+    r2   = (x - shape[2] // 2)**2 + (y - shape[1] // 2)**2
+    cube[:, r2 > radius**2] = np.nan
+    return cube, r2
+
+
+def test_sample_skips_the_blanked_voxels():
+    cube, r2 = primary_beam_cube()
+    sample   = sample_voxels(cube, 5000)
+    assert len(sample) > 0 and np.isfinite(sample).all()
+    sigma, interval = estimate_noise(cube, nsample=5000)
+    assert abs(sigma - 1.) < 0.05
+    assert interval[0] < sigma < interval[1]
+
+
+def test_masked_cube_noise():
+    # -- regression: the blanked voxels were smoothed as zeros, and the noise came out ~7x too low
+    cube, r2 = primary_beam_cube()
+    sm_sm, cutoff, mask = smooth_and_mask(cube, (0.5, 0.5, 0.), (-0.1, 0.1), factor=1.5, nsigma=3)
+    assert not np.isfinite(sm_sm[:, r2 > 50**2]).any()
+    assert not mask[:, r2 > 50**2].any()
+    truth = np.nanstd(sm_sm[1:-1][:, r2 < 40**2])
+    assert abs(cutoff / 3. / truth - 1.) < 0.1
+
+
+def test_sample_of_a_mostly_blank_cube():
+    # -- regression: too few finite voxels in the random draws made the redraws loop forever
+    for radius in (90, 20, 0):
+        cube, r2 = primary_beam_cube(radius=radius)
+        sample   = sample_voxels(cube)
+        assert np.isfinite(sample).all()
+        assert len(sample) >= min(np.isfinite(cube).sum(), 90000)
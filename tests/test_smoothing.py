@@ -0,0 +1,48 @@
+import numpy as np
+from smoothing import beam_covariance, beam_groups, convolve_planes, convolve_to_beam, hanning_smooth, matching_kernel
+
+
+CDELT = (-0.1, 0.1)
+
+
+def gaussian_image(beam, shape=(96, 96)):
+    """a point source of 1 Jy at the centre, seen with beam (bmaj, bmin, bpa): 1 Jy/beam at the peak"""
+    inv  = np.linalg.inv(beam_covariance(*(tuple(beam) + CDELT)))
+    y, x = np.mgrid[:shape[0], :shape[1]] - np.array(shape)[:, None, None] // 2
+    return np.exp(-0.5 * (inv[0, 0] * x * x + 2 * inv[0, 1] * x * y + inv[1, 1] * y * y))
+
+
+def test_blanked_voxels_stay_blanked():
+    # -- regression: the blanked voxels were convolved as zeros, and came out finite and biased low
+    cube = np.ones((3, 64, 64))
+    y, x = np.mgrid[:64, :64]
+    hole = (x - 32)**2 + (y - 32)**2 < 10**2
+    cube[:, hole] = np.nan
+    kernel, scale = matching_kernel((0.5, 0.5, 0.), (0.75, 0.75, 0.), CDELT)
+    out  = convolve_planes(cube, kernel, scale)
+    assert np.isnan(out[:, hole]).all()
+    # -- a flat field stays flat up to the edge of the hole (normalised convolution)
+    assert np.allclose(out[:, ~hole], scale, rtol=1E-5)
+
+
+def test_hanning():
+    spec = np.zeros((9, 1, 1))
+    spec[4] = 1.
+    assert np.allclose(hanning_smooth(spec)[3:6, 0, 0], [0.25, 0.5, 0.25])
+
+
+def test_perplane_beams_to_the_target():
+    bmaj = np.array([0.5, 0.5, 0.6, 0.7, 0.55])
+    bmin = np.array([0.4, 0.4, 0.35, 0.5, 0.3])
+    bpa  = np.array([30., 30., -20., 80., 0.])
+    cube = np.array([gaussian_image(beam) for beam in zip(bmaj, bmin, bpa)])
+    out, target = convolve_to_beam(cube, (bmaj, bmin, bpa), CDELT, factor=1.5)
+    assert np.isclose(target[0], 1.5 * bmaj.mean()) and target[0] == target[1]
+    # -- every channel is the point source seen with the target beam: 1 Jy/beam at the peak
+    assert np.allclose(out, gaussian_image(target)[None], atol=2E-3)
+    assert np.allclose(out[:, 48, 48], 1., atol=2E-3)
+
+
+def test_beam_groups():
+    groups = beam_groups(np.array([0.5, 0.5, 0.5001, 0.6]), np.array([0.4, 0.4, 0.4, 0.4]), np.array([0., 0., 0., 0.]))
+    assert sorted(list(chans) for beam, chans in groups) == [[0, 1, 2], [3]]
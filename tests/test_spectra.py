@@ -0,0 +1,44 @@
+import numpy as np
+from astropy.io  import fits
+from astropy.wcs import WCS
+from spectra import aperture_weights, grid_spectra
+
+
+def test_exact_aperture_area():
+    rng    = np.random.default_rng(0)
+    xc, yc = 20 + rng.uniform(-0.5, 0.5, 50), 20 + rng.uniform(-0.5, 0.5, 50)
+    for radius in (0.7, 2.3, 5.):
+        W = aperture_weights(xc, yc, radius, (40, 40))
+        assert np.allclose(np.asarray(W.sum(1)).ravel(), np.pi * radius**2, rtol=1E-9)
+        assert W.max() <= 1.
+
+
+def test_exact_ellipse_area():
+    W = aperture_weights([15.2, 14.7], [15.4, 16.], 4., (32, 32), minor=1.5, theta=30.)
+    assert np.allclose(np.asarray(W.sum(1)).ravel(), np.pi * 4. * 1.5, rtol=1E-9)
+
+
+def test_aperture_at_the_edge():
+    # -- the pixels outside the image are left out: a quarter of the circle at the corner pixel
+    W = aperture_weights([-0.5], [-0.5], 3., (20, 20))
+    assert np.isclose(W.sum(), np.pi * 9. / 4.)
+
+
+def test_grid_of_boxes(tmp_path):
+    # -- 0.1 arcsec pixels: boxes of 2, 3 and 4 pixels, the even ones centred between pixels
+    data = np.random.default_rng(1).normal(size=(3, 20, 24)).astype(np.float32)
+    data[1, 5, 7] = np.nan
+    header = fits.Header()
+    for key, value in dict(CTYPE1='RA---SIN', CTYPE2='DEC--SIN', CTYPE3='FREQ', CDELT1=-0.1/3600, CDELT2=0.1/3600,
+                           CDELT3=1E6, CRVAL1=10., CRVAL2=-5., CRVAL3=1E11, CRPIX1=1, CRPIX2=1, CRPIX3=1, CUNIT3='Hz').items():
+        header[key] = value
+    fits.writeto(str(tmp_path / 'grid.fits'), data, header)
+    for size, side in ((0.2, 2), (0.3, 3), (0.4, 4)):
+        axis, centres, spectra = grid_spectra(str(tmp_path / 'grid.fits'), 0.5, size)
+        half, lo = int(np.floor(side / 2. * (1 + 1E-9))), side // 2
+        for gy, y in enumerate(range(half, 20 - half, 5)):
+            for gx, x in enumerate(range(half, 24 - half, 5)):
+                box = data[:, y-lo:y-lo+side, x-lo:x-lo+side]
+                assert np.allclose(spectra[gy, gx], np.nanmean(box, axis=(1, 2)), atol=1E-6)
+        xc, yc = WCS(header).celestial.world_to_pixel(centres[0, 0])
+        assert np.allclose((xc, yc), half - lo + (side - 1) / 2.)
@@ -0,0 +1,22 @@
+import numpy as np
+from stacking import regrid
+
+
+def test_regrid_matches_interp():
+    rng   = np.random.default_rng(0)
+    vel   = [np.sort(rng.uniform(-300, 300, n)) for n in (50, 80, 64)]
+    vel[1] = vel[1][::-1]                                  # a descending axis
+    spec  = [rng.normal(size=len(v)) for v in vel]
+    grid  = np.linspace(-350, 350, 141)
+    out   = regrid(vel, spec, grid)
+    for i, (v, s) in enumerate(zip(vel, spec)):
+        order  = np.argsort(v)
+        inside = (grid >= v.min()) & (grid <= v.max())
+        assert np.allclose(out[i, inside], np.interp(grid[inside], v[order], s[order]))
+        assert np.isnan(out[i, ~inside]).all()
+
+
+def test_regrid_single_channel_is_blank():
+    out = regrid([[10.], [0., 20.]], [[1.], [0., 2.]], [5., 10.])
+    assert np.isnan(out[0]).all()
+    assert np.allclose(out[1], [0.5, 1.])
@@ -0,0 +1,45 @@
+import os
+import numpy as np
+from astropy.io import fits
+import cube
+from tiles import SpectralTiles, build_tiles, tiles_current
+
+
+def write_cube(path, shape=(20, 45, 70)):
+    data = np.random.default_rng(3).normal(size=shape).astype(np.float32)
+    header = fits.Header()
+    header['CTYPE1'], header['CTYPE2'], header['CTYPE3'] = 'RA---SIN', 'DEC--SIN', 'FREQ'
+    header['CDELT1'], header['CDELT2'], header['CDELT3'] = -1E-4, 1E-4, 1E6
+    header['CRVAL3'], header['CUNIT3'] = 230E9, 'Hz'
+    fits.writeto(str(path), data, header, overwrite=True)
+    return str(path), data
+
+
+def test_tiles_match_the_cube(tmp_path):
+    filename, data = write_cube(tmp_path / 'cube.fits')
+    st = SpectralTiles(filename, tile=16)
+    assert st.shape == data.shape
+    assert np.array_equal(st.spectrum(65, 40), data[:, 40, 65])
+    x, y = np.array([0, 17, 69, 33]), np.array([0, 44, 3, 16])
+    assert np.array_equal(st.spectra(x, y), data[:, y, x].T)
+    assert np.array_equal(st.region(slice(10, 37), slice(5, 60)), data[:, 10:37, 5:60])
+    # -- rebuilt when the cube changes
+    assert tiles_current(filename) is not None
+    os.utime(filename, (1E9, 1E9))
+    assert tiles_current(filename) is None
+
+
+def test_reads_stay_within_the_memory_budget(tmp_path, monkeypatch):
+    filename, data = write_cube(tmp_path / 'cube.fits')
+    read = []
+    getitem = cube.Cube.__getitem__
+    def record(self, index):
+        block = getitem(self, index)
+        read.append(block.nbytes)
+        return block
+    monkeypatch.setattr(cube.Cube, '__getitem__', record)
+    budget = 16 * 70 * 4 * 2 * 3                    # three channels of a band of 16 rows
+    directory = build_tiles(filename, tile=16, memory_budget=budget)
+    assert max(read) <= budget // 2 and len(read) == 3 * 7
+    st = SpectralTiles(filename, directory)
+    assert np.array_equal(st.region(slice(None), slice(None)), data)
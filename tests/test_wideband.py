@@ -0,0 +1,38 @@
+import numpy as np
+from wideband import stitch
+
+
+def segments():
+    # -- two windows of the same flat 1 Jy line-free spectrum, overlapping between 104 and 106
+    rng = np.random.default_rng(4)
+    return [(np.arange(100., 107.), {'flux': 1. + 0.01 * rng.normal(size=7)}),
+            (np.arange(104., 111.), {'flux': 1. + 0.01 * rng.normal(size=7)})]
+
+
+def test_inputs_are_kept():
+    # -- regression: 'average' wrote the averaged channels into the spectrum of the first window
+    segs = segments()
+    copy = [(freq.copy(), {'flux': cols['flux'].copy()}) for freq, cols in segs]
+    for overlap in ('average', 'cut'):
+        stitch(segs, overlap)
+        for (freq, cols), (freq0, cols0) in zip(segs, copy):
+            assert np.array_equal(freq, freq0) and np.array_equal(cols['flux'], cols0['flux'])
+
+
+def test_average_overlap():
+    segs = segments()
+    freq, cols = stitch(segs[::-1], 'average')
+    assert np.array_equal(freq, np.arange(100., 111.))
+    a, b = segs[0][1]['flux'], segs[1][1]['flux']
+    assert np.array_equal(cols['flux'][:4], a[:4]) and np.array_equal(cols['flux'][7:], b[3:])
+    # -- the overlap is between the two windows
+    assert np.all(cols['flux'][4:7] >= np.minimum(a[4:], b[:3]) - 1E-12)
+    assert np.all(cols['flux'][4:7] <= np.maximum(a[4:], b[:3]) + 1E-12)
+
+
+def test_cut_overlap():
+    segs = segments()
+    freq, cols = stitch(segs, 'cut')
+    assert np.array_equal(freq, np.arange(100., 111.))
+    a, b = segs[0][1]['flux'], segs[1][1]['flux']
+    assert np.array_equal(cols['flux'], np.concatenate([a[:6], b[2:]]))
@@ -0,0 +1,149 @@
+# Spectral-contiguous copy of a cube, for fast spectrum extraction.
+#
+# FITS cubes (and the Cube of cube.py) keep the channel as the slowest axis, so one spectrum
+# touches every channel plane. Here the cube is transposed once into tiles of tile x tile
+# pixels, each a .npy file of shape (y, x, chan): the spectrum of a pixel is contiguous on
+# disk, and a spectrum or an aperture is a few sequential reads of memory-mapped tiles.
+#
+# The tiles are kept next to the cube in <cube>.tiles/, with the size and mtime of the cube
+# in meta.json. They are rebuilt when the cube changes, and reused otherwise.
+#
+# Usage:
+#   from tiles import SpectralTiles
+#   st   = SpectralTiles('cube.fits')        # builds cube.fits.tiles/ the first time
+#   spec = st.spectrum(120, 100)             # (chan,) at x=120, y=100
+#   box  = st.region(slice(90, 110), slice(110, 130))   # (chan, y, x)
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import os
+import json
+import shutil
+import numpy as np
+from cube  import Cube
+from cache import files_of, stamp
+
+
+TILE = 32
+
+
+def _tile_name(directory, iy, ix):
+    return os.path.join(directory, 'tile_'+str(iy)+'_'+str(ix)+'.npy')
+
+
+def build_tiles(filename, directory=None, tile=TILE, memory_budget=2**30):
+    """transpose a cube into (y, x, chan) tiles of tile x tile pixels, in one pass over the cube
+
+    The cube is read in bands of `tile` rows, and every band in blocks of channels so that
+    a block stays within memory_budget (bytes). The tiles are memory-mapped .npy files, and
+    every block is written into them as it is read, so only one block is held in memory.
+
+    Returns
+    -------
+    the tile directory
+    """
+    directory = directory or filename.rstrip('/')+'.tiles'
+    tmp = directory+'.'+str(os.getpid())+'.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    with Cube(filename) as cube:
+        nz, ny, nx = cube.shape
+        dtype = cube.data.dtype
+        block = int(max(1, min(nz, memory_budget // (tile * nx * dtype.itemsize * 2))))
+        for iy, y0 in enumerate(range(0, ny, tile)):
+            y1    = min(ny, y0 + tile)
+            tiles = [np.lib.format.open_memmap(_tile_name(tmp, iy, ix), mode='w+', dtype=dtype,
+                                               shape=(y1 - y0, min(nx, x0 + tile) - x0, nz))
+                     for ix, x0 in enumerate(range(0, nx, tile))]
+            for z0 in range(0, nz, block):
+                band = cube[z0:z0+block, y0:y1, :].transpose(1, 2, 0)
+                for ix, x0 in enumerate(range(0, nx, tile)):
+                    tiles[ix][:, :, z0:z0+block] = band[:, x0:x0+tile]
+                del band
+            for t in tiles:
+                t.flush()
+            del tiles
+    size, mtime = stamp(files_of(os.path.realpath(filename)))
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump({'shape': [nz, ny, nx], 'tile': tile, 'dtype': dtype.str, 'size': size, 'mtime': mtime}, f)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp, directory)
+    return directory
+
+
+def tiles_current(filename, directory=None):
+    """the meta data of the tiles of filename, or None if they are missing or older than the cube"""
+    directory = directory or filename.rstrip('/')+'.tiles'
+    meta_file = os.path.join(directory, 'meta.json')
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        meta = json.load(f)
+    size, mtime = stamp(files_of(os.path.realpath(filename)))
+    if (meta['size'], meta['mtime']) != (size, mtime):
+        return None
+    return meta
+
+
+class SpectralTiles(object):
+    """spectra of a cube read from its spectral-contiguous tiles, built on first use
+
+    Parameters
+    ----------
+    filename : str
+        the FITS cube or CASA image
+    directory : str
+        the tile directory. Default: filename+'.tiles'
+    tile : int
+        the tile size in pixels, used when the tiles are (re)built
+    memory_budget : int
+        bytes, see build_tiles()
+    """
+
+    def __init__(self, filename, directory=None, tile=TILE, memory_budget=2**30):
+        self.directory = directory or filename.rstrip('/')+'.tiles'
+        meta = tiles_current(filename, self.directory)
+        if meta is None:
+            print("Building the spectral tiles of ", filename)
+            build_tiles(filename, self.directory, tile, memory_budget)
+            meta = tiles_current(filename, self.directory)
+        self.shape  = tuple(meta['shape'])
+        self.tile   = meta['tile']
+        self.dtype  = np.dtype(meta['dtype'])
+        self._tiles = {}
+
+    def _open(self, iy, ix):
+        if (iy, ix) not in self._tiles:
+            self._tiles[(iy, ix)] = np.load(_tile_name(self.directory, iy, ix), mmap_mode='r')
+        return self._tiles[(iy, ix)]
+
+    def spectrum(self, x, y):
+        """(chan,) spectrum of pixel (x, y)"""
+        t = self.tile
+        return np.array(self._open(y // t, x // t)[y % t, x % t])
+
+    def spectra(self, x, y):
+        """(n, chan) spectra of the pixels (x[i], y[i]), read tile by tile"""
+        x, y = np.asarray(x, dtype=int), np.asarray(y, dtype=int)
+        out  = np.empty((len(x), self.shape[0]), dtype=self.dtype)
+        t    = self.tile
+        key  = (y // t) * (self.shape[2] // t + 1) + x // t
+        for k in np.unique(key):
+            sel = np.flatnonzero(key == k)
+            out[sel] = self._open(y[sel[0]] // t, x[sel[0]] // t)[y[sel] % t, x[sel] % t]
+        return out
+
+    def region(self, ys, xs):
+        """(chan, y, x) cube of the pixels in the slices ys, xs"""
+        y0, y1, _ = ys.indices(self.shape[1])
+        x0, x1, _ = xs.indices(self.shape[2])
+        out = np.empty((y1 - y0, x1 - x0, self.shape[0]), dtype=self.dtype)
+        t   = self.tile
+        for iy in range(y0 // t, (y1 - 1) // t + 1):
+            for ix in range(x0 // t, (x1 - 1) // t + 1):
+                ty0, ty1 = max(y0, iy * t), min(y1, (iy + 1) * t)
+                tx0, tx1 = max(x0, ix * t), min(x1, (ix + 1) * t)
+                out[ty0-y0:ty1-y0, tx0-x0:tx1-x0] = self._open(iy, ix)[ty0-iy*t:ty1-iy*t, tx0-ix*t:tx1-ix*t]
+        return out.transpose(2, 0, 1)
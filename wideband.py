@@ -0,0 +1,121 @@
+# One wide-band spectrum of a position from the cubes of several spectral windows.
+#
+# extract_wideband() extracts the same aperture from all the cubes (e.g. spw25/27/29/31 of the
+# filelist of extract.py) concurrently, in a pool of threads: the extraction is dominated by the
+# reads of the cubes, and numpy and astropy release the GIL while reading. The spectra are
+# converted per channel to Jy and Tb (fluxes.py) and stitched onto one frequency axis, sorted by
+# frequency. Where two windows overlap, the channels are either
+#   'average' -- the noise-weighted (1/rms^2, rms from the MAD) average, the second window
+#                interpolated onto the channels of the first
+#   'cut'     -- taken from the first window below the middle of the overlap, and from the
+#                second above it (leaves out the noisy edges of both)
+# The result is written into one table (output.py), .fits or .npz.
+#
+# Usage:
+#   from wideband import extract_wideband
+#   freq, columns = extract_wideband(['spw25.fits', 'spw27.fits'], '13:15:06.315,-55.09.22.764', 0.6,
+#                                    outfile='wideband_spectra.fits')
+#
+# Author: Zhi-Yu Zhang
+# Email: pmozhang@gmail.com
+
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from spectra import extract_spectra
+from fluxes  import convert_spectra
+from noise   import mad_std
+from output  import write_spectra
+
+
+OVERLAPS = ('average', 'cut')
+
+
+def _extract(filename, position, diameter, tiles):
+    """(freq GHz, {column: (nchan,)}) of one aperture of one cube, in ascending frequency"""
+    axis, spectra = extract_spectra(filename, [position], diameter, tiles=tiles)
+    freq, flux, tb = convert_spectra(filename, spectra, diameter)
+    order = np.argsort(freq)
+    return freq[order], {'FLUX_JY_BEAM': spectra[0][order], 'FLUX_JY': flux[0][order], 'TB_K': tb[0][order]}
+
+
+def _weight(spectrum):
+    """1/rms^2 of a spectrum, rms from the MAD; 1 for a spectrum without noise"""
+    rms = mad_std(spectrum)
+    return 1. / rms**2 if np.isfinite(rms) and rms > 0 else 1.
+
+
+def stitch(segments, overlap='average'):
+    """stitch spectra of several windows onto one frequency axis
+
+    Parameters
+    ----------
+    segments : list
+        (freq, {column: spectrum}) of every window, freq ascending
+    overlap : str
+        'average' or 'cut', see above
+
+    Returns
+    -------
+    freq, {column: spectrum}
+    """
+    if overlap not in OVERLAPS:
+        raise ValueError("overlap must be one of "+str(OVERLAPS))
+    segments = sorted(segments, key=lambda seg: seg[0][0])
+    freq, cols = segments[0]
+    cols    = {key: np.array(value, dtype=np.float64) for key, value in cols.items()}    # copies: the inputs are kept
+    weights = {key: np.full(len(freq), _weight(value)) for key, value in cols.items()}
+    for nfreq, ncols in segments[1:]:
+        # -- a window inside the stitched band only adds to the average
+        if overlap == 'cut' and nfreq[0] <= freq[-1] < nfreq[-1]:
+            middle    = (nfreq[0] + freq[-1]) / 2.
+            keep, new = freq <= middle, nfreq > middle
+        else:
+            keep, new = np.ones(len(freq), dtype=bool), nfreq > freq[-1]
+        both = (freq >= nfreq[0]) & (freq <= nfreq[-1]) if overlap == 'average' else np.zeros(len(freq), dtype=bool)
+        for key in cols:
+            value  = np.asarray(ncols[key], dtype=np.float64)
+            weight = _weight(value)
+            if both.any():
+                shared = np.interp(freq[both], nfreq, value)
+                cols[key][both]    = (cols[key][both] * weights[key][both] + shared * weight) / (weights[key][both] + weight)
+                weights[key][both] = weights[key][both] + weight
+            cols[key]    = np.concatenate([cols[key][keep], value[new]])
+            weights[key] = np.concatenate([weights[key][keep], np.full(new.sum(), weight)])
+        freq = np.concatenate([freq[keep], nfreq[new]])
+    return freq, cols
+
+
+def extract_wideband(filelist, position, diameter, outfile=None, overlap='average', threads=None, tiles=False):
+    """the spectrum of one aperture in all the cubes of filelist, stitched onto one frequency axis
+
+    Parameters
+    ----------
+    filelist : list
+        the FITS cubes or CASA images of the spectral windows
+    position : str or SkyCoord
+        the centre of the aperture, see cube.parse_position()
+    diameter : float
+        the diameter of the aperture, arcsec
+    outfile : str
+        the output table (.fits or .npz), see output.py. Default: not written
+    overlap : str
+        'average' or 'cut', the channels where windows overlap
+    threads : int
+        the number of threads. Default: one per cube
+    tiles : bool
+        read the spectra from the spectral tiles of the cubes, see tiles.py
+
+    Returns
+    -------
+    freq, columns : ndarray, dict
+        the frequency (GHz), and FLUX_JY_BEAM, FLUX_JY and TB_K on it
+    """
+    with ThreadPoolExecutor(max_workers=threads or len(filelist)) as pool:
+        segments = list(pool.map(lambda filename: _extract(filename, position, diameter, tiles), filelist))
+    freq, cols = stitch(segments, overlap)
+    if outfile is not None:
+        header = {'APERTURE': diameter, 'OVERLAP': overlap}
+        header.update({'CUBE'+str(i): str(filename) for i, filename in enumerate(filelist)})
+        write_spectra(outfile, freq, cols, names=[str(position)], header=header)
+    return freq, cols